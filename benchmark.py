@@ -0,0 +1,287 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import main
+import stub_llm_server
+
+# Benchmark de extremo a extremo sobre un corpus sintético de PDFs tipo 20-F (texto + tablas con y sin reglado).
+# Mide cada etapa por separado y guarda un JSON con el commit para comparar entre versiones y dimensionar hardware.
+# Uso: python benchmark.py --pdfs 4 --text-pages 40 --ruled-tables 6 --unruled-tables 6 --llm stub --llm-latency-ms 500
+
+RESULTS_DIR = "resultados_benchmark"
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792 # Carta, en puntos
+FONT_SIZE, LEADING, MARGIN = 9, 11, 50
+MAIN_GLOBALS_OVERRIDDEN = ("LLM_BASE_URL", "LLM_RATE_LIMITER", "FOLDER_INPUT_PDFS", "EXTRACTION_CACHE_DIR", "LLM_CACHE_PATH", "LLM_STREAMING") # Restaurados al terminar run_benchmark
+
+_VOCABULARIO = ("expected credit loss", "probability of default", "loss given default", "exposure at default", "stage 1", "stage 2", "stage 3",
+                "significant increase in credit risk", "forward-looking information", "macroeconomic scenarios", "GDP growth", "unemployment rate",
+                "retail portfolio", "wholesale portfolio", "mortgage loans", "credit cards", "allowance for loan losses", "overlay", "recalibration",
+                "collateral", "cure rate", "write-off", "days past due", "lifetime", "12-month", "segmentation", "rating model", "scorecard",
+                "the Group", "management judgement", "IFRS 9", "during the year", "compared to", "increased", "decreased", "as a result of")
+_FILAS_TABLA = ("Stage 1 - Retail", "Stage 1 - Wholesale", "Stage 2 - Retail", "Stage 2 - Wholesale", "Stage 3 - Retail", "Stage 3 - Wholesale",
+                "Mortgage loans", "Credit cards", "Consumer loans", "SME loans", "Corporate loans", "Total allowance")
+
+# --- GENERADOR MÍNIMO DE PDF (sin dependencias: objetos, streams de contenido y tabla xref escritos a mano) ---
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def _text_op(x: float, y: float, text: str) -> str:
+    return f"BT /F1 {FONT_SIZE} Tf {x:.1f} {y:.1f} Td ({_pdf_escape(text)}) Tj ET"
+
+def synthetic_paragraph_lines(rng: random.Random, n_lines: int, chars_per_line: int = 100) -> list[str]:
+    lines, actual = [], ""
+    while len(lines) < n_lines:
+        frase = " ".join(rng.choice(_VOCABULARIO) for _ in range(rng.randint(6, 14))).capitalize() + f" by {rng.uniform(0.1, 25):.1f}%. "
+        for palabra in frase.split(" "):
+            if len(actual) + len(palabra) + 1 > chars_per_line: lines.append(actual.rstrip()); actual = ""
+            actual += palabra + " "
+    return lines[:n_lines]
+
+def text_page_content(rng: random.Random, page_number: int) -> str:
+    n_lines = int((PAGE_HEIGHT - 2 * MARGIN) / LEADING) - 2
+    ops = [_text_op(MARGIN, PAGE_HEIGHT - MARGIN, f"Item 5. Operating and Financial Review - Credit risk (page {page_number})")]
+    ops += [_text_op(MARGIN, PAGE_HEIGHT - MARGIN - (i + 2) * LEADING, line) for i, line in enumerate(synthetic_paragraph_lines(rng, n_lines))]
+    return "\n".join(ops)
+
+def table_page_content(rng: random.Random, page_number: int, rows: int, cols: int, ruled: bool) -> str:
+    # Tabla de provisiones por stage/segmento; con reglado (Camelot 'lattice') o solo alineada en columnas ('stream')
+    # La primera columna (etiquetas de segmento) ocupa el doble que las numéricas
+    col_w, row_h = (PAGE_WIDTH - 2 * MARGIN) / (cols + 1), 16
+    xs = [MARGIN] + [MARGIN + (c + 1) * col_w for c in range(1, cols + 1)]
+    top = PAGE_HEIGHT - MARGIN - 3 * LEADING
+    ops = [_text_op(MARGIN, PAGE_HEIGHT - MARGIN, f"Table {page_number}. Allowance for expected credit losses by stage (in millions)")]
+    ops += [_text_op(MARGIN, PAGE_HEIGHT - MARGIN - LEADING, " ".join(synthetic_paragraph_lines(rng, 1, 90)))]
+    cabecera = ["Segment"] + [f"{2024 - (c // 2)} {'Q4' if c % 2 else 'Q2'}" for c in range(cols - 1)]
+    filas = [cabecera] + [[_FILAS_TABLA[r % len(_FILAS_TABLA)]] + [f"{rng.uniform(10, 99999):,.1f}" for _ in range(cols - 1)] for r in range(rows)]
+    for r, fila in enumerate(filas):
+        y = top - (r + 1) * row_h + 5
+        ops += [_text_op(xs[c] + 3, y, celda) for c, celda in enumerate(fila)]
+    if ruled:
+        bottom = top - len(filas) * row_h
+        ops.append("0.5 w")
+        ops += [f"{MARGIN:.1f} {top - r * row_h:.1f} m {xs[-1]:.1f} {top - r * row_h:.1f} l S" for r in range(len(filas) + 1)]
+        ops += [f"{x:.1f} {top:.1f} m {x:.1f} {bottom:.1f} l S" for x in xs]
+    return "\n".join(ops)
+
+def write_pdf(path: str, page_streams: list[str]) -> None:
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    kids = []
+    for stream in page_streams:
+        data = stream.encode("latin-1", errors="replace")
+        objects.append(f"<< /Length {len(data)} >>\nstream\n".encode("latin-1") + data + b"\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode("latin-1") + (obj if isinstance(obj, bytes) else obj.encode("latin-1")) + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1") + "".join(f"{o:010d} 00000 n \n" for o in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f: f.write(out)
+
+def generate_synthetic_corpus(folder: str, n_pdfs: int, text_pages: int, ruled_tables: int, unruled_tables: int, rows: int, cols: int, seed: int = 0) -> list[str]:
+    # Cada PDF intercala sus páginas de tabla entre las de texto; la semilla hace el corpus reproducible
+    os.makedirs(folder, exist_ok=True)
+    fnames = []
+    for p in range(n_pdfs):
+        rng = random.Random(seed * 1000 + p)
+        tipos = ["texto"] * text_pages + ["reglada"] * ruled_tables + ["sin_reglado"] * unruled_tables
+        rng.shuffle(tipos)
+        streams = [text_page_content(rng, i + 1) if t == "texto" else table_page_content(rng, i + 1, rows, cols, ruled=(t == "reglada")) for i, t in enumerate(tipos)]
+        fname = f"BANCO_SINTETICO_{p + 1:02d} 20F.pdf"
+        write_pdf(os.path.join(folder, fname), streams); fnames.append(fname)
+    return fnames
+
+# --- MEDICIÓN ---
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str, items: int = None):
+        # El dict que se entrega permite fijar items y métricas extra dentro del bloque (p. ej. chunks producidos)
+        t0, c0 = time.perf_counter(), time.process_time()
+        self.stages[name] = {"items": items}
+        try: yield self.stages[name]
+        finally:
+            wall = time.perf_counter() - t0
+            self.stages[name].update({"wall_seconds": round(wall, 4), "cpu_seconds": round(time.process_time() - c0, 4)})
+            if self.stages[name]["items"]: self.stages[name]["items_per_second"] = round(self.stages[name]["items"] / wall, 2) if wall > 0 else None
+            logging.info(f"[benchmark] {name}: {wall:.3f}s" + (f" ({self.stages[name]['items']} items)" if self.stages[name]["items"] else ""))
+
+def git_commit() -> dict:
+    try:
+        root = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except Exception as e:
+        return {"commit": None, "error": str(e)}
+
+def percentiles(values: list[float]) -> dict:
+    if not values: return {}
+    arr = np.asarray(values) * 1000
+    return {"p50_ms": round(float(np.percentile(arr, 50)), 3), "p95_ms": round(float(np.percentile(arr, 95)), 3), "max_ms": round(float(arr.max()), 3)}
+
+def benchmark_llm(args, timer: StageTimer, contexts: list[str]) -> dict:
+    # Llamadas de análisis por parámetro contra un modelo falso: el servidor stub (HTTP real, pool de conexiones) o un
+    # RunnableLambda con latencia fija (solo el planificador). El limitador se amplía para medir el pipeline y no la cuota.
+    from langchain_core.runnables import RunnableLambda
+    server = None
+    if args.llm == "stub":
+        server, url = stub_llm_server.start_in_thread(config=stub_llm_server.StubConfig(latency_ms=args.llm_latency_ms, rate_429=args.llm_rate_429, seed=args.seed))
+    try: # El servidor se detiene siempre, también si la inicialización o las llamadas fallan
+        if server is not None:
+            main.LLM_BASE_URL = url
+            llm = main.initialize_llm("openai_compatible", temperature=0.0)
+        else:
+            llm = RunnableLambda(lambda prompt: (time.sleep(args.llm_latency_ms / 1000), f"Respuesta simulada ({len(str(prompt))} chars).")[1])
+        main.LLM_RATE_LIMITER = main.LLMRateLimiter(args.llm_rpm, 10**9)
+        param = main.PARAMETROS_CLAVE[0]
+        jobs = [(main.PROMPT_EXTRACCION_CAMBIOS_BE, {"context": contexts[i % len(contexts)], "nombre_parametro": param["nombre_parametro"],
+                                                      "aspectos_a_buscar_en_cambios": param["aspectos_parametro"], "nombre_banco_externo_prompt": "Banco Sintético"},
+                 f"benchmark llamada {i}") for i in range(args.llm_calls)]
+        with timer.stage("llm_calls", items=len(jobs)):
+            respuestas = main.run_llm_chains_concurrently(llm, jobs, args.llm_concurrency)
+        result = {"provider": args.llm, "latency_ms": args.llm_latency_ms, "concurrency": args.llm_concurrency, "failures": sum(1 for r in respuestas if main.is_llm_failure(r))}
+        if server is not None:
+            with server.RequestHandlerClass.state.lock: result["stub_stats"] = dict(server.RequestHandlerClass.state.stats)
+        return result
+    finally:
+        if server is not None: server.shutdown(); server.server_close()
+
+def run_benchmark(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark_ifrs9_")
+    pdf_dir = os.path.join(workdir, "pdfs")
+    # Globales de main.py que el benchmark modifica: se restauran al terminar para no afectar a quien lo importa (tests, notebooks)
+    globales_previos, nivel_log_previo = {name: getattr(main, name) for name in MAIN_GLOBALS_OVERRIDDEN}, logging.getLogger().level
+    timer = StageTimer()
+    try:
+        # Sin cachés persistentes: cada ejecución mide el trabajo completo
+        main.FOLDER_INPUT_PDFS, main.EXTRACTION_CACHE_DIR, main.LLM_CACHE_PATH = pdf_dir, None, None
+        main.LLM_STREAMING = False
+        main.start_tracing(export_path=None, summary_at_exit=False) # Los spans se agregan en el JSON de resultados
+        with timer.stage("generate_corpus", items=args.pdfs) as s:
+            fnames = generate_synthetic_corpus(pdf_dir, args.pdfs, args.text_pages, args.ruled_tables, args.unruled_tables, args.rows, args.cols, args.seed)
+            s["bytes"] = sum(os.path.getsize(os.path.join(pdf_dir, f)) for f in fnames)
+
+        page_docs = []
+        with timer.stage("pypdf_load") as s:
+            for fname in fnames:
+                pages = main.PyPDFLoader(os.path.join(pdf_dir, fname)).load()
+                page_docs += [main.Document(page_content=p.page_content, metadata={"source": fname, "page": p.metadata.get("page", i) + 1, "is_table": False}) for i, p in enumerate(pages)]
+            s["items"] = len(page_docs)
+
+        table_docs = []
+        if not args.skip_camelot:
+            with timer.stage("camelot_extraction") as s:
+                for fname in fnames: table_docs += [doc for doc, _ in main.extract_tables_from_pdf(os.path.join(pdf_dir, fname), pages="all")[0]]
+                s["items"] = len(table_docs)
+                s["expected_tables"] = args.pdfs * (args.ruled_tables + args.unruled_tables)
+
+        with timer.stage("preprocess_documents", items=len(page_docs) + len(table_docs)):
+            docs = main.preprocess_documents(page_docs + table_docs)
+
+        embedder = main.LocalEmbeddings(model_name=args.embedding_model, cache_dir=None)
+        with timer.stage("chunk_documents", items=len(docs)) as s:
+            chunks = main.chunk_documents(docs, count_tokens=embedder.count_tokens)
+            s["chunks"] = len(chunks)
+        if main.DEDUP_CHUNKS:
+            with timer.stage("deduplicate_chunks", items=len(chunks)) as s:
+                chunks = main.deduplicate_chunks(chunks)
+                s["chunks_after"] = len(chunks)
+
+        with timer.stage("embedding", items=len(chunks)):
+            vectors = main.embed_texts(embedder, [c.page_content for c in chunks], cache=True)
+
+        ids = main.assign_chunk_ids(chunks, {f: f"{i:016x}" for i, f in enumerate(fnames)})
+        with timer.stage("faiss_build", items=len(chunks)) as s:
+            index = main.create_faiss_index(vectors, args.faiss_factory or main.FAISS_INDEX_FACTORY)
+            index.add(vectors)
+            docstore = main.InMemoryDocstore({doc_id: doc for doc_id, doc in zip(ids, chunks)})
+            vector_store = main.FAISS(embedding_function=embedder, index=index, docstore=docstore, index_to_docstore_id=dict(enumerate(ids)))
+            s["factory"] = args.faiss_factory or main.FAISS_INDEX_FACTORY
+
+        queries = [main.retrieval_query(fnames[i % len(fnames)], main.PARAMETROS_CLAVE[i % len(main.PARAMETROS_CLAVE)]) for i in range(args.queries)]
+        latencias, contexts = [], []
+        logging.getLogger().setLevel(logging.WARNING) # Un log por búsqueda distorsionaría la latencia
+        with timer.stage("semantic_search_filtered", items=len(queries)) as s:
+            for i, query in enumerate(queries):
+                t0 = time.perf_counter()
+                resultados = main.semantic_search_filtered(query, vector_store, k=args.k, source_filename=fnames[i % len(fnames)])
+                latencias.append(time.perf_counter() - t0)
+                if len(contexts) < 16: contexts.append("\n\n".join(main.format_context_chunk(d) for d in resultados))
+            s.update(percentiles(latencias))
+        logging.getLogger().setLevel(logging.INFO)
+
+        llm_info = benchmark_llm(args, timer, contexts or ["(sin contexto)"]) if args.llm_calls > 0 else None
+    finally:
+        for name, value in globales_previos.items(): setattr(main, name, value)
+        logging.getLogger().setLevel(nivel_log_previo)
+        if not args.keep_workdir and not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": git_commit(),
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform(), "cpu_count": os.cpu_count(), "faiss": getattr(main.faiss, "__version__", None)},
+        "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        "corpus": {"pdfs": args.pdfs, "pages": len(page_docs), "tables": len(table_docs), "chunks": len(chunks)},
+        "llm": llm_info,
+        "stages": timer.stages,
+        "spans": main.TRACER.summary_rows(), # Spans internos del pipeline (embed, camelot_tables, llm_call...) agregados por nombre
+        "total_wall_seconds": round(sum(s.get("wall_seconds", 0) for s in timer.stages.values()), 4),
+    }
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark por etapas del pipeline de benchmarking IFRS 9 sobre PDFs sintéticos.")
+    parser.add_argument("--pdfs", type=int, default=2, help="Número de PDFs sintéticos")
+    parser.add_argument("--text-pages", type=int, default=20, help="Páginas de texto por PDF")
+    parser.add_argument("--ruled-tables", type=int, default=3, help="Páginas con tabla reglada por PDF")
+    parser.add_argument("--unruled-tables", type=int, default=3, help="Páginas con tabla sin reglado por PDF")
+    parser.add_argument("--rows", type=int, default=12, help="Filas por tabla")
+    parser.add_argument("--cols", type=int, default=6, help="Columnas por tabla")
+    parser.add_argument("--skip-camelot", action="store_true", help="No medir la extracción de tablas (p. ej. sin Ghostscript)")
+    parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--faiss-factory", default=None, help="Por defecto FAISS_INDEX_FACTORY de main.py")
+    parser.add_argument("--queries", type=int, default=60, help="Búsquedas filtradas a medir")
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--llm", choices=["stub", "fake"], default="stub", help="stub: servidor HTTP local; fake: RunnableLambda en proceso")
+    parser.add_argument("--llm-calls", type=int, default=24, help="0 para omitir la etapa LLM")
+    parser.add_argument("--llm-latency-ms", type=float, default=200.0)
+    parser.add_argument("--llm-rate-429", type=float, default=0.0, help="Fracción de 429 del servidor stub")
+    parser.add_argument("--llm-concurrency", type=int, default=main.LLM_MAX_CONCURRENCY)
+    parser.add_argument("--llm-rpm", type=float, default=6000, help="Límite de peticiones/minuto durante el benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="Carpeta de trabajo (por defecto temporal, se borra al terminar)")
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--output", default=None, help=f"Ruta del JSON de resultados (por defecto {RESULTS_DIR}/<fecha>_<commit>.json)")
+    return parser.parse_args(argv)
+
+def main_cli(argv: list[str] = None) -> str:
+    args = parse_args(argv)
+    results = run_benchmark(args)
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{(results['git'].get('commit') or 'sin_commit')[:10]}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\n{'Etapa':<28}{'Wall (s)':>10}{'CPU (s)':>10}{'Items':>8}{'Items/s':>10}")
+    for name, s in results["stages"].items():
+        print(f"{name:<28}{s.get('wall_seconds', 0):>10.3f}{s.get('cpu_seconds', 0):>10.3f}{s.get('items') or '':>8}{s.get('items_per_second') or '':>10}")
+    print(f"\n--- RESULTADOS DEL BENCHMARK GUARDADOS EN: {output} ---")
+    return output
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,24 +1,60 @@
 import os
 import logging
 import pandas as pd
+import numpy as np
 import camelot
 from langchain_google_genai import ChatGoogleGenerativeAI
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import time
 import shutil # Para limpiar directorio de FAISS
+import hashlib
+import json
+import gzip
+import atexit
+import sqlite3
+import re
+import zlib
+import unicodedata
+import asyncio
+import random
+import math
+import threading
+import httpx
+import contextvars
+import functools
+import multiprocessing
+import sys
+import uuid
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from itertools import islice
+from typing import Callable, Iterable, Iterator
 
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
 
 from langchain.schema import Document
 from langchain_community.document_loaders import PyPDFLoader
+from pypdf import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings.base import Embeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.docstore.base import Docstore, AddableMixin
+import faiss
 from langchain.prompts import PromptTemplate
 
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
+try: import resource # Memoria pico del proceso (no existe en Windows)
+except ImportError: resource = None
+try: import psutil # Opcional: memoria pico en Windows
+except ImportError: psutil = None
 
 load_dotenv()
 
@@ -32,6 +68,87 @@ NOMBRE_NUESTRO_BANCO_PROMPT = "Credicorp" # Constante global para nuestro banco
 
 FAISS_INDEX_PATH = "faiss_index_bancos_v11_final_output" # Nombre de índice para esta versión
 REBUILD_FAISS_INDEX = True # PONER EN TRUE PARA LA PRIMERA EJECUCIÓN O SI CAMBIAS PDFs
+FAISS_INDEX_FACTORY = "Flat" # Cadena de faiss.index_factory: "Flat" (exacto), "HNSW32", "IVF1024,PQ16"...
+FAISS_TRAIN_SAMPLE_SIZE = 50000 # Máx. vectores (muestra aleatoria) para entrenar índices IVF/PQ
+FAISS_IVF_NPROBE = 16
+FAISS_HNSW_EF_SEARCH = 64
+FAISS_MMAP_LOAD = True # Carga del índice por memory-map en ejecuciones solo de consulta
+FAISS_INDEX_KEEP_VERSIONS = 3 # Versiones anteriores del índice conservadas para rollback inmediato
+FAISS_DOCSTORE_FILENAME = "docstore.sqlite" # Texto y metadatos de los chunks (carga perezosa por ID, sin pickle)
+FAISS_DOCSTORE_REF_FILENAME = "docstore_ref.txt" # Versiones incrementales: ruta relativa del docstore (de una versión anterior) que comparten
+FAISS_RECALL_EVAL_QUERIES = 200 # Queries de muestra para medir recall@k frente a búsqueda exacta (0 = no medir)
+FAISS_VALIDATION_MIN_SELF_HITS = 0.8 # Fracción mínima de chunks de muestra (re-embebidos) cuyo top-1 es el propio chunk para publicar una versión
+FAISS_VALIDATION_APPROX_TOP_K = 10 # Índices aproximados (IVF/PQ/HNSW): basta con que el propio chunk aparezca en el top-k
+FAISS_VALIDATION_MIN_SELF_HITS_APPROX = 0.5 # Fracción mínima para índices aproximados (la cuantización PQ y el sondeo parcial pierden el top-1)
+INCREMENTAL_FAISS_UPDATE = True # Con REBUILD_FAISS_INDEX, re-embebe solo PDFs nuevos/modificados y elimina los retirados (según el manifiesto)
+FAISS_MANIFEST_FILENAME = "pdf_manifest.json" # Manifiesto de hashes por PDF guardado junto al índice
+INGESTION_MAX_WORKERS = max(1, (os.cpu_count() or 1) - 1) # Procesos para cargar PDFs/tablas en paralelo (1 = secuencial)
+INGESTION_STREAMING = True # Pipeline en streaming: PDF -> normalizar -> chunks -> embeddings por lotes -> índice, con memoria acotada
+INGESTION_BATCH_SIZE = 512 # Chunks por lote de embedding/inserción en el índice (acota la memoria pico)
+INGESTION_MAX_PDFS_IN_FLIGHT = 4 # PDFs extraídos por adelantado y en memoria a la vez en modo streaming
+CHUNK_SIZE_TOKENS = 254 # Tamaño de chunk en tokens del modelo de embeddings (max_seq_length=256 de all-MiniLM-L6-v2 menos [CLS]/[SEP]: lo que exceda se trunca)
+CHUNK_OVERLAP_TOKENS = 32 # Solapamiento entre chunks de texto (las tablas se parten por filas, sin solapamiento)
+DEDUP_CHUNKS = True # Colapsar chunks casi duplicados (MinHash/LSH) antes de embeber: boilerplate legal, tablas repetidas...
+DEDUP_SIMILARITY_THRESHOLD = 0.85 # Similitud de Jaccard estimada a partir de la cual dos chunks se consideran duplicados
+DEDUP_NUM_PERM = 128 # Nº de permutaciones de la firma MinHash
+DEDUP_SHINGLE_SIZE = 5 # Palabras por shingle
+CAMELOT_PRESCREEN_PAGES = True # Pre-selección barata de páginas con posibles tablas antes de correr Camelot
+PRESCREEN_MIN_RULING_OPS = 6 # Nº mínimo de líneas/rectángulos dibujados para considerar la página 'reglada' (lattice)
+PRESCREEN_MIN_NUMERIC_LINES = 4 # Nº mínimo de líneas de texto con >=3 valores numéricos para considerar tabla sin reglado (stream)
+CAMELOT_LATTICE_KWARGS = {'line_scale': 40}
+CAMELOT_STREAM_KWARGS = {'edge_tol': 100, 'row_tol': 5}
+EXTRACTION_CACHE_DIR = "cache_extraccion_pdfs" # Texto por página y tablas limpias por PDF (JSONL gzip). None para desactivar
+EXTRACTION_CACHE_VERSION = 1 # Incrementar si cambia la lógica de extracción/limpieza para invalidar la caché
+TABLE_STORE_PATH = "tablas_estructuradas.sqlite" # Tablas de Camelot en formato largo (celda a celda, con valores numéricos). None para desactivar
+TABLE_LOOKUP_MAX_TABLES = 3 # Tablas (las de más términos coincidentes) que se pasan como contexto estructurado por parámetro
+TABLE_LOOKUP_MAX_ROWS = 40 # Filas máx. de contexto estructurado por parámetro
+EMBEDDING_CACHE_DIR = "cache_embeddings" # Caché de vectores por (modelo, hash del texto normalizado). None para desactivar
+EMBEDDING_CACHE_DTYPE = "float32" # "float16" reduce a la mitad el tamaño en disco
+EMBEDDING_CACHE_MAX_MB = 2048 # Tamaño máx. del archivo de vectores; al superarlo se compacta conservando los más recientes. None = sin límite
+EMBEDDING_BACKEND = "torch" # "torch" (fp32) o "onnx_int8" (ONNX cuantizado; requiere sentence-transformers>=3.2 con optimum/onnxruntime)
+EMBEDDING_ONNX_FILE = "onnx/model_quint8_avx2.onnx" # Variante int8 publicada en el repo del modelo (hay también avx512, avx512_vnni, arm64)
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_NUM_PROCESSES = 1 # >1 reparte la codificación entre varios procesos CPU
+EMBEDDING_MULTIPROCESS_MIN_TEXTS = 2000 # Por debajo de este nº de textos no compensa usar el pool multi-proceso
+EMBEDDING_PARITY_SAMPLE = 200 # Nº de chunks para medir la deriva coseno del backend cuantizado frente a fp32 (0 = no medir)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "google") # "google" (Gemini) u "openai_compatible" (/v1/chat/completions: vLLM, Ollama, stub_llm_server.py)
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME") or None # None: modelo por defecto del proveedor
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://127.0.0.1:8765/v1") # Solo para "openai_compatible"
+LLM_HTTP_TIMEOUT_SECONDS = 300
+LLM_REQUESTS_PER_MINUTE = 15 # Presupuesto de peticiones/minuto del proveedor (Gemini Flash, nivel gratuito)
+LLM_TOKENS_PER_MINUTE = 1_000_000 # Presupuesto de tokens/minuto (entrada estimada + reserva de salida)
+LLM_MAX_CONCURRENCY = 4 # Llamadas LLM simultáneas como máximo
+LLM_HTTP_MAX_CONNECTIONS = LLM_MAX_CONCURRENCY * 2 # Tamaño del pool de conexiones HTTP por proveedor
+LLM_MAX_RETRIES = 5 # Reintentos ante errores de cuota (429/RESOURCE_EXHAUSTED) o no disponibilidad temporal
+LLM_BACKOFF_BASE_SECONDS = 2.0 # Backoff exponencial con jitter: espera ~ U(0, min(máx, base * 2^intento))
+LLM_BACKOFF_MAX_SECONDS = 60.0
+LLM_CHARS_PER_TOKEN = 4.0 # Estimación de tokens de entrada para el presupuesto de TPM
+LLM_TOKEN_CALIBRATION_PATH = "calibracion_tokens_llm.json" # Caracteres/token calibrados por (proveedor, modelo); se reutilizan entre ejecuciones. None para recalibrar siempre
+LLM_TOKEN_CALIBRATION_STEP = 0.25 # La relación calibrada se redondea a la baja a este paso: variaciones pequeñas no cambian el contexto empaquetado
+LLM_OUTPUT_TOKENS_RESERVE = 2048 # Tokens de salida reservados por llamada en el presupuesto de TPM
+LLM_CACHE_PATH = "cache_llm_respuestas.sqlite" # Respuestas por (modelo, temperatura, hash de plantilla, hash de inputs). None para desactivar
+LLM_CACHE_MAX_MB = 200 # Tamaño máx. de las respuestas guardadas; se expulsan las usadas hace más tiempo (LRU)
+LLM_CACHE_BYPASS = False # True: no leer la caché (siempre se llama al LLM), pero sí refrescarla con las nuevas respuestas
+LLM_STREAMING = True # chain.stream en lugar de chain.invoke: los informes y la conclusión se muestran en consola a medida que se generan
+LLM_CONTEXT_BUDGET_ANALISIS = 12000 # Tokens (del modelo LLM) de contexto recuperado por llamada de análisis por parámetro
+LLM_CONTEXT_BUDGET_INFORME = 120000 # Tokens de contexto para el informe individual (reemplaza el corte a 300000 caracteres)
+CONTEXT_MMR_LAMBDA = 0.7 # MMR: 1.0 = solo relevancia, 0.0 = solo diversidad
+CONTEXT_MIN_OVERLAP_CHARS = 20 # Solapamiento mínimo (sufijo/prefijo) para recortar texto repetido entre chunks contiguos
+CONTEXT_COMPRESSION_ENABLED = True # Compresión extractiva local: solo las frases/filas de tabla más afines a la query y a los aspectos del parámetro
+CONTEXT_COMPRESSION_KEEP_RATIO = 0.5 # Fracción (en caracteres) del texto recuperado que se conserva
+CONTEXT_COMPRESSION_MIN_SIMILARITY = 0.25 # Las unidades por encima de esta similitud coseno se conservan aunque excedan la fracción
+CONTEXT_COMPRESSION_MAX_UNIT_WORDS = 60 # Frases más largas (texto PDF sin puntuación) se parten en ventanas de este tamaño
+CONCLUSION_DIGEST_MAX_WORDS = 400 # Tamaño objetivo de cada resumen de hallazgos (map) y de cada fusión (reduce)
+CONCLUSION_DIGEST_MAX_TOKENS = 650 # Cuota (tokens LLM) de un informe que no se pudo resumir: equivale a ~CONCLUSION_DIGEST_MAX_WORDS palabras en español
+CONCLUSION_REDUCE_GROUP_TOKENS = 24000 # Tokens máx. de resúmenes por llamada de fusión y para la conclusión final
+TRACE_ENABLED = True # Spans por etapa y por llamada LLM: tiempo, CPU, RSS pico, chunks/vectores, tokens, reintentos, caché
+TRACE_EXPORT_PATH = "trazas_pipeline.jsonl" # None para no exportar (el resumen final se sigue mostrando)
+TRACE_EXPORT_FORMAT = "jsonl" # "jsonl" (un span por línea, se añade al archivo) u "otlp_json" (traza OpenTelemetry por ejecución)
+TRACE_SUMMARY_AT_EXIT = True # Tabla resumen por tipo de span al terminar
+PIPELINE_ARTIFACTS_DIR = "artefactos_pipeline" # Salida de cada etapa (recuperación, análisis, informes) por hash de sus entradas. None para no persistir
+PIPELINE_RESUME = True # Reutilizar artefactos válidos: al reanudar solo se re-ejecutan las etapas afectadas por entradas modificadas
+PIPELINE_ARTIFACTS_VERSION = 1 # Incrementar para invalidar todos los artefactos
+PIPELINE_ARTIFACTS_KEEP_VERSIONS = 1 # Por etapa y elemento (fuente, parámetro...): versiones superadas que se conservan además de las usadas. None = no podar
 
 # --- LISTA DE PARÁMETROS CLAVE Y QUERIES ---
 PARAMETROS_CLAVE = [
@@ -57,7 +174,8 @@ PARAMETROS_CLAVE = [
         "nombre_parametro": "Expected Credit Loss (ECL) y Staging",
         "query_rag_nuestro_banco_template": f"Metodología actual de Pérdida Crediticia Esperada (ECL) {NOMBRE_NUESTRO_BANCO_PROMPT} y criterios de clasificación por etapas (Stage 1, 2, 3), transferencias",
         "query_rag_banco_externo_template": "Metodología de Pérdida Crediticia Esperada (ECL) {nombre_banco_externo}, criterios de etapas (Stage 1, 2, 3), transferencias entre etapas, justificación, factores y cualquier cambio o actualización",
-        "aspectos_parametro": "fórmula PDxLGDxEAD, ponderación de escenarios macroeconómicos (listar escenarios y ponderaciones si se mencionan), definición y criterios de Stages (cuantitativos y cualitativos), umbrales de transferencia, impacto cuantitativo del cambio en ECL total o por Stage si lo hay, fechas."
+        "aspectos_parametro": "fórmula PDxLGDxEAD, ponderación de escenarios macroeconómicos (listar escenarios y ponderaciones si se mencionan), definición y criterios de Stages (cuantitativos y cualitativos), umbrales de transferencia, impacto cuantitativo del cambio en ECL total o por Stage si lo hay, fechas.",
+        "terminos_tabla": ["stage", "etapa", "ecl", "pérdida esperada", "expected credit loss", "provisión"] # Opcional: búsqueda directa en las tablas
     },
     {
         "nombre_parametro": "Significant Increase in Credit Risk (SICR)",
@@ -69,7 +187,8 @@ PARAMETROS_CLAVE = [
         "nombre_parametro": "Forward-Looking Information (FLI)",
         "query_rag_nuestro_banco_template": f"Uso actual de información prospectiva (FLI) en modelos de riesgo {NOMBRE_NUESTRO_BANCO_PROMPT}, escenarios macroeconómicos",
         "query_rag_banco_externo_template": "Metodología, cambios o actualizaciones en uso de información prospectiva (FLI) {nombre_banco_externo}, escenarios macroeconómicos (listar variables específicas, ponderaciones, fuentes si se mencionan), justificación y cómo se integran en PD, LGD o ECL",
-        "aspectos_parametro": "variables macroeconómicas clave (listar si se mencionan, ej. PBI, desempleo, tasas de interés, inflación sectorial), número y ponderación de escenarios (ej. base, optimista, pesimista, severo), fuentes de proyecciones, frecuencia de actualización, overlays de gestión basados en FLI, impacto cuantitativo del cambio si lo hay, fechas."
+        "aspectos_parametro": "variables macroeconómicas clave (listar si se mencionan, ej. PBI, desempleo, tasas de interés, inflación sectorial), número y ponderación de escenarios (ej. base, optimista, pesimista, severo), fuentes de proyecciones, frecuencia de actualización, overlays de gestión basados en FLI, impacto cuantitativo del cambio si lo hay, fechas.",
+        "terminos_tabla": ["escenario", "scenario", "ponderación", "weight", "pbi", "gdp", "desempleo", "unemployment"]
     }
 ]
 
@@ -220,7 +339,12 @@ TU TAREA: Generar un informe de benchmarking en formato MARKDOWN. Sé preciso, e
 TEMPLATE_CONCLUSION_GLOBAL_BENCHMARK = """
 Actúa como el Director de Estrategia de Riesgos de '{nombre_nuestro_banco_prompt}', presentando las conclusiones finales y recomendaciones estratégicas consolidadas de un ejercicio de benchmarking exhaustivo.
 Se han analizado múltiples bancos competidores ({lista_nombres_competidores}) en comparación con las prácticas de '{nombre_nuestro_banco_prompt}'.
-Los análisis individuales de cada competidor (que has procesado previamente, incluyendo explicaciones de conceptos clave) son la base para esta conclusión global.
+Los análisis individuales de cada competidor, condensados a continuación en resúmenes de hallazgos, son la base para esta conclusión global.
+
+RESÚMENES DE HALLAZGOS DE LOS INFORMES INDIVIDUALES:
+---
+{resumenes_hallazgos_competidores}
+---
 
 TU TAREA:
 Con base en TODOS los informes de benchmarking individuales que has generado, elabora una sección final para el informe consolidado. Esta sección debe ser **clara, accionable y explicar conceptos clave cuando sea necesario para la comprensión de las recomendaciones por parte del Comité de Riesgos de '{nombre_nuestro_banco_prompt}'. Evita recomendaciones genéricas. Enfócate en análisis internos, pilotos o desarrollo de capacidades que '{nombre_nuestro_banco_prompt}' pueda emprender.**
@@ -249,6 +373,205 @@ Utiliza formato MARKDOWN para una presentación clara y profesional, con encabez
 El enfoque debe ser 100% en cómo '{nombre_nuestro_banco_prompt}' puede mejorar y fortalecerse de manera práctica.
 """
 
+# Map-reduce de la conclusión global: cada informe individual se condensa (map) y los resúmenes se fusionan por grupos (reduce)
+TEMPLATE_RESUMEN_HALLAZGOS_COMPETIDOR = """
+Actúa como analista senior de Metodologías de Riesgo de '{nombre_nuestro_banco_prompt}'.
+A continuación tienes el informe de benchmarking individual del competidor '{nombre_banco_externo_prompt}'.
+Condénsalo en un RESUMEN DE HALLAZGOS compacto (máximo {max_palabras} palabras) que servirá de insumo para una conclusión global junto con los de otros competidores.
+
+INFORME INDIVIDUAL DE {nombre_banco_externo_prompt}:
+---
+{informe_competidor}
+---
+
+Formato (MARKDOWN, solo viñetas, sin introducción):
+### {nombre_banco_externo_prompt}
+*   **Prácticas destacadas por parámetro** (PD, LGD, EAD, ECL/Staging, SICR, FLI): una viñeta por parámetro con información, con técnicas, cifras y fechas concretas si aparecen.
+*   **Cambios metodológicos recientes** y su impacto cuantitativo, si se mencionan.
+*   **Oportunidades para '{nombre_nuestro_banco_prompt}'** que el informe identifica (máximo 3).
+No inventes información que no esté en el informe. Conserva el nombre del competidor en cada hallazgo.
+"""
+
+TEMPLATE_FUSION_RESUMENES_HALLAZGOS = """
+Actúa como analista senior de Metodologías de Riesgo de '{nombre_nuestro_banco_prompt}'.
+Fusiona los siguientes resúmenes de hallazgos de varios competidores en UN solo resumen compacto (máximo {max_palabras} palabras).
+
+RESÚMENES A FUSIONAR:
+---
+{resumenes_grupo}
+---
+
+Agrupa por parámetro (PD, LGD, EAD, ECL/Staging, SICR, FLI) y luego por oportunidades para '{nombre_nuestro_banco_prompt}'.
+Indica siempre entre paréntesis qué competidor(es) respaldan cada hallazgo. Destaca las tendencias que se repiten entre competidores.
+No inventes información. Usa MARKDOWN con viñetas.
+"""
+
+# --- TRAZAS POR ETAPA Y POR LLAMADA LLM (tiempo, CPU, memoria, contadores) ---
+# Cada span registra tiempo real, CPU del proceso (incluye otros hilos), variación de RSS entre su inicio y su fin, el pico de
+# RSS del proceso hasta ese momento (no atribuible al span) y atributos (chunks, vectores, tokens, reintentos, aciertos de caché). El padre se propaga con contextvars, también a los hilos de asyncio.to_thread.
+# Los spans de los procesos de extracción se exportan al mismo JSONL (mismo trace_id vía entorno) pero no entran en el resumen.
+_CURRENT_SPAN: contextvars.ContextVar = contextvars.ContextVar("pipeline_span", default=None)
+
+def current_rss_mb() -> float | None:
+    # Memoria residente actual del proceso: /proc/self/statm (Linux, sin llamadas al sistema caras) o psutil; None si no hay ninguno
+    try:
+        with open("/proc/self/statm", "rb") as f: return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError, AttributeError): pass
+    if psutil is not None: return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+    return None
+
+def process_peak_rss_mb() -> float | None:
+    # Memoria residente máxima del proceso desde su arranque (no de un span): resource (Linux/macOS) o psutil (Windows)
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) # macOS: bytes; Linux: KiB
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    return None
+
+def _format_mb(value: float | None) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+class Span:
+    def __init__(self, name: str, parent_id: str | None, attributes: dict):
+        self.name, self.parent_id, self.attributes = name, parent_id, dict(attributes)
+        self.span_id = os.urandom(8).hex()
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, key: str, value: float = 1) -> None:
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+class _NullSpan(Span):
+    # Fuera de cualquier span (o con trazas desactivadas) los set/add no acumulan nada
+    def set(self, **attributes) -> None: pass
+    def add(self, key: str, value: float = 1) -> None: pass
+
+_NULL_SPAN = _NullSpan("null", None, {})
+
+class Tracer:
+    def __init__(self, export_path: str = TRACE_EXPORT_PATH, export_format: str = TRACE_EXPORT_FORMAT, enabled: bool = TRACE_ENABLED, summary_at_exit: bool = TRACE_SUMMARY_AT_EXIT):
+        self.export_path, self.export_format, self.enabled, self.summary_at_exit = export_path, export_format, enabled, summary_at_exit
+        self.trace_id = os.environ.setdefault("PIPELINE_TRACE_ID", uuid.uuid4().hex) # Heredado por los procesos hijos
+        self.spans, self._lock, self._file, self._closed = [], threading.Lock(), None, False
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent = _CURRENT_SPAN.get()
+        if not self.enabled: yield _NULL_SPAN; return
+        span = Span(name, parent.span_id if parent else None, attributes)
+        token = _CURRENT_SPAN.set(span)
+        start_ns, t0, c0, rss0 = time.time_ns(), time.perf_counter(), time.process_time(), current_rss_mb()
+        status = "ok"
+        try: yield span
+        except BaseException as e: status = f"error: {type(e).__name__}"; raise
+        finally:
+            _CURRENT_SPAN.reset(token)
+            rss1 = current_rss_mb()
+            self._finish({"trace_id": self.trace_id, "span_id": span.span_id, "parent_id": span.parent_id, "name": name,
+                          "start_unix_ns": start_ns, "end_unix_ns": time.time_ns(), "wall_seconds": round(time.perf_counter() - t0, 4),
+                          "cpu_seconds": round(time.process_time() - c0, 4), "rss_end_mb": rss1,
+                          "rss_delta_mb": round(rss1 - rss0, 1) if rss1 is not None and rss0 is not None else None,
+                          "process_peak_rss_mb": process_peak_rss_mb(),
+                          "pid": os.getpid(), "thread": threading.current_thread().name, "status": status, "attributes": span.attributes})
+
+    def _finish(self, record: dict) -> None:
+        with self._lock:
+            self.spans.append(record)
+            if not self.export_path or self.export_format != "jsonl": return
+            try:
+                if self._file is None: self._file = open(self.export_path, "a", encoding="utf-8")
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n"); self._file.flush()
+            except OSError as e: logging.warning(f"No se pudo exportar el span '{record['name']}': {e}"); self.export_path = None
+
+    def export_otlp_json(self, path: str) -> None:
+        # Formato JSON de OTLP (resourceSpans/scopeSpans): importable en Jaeger, Tempo o un OpenTelemetry Collector
+        def _value(v):
+            if isinstance(v, bool): return {"boolValue": v}
+            if isinstance(v, int): return {"intValue": str(v)}
+            if isinstance(v, float): return {"doubleValue": v}
+            return {"stringValue": str(v)}
+        spans = []
+        for r in self.spans:
+            attrs = {**r["attributes"], "wall_seconds": r["wall_seconds"], "cpu_seconds": r["cpu_seconds"], "rss_end_mb": r["rss_end_mb"],
+                     "rss_delta_mb": r["rss_delta_mb"], "process_peak_rss_mb": r["process_peak_rss_mb"], "thread": r["thread"]}
+            spans.append({"traceId": r["trace_id"], "spanId": r["span_id"], "parentSpanId": r["parent_id"] or "", "name": r["name"], "kind": 1,
+                          "startTimeUnixNano": str(r["start_unix_ns"]), "endTimeUnixNano": str(r["end_unix_ns"]),
+                          "attributes": [{"key": k, "value": _value(v)} for k, v in attrs.items() if v is not None],
+                          "status": {"code": 1} if r["status"] == "ok" else {"code": 2, "message": r["status"]}})
+        resource_attrs = [{"key": "service.name", "value": {"stringValue": "benchmark_ifrs9"}}, {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"resourceSpans": [{"resource": {"attributes": resource_attrs}, "scopeSpans": [{"scope": {"name": "main"}, "spans": spans}]}]}, f, ensure_ascii=False)
+
+    def summary_rows(self) -> list[dict]:
+        # Agregado por nombre de span: llamadas, tiempos, mayor variación de RSS de un span, pico del proceso y suma de los atributos numéricos
+        rows = {}
+        for r in self.spans:
+            row = rows.setdefault(r["name"], {"name": r["name"], "count": 0, "errors": 0, "wall_seconds": 0.0, "max_wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                              "max_rss_delta_mb": None, "process_peak_rss_mb": None, "totals": {}})
+            row["count"] += 1; row["errors"] += r["status"] != "ok"
+            row["wall_seconds"] += r["wall_seconds"]; row["max_wall_seconds"] = max(row["max_wall_seconds"], r["wall_seconds"]); row["cpu_seconds"] += r["cpu_seconds"]
+            if r["rss_delta_mb"] is not None: row["max_rss_delta_mb"] = r["rss_delta_mb"] if row["max_rss_delta_mb"] is None else max(row["max_rss_delta_mb"], r["rss_delta_mb"])
+            if r["process_peak_rss_mb"] is not None: row["process_peak_rss_mb"] = max(row["process_peak_rss_mb"] or 0, r["process_peak_rss_mb"])
+            for k, v in r["attributes"].items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool) or isinstance(v, bool) and v: row["totals"][k] = row["totals"].get(k, 0) + v
+        return sorted(rows.values(), key=lambda row: -row["wall_seconds"])
+
+    def print_summary(self) -> None:
+        if not self.spans: return
+        print(f"\n--- RESUMEN DE TRAZAS (trace_id={self.trace_id}) ---")
+        print(f"{'Span':<26}{'N':>6}{'Err':>5}{'Wall (s)':>10}{'Máx (s)':>9}{'CPU (s)':>9}{'ΔRSS máx (MB)':>15}{'Pico proc. (MB)':>17}  Contadores")
+        for row in self.summary_rows():
+            contadores = ", ".join(f"{k}={round(v, 2) if isinstance(v, float) else v}" for k, v in sorted(row["totals"].items()))
+            print(f"{row['name']:<26}{row['count']:>6}{row['errors']:>5}{row['wall_seconds']:>10.2f}{row['max_wall_seconds']:>9.2f}{row['cpu_seconds']:>9.2f}{_format_mb(row['max_rss_delta_mb']):>15}{_format_mb(row['process_peak_rss_mb']):>17}  {contadores}")
+
+    def shutdown(self) -> None:
+        # Solo el proceso principal resume y exporta en OTLP; los procesos hijos solo escriben sus líneas JSONL
+        if multiprocessing.parent_process() is not None or self._closed: return
+        with self._lock:
+            self._closed = True
+            if self._file is not None: self._file.close(); self._file = None
+        if self.enabled and self.export_path and self.export_format == "otlp_json" and self.spans:
+            path = f"{os.path.splitext(self.export_path)[0]}_{self.trace_id[:8]}.otlp.json"
+            try: self.export_otlp_json(path); logging.info(f"Trazas exportadas (OTLP JSON) en: {path}")
+            except OSError as e: logging.warning(f"No se pudieron exportar las trazas OTLP: {e}")
+        elif self.enabled and self.export_path and self.spans: logging.info(f"Trazas exportadas (JSONL, trace_id={self.trace_id}) en: {self.export_path}")
+        if self.summary_at_exit: self.print_summary()
+
+TRACER: Tracer = None # Lo crea start_tracing() al ejecutar el script o el benchmark; importar main no traza ni escribe nada
+
+def start_tracing(export_path: str = TRACE_EXPORT_PATH, summary_at_exit: bool = TRACE_SUMMARY_AT_EXIT) -> Tracer:
+    global TRACER
+    if TRACER is None:
+        TRACER = Tracer(export_path, summary_at_exit=summary_at_exit)
+        os.environ["PIPELINE_TRACE_EXPORT_PATH"] = export_path or "" # Junto con PIPELINE_TRACE_ID, lo heredan los procesos hijos
+        atexit.register(TRACER.shutdown)
+    return TRACER
+
+def get_tracer() -> Tracer | None:
+    # Los procesos hijos (spawn) reimportan main sin tracer: lo recrean con el trace_id y el archivo del padre
+    if TRACER is None and "PIPELINE_TRACE_ID" in os.environ and multiprocessing.parent_process() is not None:
+        start_tracing(os.environ.get("PIPELINE_TRACE_EXPORT_PATH") or None, summary_at_exit=False)
+    return TRACER
+
+def trace_span(name: str, **attributes):
+    tracer = get_tracer()
+    return tracer.span(name, **attributes) if tracer is not None else nullcontext(_NULL_SPAN)
+
+def current_span() -> Span:
+    return _CURRENT_SPAN.get() or _NULL_SPAN
+
+def traced(name: str):
+    # Decorador: la función completa se ejecuta dentro de un span; dentro, current_span().set(...) añade atributos
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name): return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # --- FUNCIONES ---
 def clean_camelot_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty: return df
@@ -268,28 +591,89 @@ def clean_camelot_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     df_cleaned.reset_index(drop=True, inplace=True)
     return df_cleaned
 
-def extract_and_format_tables_from_pdf(pdf_path: str, pages: str = 'all') -> list[Document]:
-    table_docs = []
+# Operadores de dibujo en el content stream: rectángulos ("x y w h re") y segmentos ("x y l")
+_RE_RULING_RECT = re.compile(rb'(?:-?\d*\.?\d+\s+){4}re\b')
+_RE_RULING_LINE = re.compile(rb'(?:-?\d*\.?\d+\s+){2}l\b')
+_RE_NUMERIC_TOKEN = re.compile(r'^\(?[-+]?[$€£]?(?:S/)?\d[\d.,]*%?\)?$')
+
+def screen_pdf_pages_for_tables(pdf_path: str) -> dict[int, bool]:
+    # Devuelve {página (1-based): tiene_reglado} solo para las páginas que probablemente contienen tablas
+    reader = PdfReader(pdf_path)
+    candidates = {}
+    for page_number, page in enumerate(reader.pages, start=1):
+        try:
+            contents = page.get_contents()
+            data = contents.get_data() if contents is not None else b""
+            ruling_ops = len(_RE_RULING_RECT.findall(data)) + len(_RE_RULING_LINE.findall(data))
+            text = page.extract_text() or ""
+        except Exception as e:
+            logging.warning(f"Pre-selección: no se pudo analizar la pág {page_number} de {os.path.basename(pdf_path)} ({e}). Se incluirá.")
+            candidates[page_number] = True; continue
+        numeric_lines = sum(1 for line in text.splitlines() if sum(1 for tok in line.split() if _RE_NUMERIC_TOKEN.match(tok)) >= 3)
+        has_rulings = ruling_ops >= PRESCREEN_MIN_RULING_OPS
+        if has_rulings or numeric_lines >= PRESCREEN_MIN_NUMERIC_LINES:
+            candidates[page_number] = has_rulings
+    return candidates
+
+def _expand_page_spec(pages: str, num_pages: int) -> list[int]:
+    # Interpreta la sintaxis de páginas de Camelot ('all', '1,3-5', '10-end')
+    if pages == 'all': return list(range(1, num_pages + 1))
+    result = []
+    for part in pages.split(','):
+        part = part.strip()
+        if '-' in part:
+            a, b = part.split('-', 1)
+            result.extend(range(int(a), (num_pages if b.strip() == 'end' else int(b)) + 1))
+        elif part: result.append(int(part))
+    return result
+
+def extract_and_format_tables_from_pdf(pdf_path: str, pages: str = 'all', prescreen: bool = CAMELOT_PRESCREEN_PAGES) -> list[Document]:
+    table_items, _ = extract_tables_from_pdf(pdf_path, pages=pages, prescreen=prescreen)
+    return [doc for doc, _ in table_items]
+
+@traced("camelot_tables")
+def extract_tables_from_pdf(pdf_path: str, pages: str = 'all', prescreen: bool = CAMELOT_PRESCREEN_PAGES) -> tuple[list[tuple[Document, pd.DataFrame]], bool]:
+    # Devuelve ([(Document markdown, DataFrame limpio)], extracción_completa). Incompleta si Camelot falló en algún flavor.
+    table_items = []
+    extraction_complete = True
     short_pdf_name = os.path.basename(pdf_path)
+
+    # Páginas candidatas: con reglado se intenta 'lattice' primero; sin reglado se va directo a 'stream'
+    candidates = None
+    if prescreen and pages == 'all':
+        try:
+            candidates = screen_pdf_pages_for_tables(pdf_path)
+            logging.info(f"Pre-selección de {short_pdf_name}: {len(candidates)} página(s) candidata(s) a contener tablas ({sum(candidates.values())} con reglado).")
+        except Exception as e: logging.warning(f"Pre-selección de páginas falló para {short_pdf_name} ({e}). Se analizarán todas las páginas.")
+    if candidates is None:
+        try: candidates = {p: True for p in _expand_page_spec(pages, len(PdfReader(pdf_path).pages))}
+        except Exception as e:
+            logging.error(f"No se pudieron determinar las páginas de {short_pdf_name}: {e}"); return table_items, False
+    if not candidates:
+        logging.info(f"Ninguna página de {short_pdf_name} parece contener tablas. Se omite Camelot.")
+        return table_items, extraction_complete
+
     flavors_to_try = ['lattice', 'stream']
-    tables_found_with_first_flavor = False
+    pages_with_tables = set()
     # Suprimir warnings de Camelot durante la extracción
     camelot_logger = logging.getLogger('camelot')
     original_level = camelot_logger.level
     camelot_logger.setLevel(logging.CRITICAL) # O logging.ERROR para ver solo errores de Camelot
 
     for flavor in flavors_to_try:
-        if flavor == 'stream' and tables_found_with_first_flavor:
-            logging.info(f"Tablas encontradas con 'lattice' para {short_pdf_name}. Omitiendo 'stream'.")
-            break
-        logging.info(f"Extrayendo tablas de {short_pdf_name} (págs: {pages}, flavor: '{flavor}')...")
+        # El fallback a 'stream' se decide por página: solo páginas donde 'lattice' no produjo tablas
+        if flavor == 'lattice': flavor_pages = sorted(p for p, has_rulings in candidates.items() if has_rulings)
+        else: flavor_pages = sorted(p for p in candidates if p not in pages_with_tables)
+        if not flavor_pages:
+            logging.info(f"Sin páginas pendientes para '{flavor}' en {short_pdf_name}.")
+            continue
+        pages_arg = ",".join(str(p) for p in flavor_pages)
+        logging.info(f"Extrayendo tablas de {short_pdf_name} ({len(flavor_pages)} págs, flavor: '{flavor}')...")
         try:
-            camelot_kwargs = {'pages': pages, 'flavor': flavor}
-            if flavor == 'lattice': camelot_kwargs['line_scale'] = 40
-            elif flavor == 'stream': camelot_kwargs['edge_tol'] = 100; camelot_kwargs['row_tol'] = 5
+            camelot_kwargs = {'pages': pages_arg, 'flavor': flavor}
+            camelot_kwargs.update(CAMELOT_LATTICE_KWARGS if flavor == 'lattice' else CAMELOT_STREAM_KWARGS)
             tables = camelot.read_pdf(pdf_path, **camelot_kwargs)
             if tables.n > 0:
-                if flavor == 'lattice': tables_found_with_first_flavor = True
                 logging.info(f"Camelot ('{flavor}') encontró {tables.n} tabla(s) en {short_pdf_name}.")
                 for i, table_report in enumerate(tables):
                     try:
@@ -302,18 +686,20 @@ def extract_and_format_tables_from_pdf(pdf_path: str, pages: str = 'all') -> lis
                             metadata = {"source": short_pdf_name, "page": table_report.page, "is_table": True,
                                         "table_id": f"{short_pdf_name}_t{i+1}_p{table_report.page}_{flavor}",
                                         "extraction_method": f"camelot_{flavor}"}
-                            table_docs.append(Document(page_content=content, metadata=metadata))
+                            table_items.append((Document(page_content=content, metadata=metadata), cleaned_df))
+                            pages_with_tables.add(int(table_report.page))
                         else: logging.info(f"Tabla {i+1} (pág {table_report.page}) en {short_pdf_name} ('{flavor}') vacía tras limpiar; omitida.")
                     except Exception as e_table: logging.error(f"Error procesando tabla {i+1}, pág {table_report.page}, {short_pdf_name}: {e_table}")
-            elif flavor == 'lattice': logging.info(f"Camelot 'lattice' no encontró tablas en {short_pdf_name}. Intentando 'stream'.")
-            elif flavor == 'stream': logging.info(f"Camelot 'stream' tampoco encontró tablas en {short_pdf_name}.")
+            else: logging.info(f"Camelot '{flavor}' no encontró tablas en las páginas analizadas de {short_pdf_name}.")
         except Exception as e:
             logging.error(f"Error crítico con Camelot para {short_pdf_name} ('{flavor}'): {e}")
+            extraction_complete = False
             if "ghostscript" in str(e).lower(): logging.error("¡ERROR GHOSTSCRIPT DETECTADO! Asegúrate de que Ghostscript esté instalado y en el PATH del sistema."); break
     
     camelot_logger.setLevel(original_level) # Restaurar nivel de logging
-    if not table_docs and not tables_found_with_first_flavor: logging.info(f"No se extrajeron tablas de {short_pdf_name} con Camelot.")
-    return table_docs
+    current_span().set(source=short_pdf_name, candidate_pages=len(candidates), tables=len(table_items), complete=extraction_complete)
+    if not table_items: logging.info(f"No se extrajeron tablas de {short_pdf_name} con Camelot.")
+    return table_items, extraction_complete
 
 def normalize(text: str) -> str:
     text = text.lower(); return " ".join(text.split())
@@ -329,26 +715,965 @@ def preprocess_documents(docs: list[Document]) -> list[Document]:
         except Exception as e: logging.warning(f"Error procesando {doc.metadata.get('source','N/A')}, pág {doc.metadata.get('page','N/A')}: {e}")
     return processed_docs
 
-def chunk_documents(documents: list[Document], chunk_size: int = 1800, chunk_overlap: int = 200) -> list[Document]:
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=["\n\n", "\n", ". ", " ", ""], length_function=len)
-    logging.info(f"Dividiendo {len(documents)} docs en chunks (tamaño={chunk_size}, solapamiento={chunk_overlap})...")
-    return splitter.split_documents(documents)
+_TABLE_START, _TABLE_END = "[INICIO DE TABLA Markdown]", "[FIN DE TABLA Markdown]"
+
+def split_table_document(doc: Document, count_tokens: Callable[[str], int], chunk_size: int) -> list[Document]:
+    # La tabla se mantiene entera si cabe; si no, se parte por filas repitiendo contexto y cabecera en cada parte
+    content = doc.page_content
+    if count_tokens(content) <= chunk_size or _TABLE_START not in content or _TABLE_END not in content: return [doc]
+    prefix, rest = content.split(_TABLE_START, 1)
+    table_body, suffix = rest.split(_TABLE_END, 1)
+    lines = [l for l in table_body.strip("\n").split("\n") if l.strip()]
+    header, rows = lines[:2], lines[2:] # Cabecera Markdown + línea separadora '|---|'
+    if not rows: return [doc]
+    def _render(part_rows: list[str]) -> str:
+        return f"{prefix.rstrip()}\n\n{_TABLE_START}\n" + "\n".join(header + part_rows) + f"\n{_TABLE_END}{suffix.rstrip()}"
+    budget = chunk_size - count_tokens(_render([]))
+    parts, current, current_tokens = [], [], 0
+    for row in rows:
+        row_tokens = count_tokens(row) + 1
+        if current and current_tokens + row_tokens > budget:
+            parts.append(current); current, current_tokens = [], 0
+        current.append(row); current_tokens += row_tokens # Una fila que no cabe sola queda en su propia parte
+    if current: parts.append(current)
+    return [Document(page_content=_render(part), metadata={**doc.metadata, "table_part": k + 1, "table_parts": len(parts)}) for k, part in enumerate(parts)]
+
+@traced("chunk")
+def chunk_documents(documents: list[Document], chunk_size: int = CHUNK_SIZE_TOKENS, chunk_overlap: int = CHUNK_OVERLAP_TOKENS, count_tokens: Callable[[str], int] = None) -> list[Document]:
+    # Tamaños medidos en tokens del modelo de embeddings; las tablas no pasan por el splitter de texto.
+    # Los llamadores pasan embeddings.count_tokens; sin él se usa la estimación del LLM (solo aproximada para el modelo de embeddings).
+    count_tokens = count_tokens or count_llm_tokens
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=["\n\n", "\n", ". ", " ", ""], length_function=count_tokens)
+    logging.info(f"Dividiendo {len(documents)} docs en chunks (tamaño={chunk_size} tokens, solapamiento={chunk_overlap})...")
+    chunks = []
+    for doc in documents:
+        if doc.metadata.get("is_table", False): chunks.extend(split_table_document(doc, count_tokens, chunk_size))
+        else: chunks.extend(splitter.split_documents([doc]))
+    current_span().set(documents=len(documents), chunks=len(chunks))
+    return chunks
+
+_MINHASH_PRIME = (1 << 31) - 1
+_MINHASH_RNG = np.random.default_rng(20240601)
+_MINHASH_A = _MINHASH_RNG.integers(1, _MINHASH_PRIME, size=DEDUP_NUM_PERM, dtype=np.uint64)
+_MINHASH_B = _MINHASH_RNG.integers(0, _MINHASH_PRIME, size=DEDUP_NUM_PERM, dtype=np.uint64)
+
+def minhash_signature(text: str, shingle_size: int = DEDUP_SHINGLE_SIZE) -> np.ndarray:
+    words = text.split()
+    shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))}
+    x = np.fromiter((zlib.crc32(sh.encode("utf-8")) % _MINHASH_PRIME for sh in shingles), dtype=np.uint64, count=len(shingles))
+    # h(x) = (a*x + b) mod p, con a, x < 2^31 para que el producto no desborde uint64
+    return ((_MINHASH_A[:, None] * x[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+def _lsh_bands(num_perm: int, threshold: float) -> tuple[int, int]:
+    # (bandas, filas) cuyo umbral aproximado (1/b)^(1/r) queda más cerca del umbral pedido
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(options, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+def format_page_reference(metadata: dict) -> str:
+    return ", ".join(str(p) for p in metadata.get("pages") or [metadata.get("page")])
+
+def format_source_reference(metadata: dict) -> str:
+    # Chunks deduplicados entre PDFs: todas las fuentes con sus páginas
+    source_pages = metadata.get("source_pages")
+    if not source_pages or len(source_pages) < 2: return f"Fuente: {metadata.get('source')}, Página: {format_page_reference(metadata)}"
+    return "Fuentes: " + "; ".join(f"{source} (pág. {', '.join(str(p) for p in source_pages[source]) or 'N/A'})" for source in metadata["sources"])
+
+def normalize_for_dedup(text: str) -> str:
+    # La versión tabular (markdown) y el texto extraído de la misma página solo difieren en marcadores, pipes y filas
+    # separadoras: se eliminan antes de generar los shingles para que ambas versiones coincidan
+    text = text.replace(_TABLE_START, " ").replace(_TABLE_END, " ")
+    text = re.sub(r"^[\s|:-]*-[\s|:-]*$", " ", text, flags=re.MULTILINE)
+    return text.replace("|", " ")
+
+class ChunkDeduplicator:
+    # MinHash/LSH sobre todas las fuentes, con estado entre llamadas a filter(): en streaming (PDF a PDF) un chunk casi
+    # idéntico a uno ya emitido no se vuelve a emitir; su fuente y páginas se añaden a los metadatos del representante
+    # ('sources', 'source_pages', 'pages') y este queda pendiente en `updated` para reescribirlo en el docstore.
+    # Por chunk emitido se guardan su firma y la referencia a sus metadatos, no el texto.
+    def __init__(self, threshold: float = DEDUP_SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.bands, self.rows = _lsh_bands(DEDUP_NUM_PERM, threshold)
+        self.buckets, self.signatures, self.metadatas, self.updated = {}, [], [], {}
+
+    def _band_keys(self, sig: np.ndarray) -> list[tuple]:
+        return [(b, sig[b * self.rows:(b + 1) * self.rows].tobytes()) for b in range(self.bands)]
+
+    def _similar(self, a: np.ndarray, b: np.ndarray) -> bool:
+        return np.mean(a == b) >= self.threshold
+
+    @staticmethod
+    def _absorb(meta: dict, duplicates: list[dict]) -> None:
+        own_pages = lambda m: m.get("source_pages") or {m.get("source"): sorted({p for p in [m.get("page"), *(m.get("pages") or [])] if p is not None})}
+        source_pages = own_pages(meta)
+        for dup in duplicates:
+            for source, pages in own_pages(dup).items(): source_pages[source] = sorted(set(source_pages.get(source, [])) | set(pages))
+        meta["source_pages"] = source_pages
+        meta["sources"] = [meta.get("source")] + sorted((s for s in source_pages if s != meta.get("source")), key=str)
+        meta["pages"] = source_pages.get(meta.get("source"), [])
+        meta["duplicates_collapsed"] = meta.get("duplicates_collapsed", 0) + sum(1 + d.get("duplicates_collapsed", 0) for d in duplicates)
+
+    @traced("dedup")
+    def filter(self, chunks: list[Document]) -> list[Document]:
+        if not chunks: return []
+        # Firmas en uint32 (los valores son < 2^31): la mitad de memoria para el estado que se conserva entre lotes
+        signatures = [minhash_signature(normalize_for_dedup(d.page_content)).astype(np.uint32) for d in chunks]
+        parent = list(range(len(chunks)))
+        def _find(i: int) -> int:
+            while parent[i] != i: parent[i] = parent[parent[i]]; i = parent[i]
+            return i
+        local = {}
+        for i, sig in enumerate(signatures):
+            for key in self._band_keys(sig):
+                bucket = local.setdefault(key, [])
+                for j in bucket:
+                    ri, rj = _find(i), _find(j)
+                    if ri != rj and self._similar(sig, signatures[j]): parent[ri] = rj
+                bucket.append(i)
+
+        groups = {}
+        for i in range(len(chunks)): groups.setdefault(_find(i), []).append(i)
+        result = []
+        for members in sorted(groups.values(), key=lambda m: m[0]):
+            # Duplicado de un representante ya emitido (de este u otro PDF): se absorbe en sus metadatos
+            previous = next((r for i in members for key in self._band_keys(signatures[i]) for r in self.buckets.get(key, ())
+                             if self._similar(signatures[i], self.signatures[r])), None)
+            if previous is not None:
+                meta = self.metadatas[previous]
+                self._absorb(meta, [chunks[i].metadata for i in members])
+                self.updated[id(meta)] = meta; continue
+            # Representante: la versión tabular (formato más limpio) o, si no hay, la primera aparición
+            rep_idx = next((i for i in members if chunks[i].metadata.get("is_table")), members[0])
+            rep = chunks[rep_idx]
+            if len(members) > 1:
+                rep = Document(page_content=rep.page_content, metadata=dict(rep.metadata))
+                self._absorb(rep.metadata, [chunks[i].metadata for i in members if i != rep_idx])
+            for key in self._band_keys(signatures[rep_idx]): self.buckets.setdefault(key, []).append(len(self.signatures))
+            self.signatures.append(signatures[rep_idx]); self.metadatas.append(rep.metadata)
+            result.append(rep)
+        if len(result) < len(chunks): logging.info(f"Deduplicación: {len(chunks)} chunks -> {len(result)} ({len(chunks) - len(result)} casi duplicados colapsados).")
+        current_span().set(chunks_in=len(chunks), chunks_out=len(result))
+        return result
+
+    def pop_updated(self) -> list[dict]:
+        # Metadatos de representantes que absorbieron duplicados después de haber sido emitidos
+        updated = list(self.updated.values()); self.updated.clear()
+        return updated
+
+def deduplicate_chunks(chunks: list[Document], threshold: float = DEDUP_SIMILARITY_THRESHOLD) -> list[Document]:
+    # Colapsa chunks casi duplicados (también entre PDFs) en uno solo que conserva todas sus fuentes y páginas
+    return ChunkDeduplicator(threshold).filter(chunks)
+
+class EmbeddingCache:
+    # Vectores en un único archivo binario contiguo (leído con memmap) + archivo de claves: la línea i es el offset del vector i
+    # Acceso protegido por un lock: la caché se comparte entre las etapas que embeben en hilos
+    def __init__(self, cache_dir: str, namespace: str, dim: int, dtype: str = "float32", max_mb: float = EMBEDDING_CACHE_MAX_MB):
+        self.dir = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', namespace))
+        os.makedirs(self.dir, exist_ok=True)
+        self.dim, self.dtype = dim, np.dtype(dtype)
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self.max_rows = int(max_mb * 1024 * 1024) // self.row_bytes if max_mb else None
+        self.vectors_path = os.path.join(self.dir, f"vectors_{self.dtype.name}_{dim}.bin")
+        self.keys_path = os.path.join(self.dir, f"keys_{self.dtype.name}_{dim}.txt")
+        self.offsets, self.n_rows, self._matrix = {}, 0, None
+        self._lock = threading.Lock()
+        self._load_keys()
+
+    def _load_keys(self):
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "r", encoding="ascii") as f: keys = [line.strip() for line in f if line.strip()]
+        row_bytes = self.row_bytes
+        n_vectors = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        n = min(len(keys), n_vectors)
+        # Reparar una escritura interrumpida: claves y vectores deben quedar alineados
+        if n_vectors > n:
+            with open(self.vectors_path, "r+b") as f: f.truncate(n * row_bytes)
+        if len(keys) > n:
+            with open(self.keys_path, "w", encoding="ascii") as f: f.write("".join(k + "\n" for k in keys[:n]))
+        self.offsets = {k: i for i, k in enumerate(keys[:n])}
+        self.n_rows = n
+
+    def _vectors(self) -> np.ndarray:
+        if self._matrix is None and self.n_rows:
+            self._matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(self.n_rows, self.dim))
+        return self._matrix
+
+    def lookup(self, keys: list[str]) -> tuple[np.ndarray, list[int]]:
+        # Devuelve (matriz float32 con los aciertos rellenados, posiciones de las claves no encontradas)
+        out = np.zeros((len(keys), self.dim), dtype=np.float32)
+        with self._lock:
+            hit_pos = [i for i, k in enumerate(keys) if k in self.offsets]
+            if hit_pos: out[hit_pos] = self._vectors()[[self.offsets[keys[i]] for i in hit_pos]]
+        hits = set(hit_pos)
+        return out, [i for i in range(len(keys)) if i not in hits]
+
+    def add(self, keys: list[str], vectors: np.ndarray) -> None:
+        with self._lock:
+            new = {}
+            for k, v in zip(keys, vectors):
+                if k not in self.offsets: new.setdefault(k, v)
+            if not new: return
+            # Primero los vectores y luego las claves: una interrupción deja vectores huérfanos que _load_keys descarta
+            with open(self.vectors_path, "ab") as f: f.write(np.ascontiguousarray(np.stack(list(new.values())), dtype=self.dtype).tobytes())
+            with open(self.keys_path, "a", encoding="ascii") as f: f.write("".join(k + "\n" for k in new))
+            for i, k in enumerate(new): self.offsets[k] = self.n_rows + i
+            self.n_rows += len(new)
+            self._matrix = None
+            if self.max_rows and self.n_rows > self.max_rows: self._compact(max(1, int(self.max_rows * 0.8)))
+
+    def _compact(self, keep_rows: int) -> None:
+        # FIFO: conserva las `keep_rows` filas más recientes. Se borra el archivo de claves antes de sustituir los vectores:
+        # una interrupción a mitad deja la caché vacía (_load_keys trunca los vectores sin claves), nunca desalineada
+        keep_keys = sorted(self.offsets, key=self.offsets.get)[-keep_rows:]
+        data = np.array(self._vectors()[[self.offsets[k] for k in keep_keys]])
+        self._matrix = None
+        with open(self.vectors_path + ".tmp", "wb") as f: f.write(data.tobytes())
+        with open(self.keys_path + ".tmp", "w", encoding="ascii") as f: f.write("".join(k + "\n" for k in keep_keys))
+        os.remove(self.keys_path)
+        os.replace(self.vectors_path + ".tmp", self.vectors_path)
+        os.replace(self.keys_path + ".tmp", self.keys_path)
+        logging.info(f"Caché de embeddings compactada: {self.n_rows} -> {len(keep_keys)} vectores (límite {self.max_rows}).")
+        self.offsets = {k: i for i, k in enumerate(keep_keys)}
+        self.n_rows = len(keep_keys)
 
 class LocalEmbeddings(Embeddings):
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
-        try: self.model = SentenceTransformer(model_name); logging.info(f"Embeddings '{model_name}' cargado.")
-        except Exception as e: logging.error(f"Error cargando SentenceTransformer '{model_name}': {e}"); raise
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", cache_dir: str = EMBEDDING_CACHE_DIR, cache_dtype: str = EMBEDDING_CACHE_DTYPE,
+                 backend: str = EMBEDDING_BACKEND, batch_size: int = EMBEDDING_BATCH_SIZE, num_processes: int = EMBEDDING_NUM_PROCESSES):
+        try:
+            if backend == "torch": self.model = SentenceTransformer(model_name)
+            elif backend == "onnx_int8": self.model = SentenceTransformer(model_name, backend="onnx", model_kwargs={"file_name": EMBEDDING_ONNX_FILE})
+            else: raise ValueError(f"Backend de embeddings no soportado: {backend}.")
+            logging.info(f"Embeddings '{model_name}' cargado (backend={backend}, batch={batch_size}, procesos={num_processes}).")
+        except Exception as e: logging.error(f"Error cargando SentenceTransformer '{model_name}' (backend={backend}): {e}"); raise
+        self.model_name, self.backend = model_name, backend
+        self.batch_size, self.num_processes = batch_size, num_processes
+        self._pool = None
+        # Los vectores cuantizados no son intercambiables con los fp32: cada backend tiene su propio espacio de caché
+        self.cache_namespace = model_name if backend == "torch" else f"{model_name}__{backend}"
+        self.cache = EmbeddingCache(cache_dir, self.cache_namespace, self.model.get_sentence_embedding_dimension(), cache_dtype) if cache_dir else None
+        if CHUNK_SIZE_TOKENS + 2 > (self.model.max_seq_length or CHUNK_SIZE_TOKENS + 2):
+            logging.warning(f"CHUNK_SIZE_TOKENS={CHUNK_SIZE_TOKENS} (+[CLS]/[SEP]) supera max_seq_length={self.model.max_seq_length} de '{model_name}': el final de cada chunk no se embeberá.")
+    def count_tokens(self, text: str) -> int:
+        return len(self.model.tokenizer(text, add_special_tokens=False, truncation=False)["input_ids"])
+    def close(self):
+        if self._pool is not None:
+            self.model.stop_multi_process_pool(self._pool); self._pool = None
+    @staticmethod
+    def _prepare_text(text: str) -> str:
+        # El tokenizador ignora diferencias de espacios en blanco: normalizarlos no cambia el vector y mejora la tasa de aciertos
+        return " ".join(text.split())
+    def _cache_key(self, prepared_text: str) -> str:
+        return hashlib.sha1(f"{self.cache_namespace}\x00{prepared_text}".encode("utf-8")).hexdigest()
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        if self.num_processes > 1 and len(texts) >= EMBEDDING_MULTIPROCESS_MIN_TEXTS:
+            if self._pool is None:
+                self._pool = self.model.start_multi_process_pool(target_devices=["cpu"] * self.num_processes)
+                atexit.register(self.close)
+            return np.asarray(self.model.encode_multi_process(texts, self._pool, batch_size=self.batch_size), dtype=np.float32)
+        return np.asarray(self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True), dtype=np.float32)
+    @traced("embed")
+    def embed_array(self, texts: list[str], cache: bool = False) -> np.ndarray:
+        # Ruta interna: matriz float32 (n, dim) que FAISS consume directamente. Solo los chunks del índice (cache=True) pasan por
+        # la caché; queries, unidades de compresión y textos de validación son efímeros y no deben desplazar vectores útiles
+        prepared = [self._prepare_text(t) for t in texts]
+        current_span().set(texts=len(texts), model=self.model_name, backend=self.backend, cached=bool(cache and self.cache))
+        if not (cache and self.cache): return self._encode(prepared)
+        keys = [self._cache_key(t) for t in prepared]
+        vectors, missing = self.cache.lookup(keys)
+        if missing:
+            pending = {}
+            for i in missing: pending.setdefault(keys[i], prepared[i])
+            encoded = self._encode(list(pending.values()))
+            self.cache.add(list(pending.keys()), encoded)
+            row_of_key = {k: j for j, k in enumerate(pending)}
+            vectors[missing] = encoded[[row_of_key[keys[i]] for i in missing]]
+        logging.info(f"Embeddings: {len(texts) - len(missing)} de caché, {len(missing)} calculados ({self.model_name}).")
+        current_span().set(cache_hits=len(texts) - len(missing), computed=len(missing))
+        return vectors
+    def embed_chunks(self, texts: list[str]) -> np.ndarray:
+        return self.embed_array(texts, cache=True)
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
-        return self.model.encode([t.replace("\n", " ") for t in texts], convert_to_numpy=True).tolist()
+        # Contrato de LangChain: listas de floats. Internamente se usa embed_array/embed_chunks para evitar la conversión
+        return self.embed_array(texts).tolist()
     def embed_query(self, text: str) -> list[float]:
-        encoded = self.model.encode(text.replace("\n", " "), convert_to_numpy=True)
-        return encoded.flatten().tolist()
+        return self.embed_array([text])[0].tolist()
+
+def embed_texts(embeddings: Embeddings, texts: list[str], cache: bool = False) -> np.ndarray:
+    # Matriz float32 contigua para FAISS desde cualquier Embeddings; con LocalEmbeddings evita el paso por listas
+    if isinstance(embeddings, LocalEmbeddings): vectors = embeddings.embed_array(texts, cache=cache)
+    else: vectors = embeddings.embed_documents(texts)
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+def check_embedding_parity(texts: list[str], candidate: LocalEmbeddings, reference_model_name: str = None) -> dict:
+    # Deriva coseno entre el backend del `candidate` (ej. ONNX int8) y el modelo fp32 de referencia, sin pasar por la caché
+    reference = SentenceTransformer(reference_model_name or candidate.model_name)
+    prepared = [LocalEmbeddings._prepare_text(t) for t in texts if t and t.strip()]
+    if not prepared: return {}
+    ref_vecs = np.asarray(reference.encode(prepared, batch_size=candidate.batch_size, convert_to_numpy=True), dtype=np.float32)
+    cand_vecs = candidate._encode(prepared)
+    cos = np.sum(ref_vecs * cand_vecs, axis=1) / (np.linalg.norm(ref_vecs, axis=1) * np.linalg.norm(cand_vecs, axis=1) + 1e-12)
+    report = {"n": len(prepared), "backend": candidate.backend, "cos_mean": float(cos.mean()), "cos_min": float(cos.min()),
+              "cos_p05": float(np.percentile(cos, 5)), "max_drift": float(1.0 - cos.min())}
+    logging.info(f"Paridad de embeddings ({candidate.backend} vs fp32, n={report['n']}): coseno medio={report['cos_mean']:.4f}, p05={report['cos_p05']:.4f}, mínimo={report['cos_min']:.4f}.")
+    return report
+
+# --- CACHÉ DE EXTRACCIÓN POR PDF (clave: hash del PDF + configuración del extractor) ---
+def extraction_settings_fingerprint() -> str:
+    settings = {"version": EXTRACTION_CACHE_VERSION, "prescreen": CAMELOT_PRESCREEN_PAGES,
+                "min_ruling_ops": PRESCREEN_MIN_RULING_OPS, "min_numeric_lines": PRESCREEN_MIN_NUMERIC_LINES,
+                "lattice": CAMELOT_LATTICE_KWARGS, "stream": CAMELOT_STREAM_KWARGS}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def extraction_cache_path(pdf_hash: str) -> str:
+    return os.path.join(EXTRACTION_CACHE_DIR, f"{pdf_hash[:32]}_{extraction_settings_fingerprint()}.jsonl.gz")
+
+def save_extraction_cache(pdf_hash: str, page_docs: list[Document], table_items: list[tuple[Document, pd.DataFrame]]) -> None:
+    os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+    cache_path = extraction_cache_path(pdf_hash)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for doc in page_docs:
+            f.write(json.dumps({"type": "page", "page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False) + "\n")
+        for doc, df in table_items:
+            record = {"type": "table", "page_content": doc.page_content, "metadata": doc.metadata,
+                      "columns": [str(c) for c in df.columns], "data": df.astype(str).values.tolist()}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, cache_path)
+
+def iter_extraction_cache(pdf_hash: str):
+    # Generador de registros de la caché (páginas y tablas) sin cargar el archivo completo en memoria
+    with gzip.open(extraction_cache_path(pdf_hash), "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip(): yield json.loads(line)
+
+def load_extraction_cache(fname: str, pdf_hash: str) -> list[Document] | None:
+    if not EXTRACTION_CACHE_DIR or not pdf_hash or not os.path.exists(extraction_cache_path(pdf_hash)): return None
+    try:
+        docs = []
+        for record in iter_extraction_cache(pdf_hash):
+            if record["metadata"].get("source") != fname: return None # Mismo contenido bajo otro nombre: re-extraer
+            docs.append(Document(page_content=record["page_content"], metadata=record["metadata"]))
+        return docs
+    except Exception as e:
+        logging.warning(f"Caché de extracción corrupta para {fname} ({e}). Se re-extraerá."); return None
+
+@traced("extract_pdf")
+def load_pdf_documents(fname: str, pdf_hash: str = None, folder: str = None) -> list[Document]:
+    full_path = os.path.join(folder or FOLDER_INPUT_PDFS, fname)
+    docs = []
+    logging.info(f"\n--- Procesando para índice: {fname} ---")
+    if EXTRACTION_CACHE_DIR:
+        try:
+            pdf_hash = pdf_hash or compute_file_hash(full_path)
+            cached_docs = load_extraction_cache(fname, pdf_hash)
+            if cached_docs is not None:
+                logging.info(f"Extracción de {fname} recuperada de caché ({len(cached_docs)} docs).")
+                current_span().set(source=fname, cache_hit=True, documents=len(cached_docs))
+                return cached_docs
+        except OSError as e: logging.warning(f"No se pudo consultar la caché de extracción para {fname}: {e}")
+    try:
+        loader = PyPDFLoader(full_path)
+        pages = loader.load()
+        current_page_docs = [Document(page_content=p.page_content, metadata={"source": fname, "page": p.metadata.get("page", i) + 1, "is_table": False}) for i, p in enumerate(pages)]
+        docs.extend(current_page_docs)
+        logging.info(f"Texto cargado de {fname} ({len(current_page_docs)} págs).")
+
+        table_items, tables_complete = extract_tables_from_pdf(full_path, pages="all")
+        docs.extend(doc for doc, _ in table_items)
+        logging.info(f"{len(table_items)} tablas procesadas de {fname}.")
+
+        if EXTRACTION_CACHE_DIR and pdf_hash and tables_complete:
+            try: save_extraction_cache(pdf_hash, current_page_docs, table_items)
+            except Exception as e_cache: logging.warning(f"No se pudo guardar la caché de extracción de {fname}: {e_cache}")
+    except Exception as e: logging.error(f"Error procesando PDF {full_path}: {e}", exc_info=True)
+    current_span().set(source=fname, cache_hit=False, documents=len(docs))
+    return docs
+
+# Configuración de extracción que los procesos de ingestión (spawn: reimportan main) reciben del proceso principal
+_INGESTION_WORKER_SETTINGS = ("EXTRACTION_CACHE_DIR", "CAMELOT_PRESCREEN_PAGES", "PRESCREEN_MIN_RULING_OPS", "PRESCREEN_MIN_NUMERIC_LINES", "CAMELOT_LATTICE_KWARGS", "CAMELOT_STREAM_KWARGS")
+
+def _init_ingestion_worker(settings: dict) -> None:
+    globals().update(settings)
+
+def _new_ingestion_pool(max_workers: int) -> ProcessPoolExecutor:
+    # "spawn" y no fork: el proceso principal ya tiene cargado torch (multihilo) y un fork puede quedar bloqueado
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_ingestion_worker,
+                               initargs=({name: globals()[name] for name in _INGESTION_WORKER_SETTINGS},))
+
+def iter_pdfs_documents(fnames: list[str], max_workers: int = INGESTION_MAX_WORKERS, pdf_hashes: dict = None, max_in_flight: int = None, folder: str = None) -> Iterator[tuple[str, list[Document]]]:
+    # Genera (pdf, docs) en el mismo orden que `fnames`, sin importar el orden en que terminen los procesos.
+    # Como mucho `max_in_flight` PDFs se extraen por adelantado (None = todos, enviando primero los más grandes).
+    pdf_hashes, folder = pdf_hashes or {}, folder or FOLDER_INPUT_PDFS
+    if max_workers <= 1 or len(fnames) <= 1:
+        for fname in fnames: yield fname, load_pdf_documents(fname, pdf_hashes.get(fname), folder)
+        return
+    max_in_flight = len(fnames) if max_in_flight is None else max(max_in_flight, 1)
+    n_workers = min(max_workers, len(fnames))
+    logging.info(f"Ingestión paralela de {len(fnames)} PDFs con {n_workers} procesos...")
+    pool = _new_ingestion_pool(n_workers)
+    submit = lambda fname: pool.submit(load_pdf_documents, fname, pdf_hashes.get(fname), folder)
+    try:
+        if max_in_flight >= len(fnames):
+            # Los PDFs más grandes se envían primero para equilibrar la carga entre procesos
+            orden_envio = sorted(fnames, key=lambda f: os.path.getsize(os.path.join(folder, f)) if os.path.exists(os.path.join(folder, f)) else 0, reverse=True)
+            futures = {fname: submit(fname) for fname in orden_envio}
+            pending = deque((fname, futures[fname]) for fname in fnames)
+            remaining = iter(())
+        else:
+            remaining = iter(fnames)
+            pending = deque((fname, submit(fname)) for fname in islice(remaining, max_in_flight))
+        while pending:
+            fname, future = pending.popleft()
+            try: docs = future.result()
+            except BrokenProcessPool:
+                # Un proceso murió (segfault, memoria...) y el pool queda inservible: se recrea, se reenvían los PDFs
+                # pendientes y este se reintenta aislado, de modo que solo se pierde el PDF que provoca el fallo
+                logging.error(f"El pool de ingestión se rompió mientras se procesaba {fname}. Se recrea y se reintenta el PDF aislado.")
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = _new_ingestion_pool(n_workers)
+                pending = deque((f, submit(f)) for f, _ in pending)
+                docs = _load_pdf_documents_isolated(fname, pdf_hashes.get(fname), folder)
+            except Exception as e:
+                logging.error(f"Error en el proceso de ingestión de {fname}: {e}", exc_info=True)
+                docs = []
+            next_fname = next(remaining, None)
+            if next_fname is not None: pending.append((next_fname, submit(next_fname)))
+            yield fname, docs
+    finally: pool.shutdown(wait=True, cancel_futures=True)
+
+def _load_pdf_documents_isolated(fname: str, pdf_hash: str, folder: str) -> list[Document]:
+    pool = _new_ingestion_pool(1)
+    try: return pool.submit(load_pdf_documents, fname, pdf_hash, folder).result()
+    except BrokenProcessPool: logging.error(f"{fname} vuelve a terminar el proceso de extracción. Se omite."); return []
+    except Exception as e: logging.error(f"Error en el proceso de ingestión de {fname}: {e}", exc_info=True); return []
+    finally: pool.shutdown(wait=True)
+
+def load_pdfs_documents(fnames: list[str], max_workers: int = INGESTION_MAX_WORKERS, pdf_hashes: dict = None) -> dict[str, list[Document]]:
+    return dict(iter_pdfs_documents(fnames, max_workers=max_workers, pdf_hashes=pdf_hashes))
+
+def iter_index_chunks(fnames: list[str], embeddings: LocalEmbeddings, pdf_hashes: dict = None, chunk_size: int = CHUNK_SIZE_TOKENS, chunk_overlap: int = CHUNK_OVERLAP_TOKENS,
+                      deduplicator: ChunkDeduplicator = None) -> Iterator[Document]:
+    # Carga -> normalización -> chunking PDF a PDF; solo los PDFs en vuelo están en memoria. El `deduplicator` se comparte
+    # con quien consume el flujo, que debe aplicar al final sus pop_updated() (apply_chunk_merges)
+    for fname, docs in iter_pdfs_documents(fnames, pdf_hashes=pdf_hashes, max_in_flight=INGESTION_MAX_PDFS_IN_FLIGHT):
+        if not docs: continue
+        chunks = chunk_documents(preprocess_documents(docs), chunk_size=chunk_size, chunk_overlap=chunk_overlap, count_tokens=embeddings.count_tokens)
+        yield from deduplicator.filter(chunks) if deduplicator is not None else chunks
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)): yield batch
+
+def compute_file_hash(path: str, block_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""): sha.update(block)
+    return sha.hexdigest()
+
+# --- MANIFIESTO DE PDFs INDEXADOS (hash de contenido -> IDs de chunks en FAISS) ---
+def load_faiss_manifest(persist_path: str) -> dict:
+    manifest_path = os.path.join(resolve_faiss_index_dir(persist_path), FAISS_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path): return {}
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f: return json.load(f).get("pdfs", {})
+    except Exception as e:
+        logging.warning(f"Manifiesto de índice ilegible en {manifest_path} ({e}). Se ignorará."); return {}
+
+def save_faiss_manifest(persist_path: str, manifest: dict) -> None:
+    manifest_path = os.path.join(persist_path, FAISS_MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f: json.dump({"version": 1, "pdfs": manifest}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def assign_chunk_ids(chunked_docs: list[Document], pdf_hashes: dict, counters: dict = None) -> list[str]:
+    # IDs deterministas por PDF: permiten borrar del índice todos los vectores de un PDF concreto.
+    # `counters` se comparte entre lotes cuando los chunks llegan en streaming.
+    counters = {} if counters is None else counters
+    ids = []
+    for doc in chunked_docs:
+        source = doc.metadata.get("source", "N/A")
+        n = counters.get(source, 0); counters[source] = n + 1
+        chunk_id = f"{source}:{pdf_hashes.get(source, 'sin_hash')[:16]}:{n}"
+        doc.metadata["chunk_id"] = chunk_id
+        ids.append(chunk_id)
+    return ids
+
+def build_manifest_entries(chunked_docs: list[Document], ids: list[str], pdf_hashes: dict, entries: dict = None) -> dict:
+    # Un chunk deduplicado entre PDFs figura en el manifiesto de cada fuente que lo contiene
+    entries = {} if entries is None else entries
+    for doc, chunk_id in zip(chunked_docs, ids):
+        for source in doc.metadata.get("sources") or [doc.metadata.get("source", "N/A")]:
+            entry = entries.setdefault(source, {"sha256": pdf_hashes.get(source), "ids": []})
+            entry["ids"].append(chunk_id)
+    return entries
+
+def apply_chunk_merges(docstore: Docstore, metadatas: list[dict], manifest: dict, pdf_hashes: dict) -> None:
+    # Representantes ya escritos que absorbieron duplicados de PDFs posteriores: se reescriben sus metadatos en el
+    # docstore y el chunk pasa a figurar también en el manifiesto de las fuentes nuevas
+    merged = {m["chunk_id"]: m for m in metadatas if m.get("chunk_id")}
+    if not merged: return
+    docstore.update_metadata(merged)
+    for chunk_id, meta in merged.items():
+        for source in meta.get("sources", []):
+            entry = manifest.setdefault(source, {"sha256": pdf_hashes.get(source), "ids": []})
+            if chunk_id not in entry["ids"]: entry["ids"].append(chunk_id)
+    logging.info(f"Deduplicación entre PDFs: {len(merged)} chunks ya indexados comparten ahora varias fuentes.")
+
+def diff_pdf_manifest(manifest: dict, pdf_hashes: dict, unreadable: Iterable[str] = ()) -> tuple[list[str], list[str]]:
+    # (PDFs a (re)indexar, PDFs cuyos vectores deben eliminarse). Un PDF modificado aparece en ambas listas.
+    # Los PDFs presentes pero cuyo hash no se pudo calcular (`unreadable`) conservan sus vectores: no se tratan como retirados.
+    unreadable = set(unreadable)
+    to_index = [f for f, h in pdf_hashes.items() if manifest.get(f, {}).get("sha256") != h]
+    to_remove = [f for f, entry in manifest.items() if f not in unreadable and pdf_hashes.get(f) != entry.get("sha256")]
+    # Chunks deduplicados entre PDFs: al retirar uno de sus PDFs se retira el chunk, así que los PDFs sin cambios que lo
+    # compartían se reindexan también (hasta que no quede ninguno afectado)
+    removed_ids = {cid for f in to_remove for cid in manifest[f].get("ids", [])}
+    while removed_ids:
+        shared = [f for f, entry in manifest.items() if f in pdf_hashes and f not in to_remove and not removed_ids.isdisjoint(entry.get("ids", []))]
+        to_index.extend(shared); to_remove.extend(shared)
+        removed_ids = {cid for f in shared for cid in manifest[f].get("ids", [])}
+    return to_index, to_remove
+
+def faiss_index_supports_removal(index) -> bool:
+    # Solo IndexFlat compacta las posiciones al hacer remove_ids, igual que FAISS.delete renumera index_to_docstore_id.
+    # IVF conserva los ids originales (el mapeo queda desalineado) y HNSW no implementa remove_ids.
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+@traced("faiss_update")
+def update_faiss_index_incremental(embeddings: Embeddings, documents: Iterable[Document], persist_path: str, pdf_hashes: dict, pdfs_to_remove: list[str],
+                                   deduplicator: ChunkDeduplicator = None) -> FAISS:
+    # La versión nueva se escribe en un staging vacío y solo se publica si la validación pasa. El índice y el mapeo se
+    # reescriben (un IndexFlat no admite modificarse en el archivo), pero el docstore SQLite no se copia: se comparte con
+    # la versión activa y solo recibe las filas nuevas. Los IDs llevan el hash del PDF, así que las versiones anteriores
+    # nunca ven las filas añadidas; las filas retiradas se borran en prune_faiss_versions cuando ninguna versión las usa.
+    staging_dir = create_faiss_staging_dir(persist_path)
+    vectorstore = None
+    try:
+        vectorstore = load_faiss_vectorstore(persist_path, embeddings, mmap=False) # Se modificará: carga completa del índice
+        manifest = load_faiss_manifest(persist_path)
+        existing_ids = set(vectorstore.index_to_docstore_id.values())
+        ids_to_delete = []
+        for f in pdfs_to_remove:
+            ids_pdf = manifest.get(f, {}).get("ids", [])
+            if not ids_pdf and isinstance(vectorstore.docstore, SQLiteDocstore): ids_pdf = vectorstore.docstore.ids_for_source(f)
+            ids_to_delete.extend(cid for cid in ids_pdf if cid in existing_ids)
+        if ids_to_delete and not faiss_index_supports_removal(vectorstore.index):
+            raise ValueError(f"El índice '{type(faiss.downcast_index(vectorstore.index)).__name__}' no admite eliminar vectores de forma incremental.")
+        if ids_to_delete:
+            # Como FAISS.delete, pero sin borrar las filas del docstore compartido (la versión activa aún las usa)
+            to_delete = set(ids_to_delete)
+            positions = [pos for pos, doc_id in vectorstore.index_to_docstore_id.items() if doc_id in to_delete]
+            vectorstore.index.remove_ids(np.asarray(positions, dtype=np.int64))
+            remaining = [doc_id for _, doc_id in sorted(vectorstore.index_to_docstore_id.items()) if doc_id not in to_delete]
+            vectorstore.index_to_docstore_id = dict(enumerate(remaining))
+            logging.info(f"Eliminados {len(ids_to_delete)} vectores de PDFs retirados/modificados: {', '.join(pdfs_to_remove)}")
+        for f in pdfs_to_remove: manifest.pop(f, None)
+
+        counters, new_entries, n_added = {}, {}, 0
+        for batch in iter_batches(documents, INGESTION_BATCH_SIZE):
+            ids = assign_chunk_ids(batch, pdf_hashes, counters)
+            vectors = embed_texts(embeddings, [d.page_content for d in batch], cache=True)
+            start = vectorstore.index.ntotal
+            vectorstore.index.add(vectors)
+            for j, doc_id in enumerate(ids): vectorstore.index_to_docstore_id[start + j] = doc_id
+            vectorstore.docstore.add(dict(zip(ids, batch)), replace=True) # Un PDF re-añadido puede conservar filas aún no recolectadas
+            build_manifest_entries(batch, ids, pdf_hashes, new_entries)
+            n_added += len(ids)
+        manifest.update(new_entries)
+        if deduplicator is not None: apply_chunk_merges(vectorstore.docstore, deduplicator.pop_updated(), manifest, pdf_hashes)
+        if n_added: logging.info(f"Añadidos {n_added} vectores nuevos al índice FAISS.")
+
+        validate_faiss_vectorstore(vectorstore)
+        save_faiss_vectorstore(vectorstore, staging_dir)
+        save_faiss_manifest(staging_dir, manifest)
+        with open(os.path.join(staging_dir, FAISS_DOCSTORE_REF_FILENAME), "w", encoding="utf-8") as f:
+            f.write(os.path.relpath(vectorstore.docstore.db_path, staging_dir)) # El staging se renombra al mismo nivel: la ruta sigue siendo válida
+        vectorstore.docstore.close()
+        publish_faiss_version(persist_path, staging_dir)
+    except Exception:
+        if vectorstore is not None and isinstance(vectorstore.docstore, SQLiteDocstore): vectorstore.docstore.close()
+        discard_faiss_staging(staging_dir)
+        raise
+    vectorstore = load_faiss_vectorstore(persist_path, embeddings)
+    logging.info(f"Índice FAISS actualizado incrementalmente en {persist_path} ({vectorstore.index.ntotal} vectores).")
+    current_span().set(vectors_removed=len(ids_to_delete), vectors_added=n_added, vectors=vectorstore.index.ntotal)
+    return vectorstore
+
+# --- DOCSTORE EN SQLITE (reemplaza el pickle en memoria del wrapper FAISS de LangChain) ---
+class SQLiteDocstore(Docstore, AddableMixin):
+    # page_content y metadatos se leen solo para los IDs que devuelve una búsqueda
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, source TEXT, page_content TEXT NOT NULL, metadata TEXT NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks(source)")
+            # Fuentes adicionales de los chunks deduplicados entre PDFs (la principal está en chunks.source)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS chunk_sources (id TEXT NOT NULL, source TEXT NOT NULL, PRIMARY KEY (id, source))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunk_sources_source ON chunk_sources(source)")
+
+    @staticmethod
+    def _extra_sources(doc_id: str, metadata: dict) -> list[tuple[str, str]]:
+        return [(doc_id, s) for s in metadata.get("sources") or [] if s != metadata.get("source")]
+
+    def add(self, texts: dict[str, Document], replace: bool = False) -> None:
+        rows = [(doc_id, doc.metadata.get("source"), doc.page_content, json.dumps(doc.metadata, ensure_ascii=False, default=str)) for doc_id, doc in texts.items()]
+        try:
+            with self._conn:
+                self._conn.executemany(f"INSERT {'OR REPLACE ' if replace else ''}INTO chunks (id, source, page_content, metadata) VALUES (?, ?, ?, ?)", rows)
+                self._conn.executemany("INSERT OR IGNORE INTO chunk_sources VALUES (?, ?)", [r for doc_id, doc in texts.items() for r in self._extra_sources(doc_id, doc.metadata)])
+        except sqlite3.IntegrityError as e: raise ValueError(f"Intentando añadir IDs ya existentes en el docstore: {e}")
+
+    def update_metadata(self, metadatas: dict[str, dict]) -> None:
+        with self._conn:
+            self._conn.executemany("UPDATE chunks SET metadata = ? WHERE id = ?", [(json.dumps(m, ensure_ascii=False, default=str), doc_id) for doc_id, m in metadatas.items()])
+            self._conn.executemany("INSERT OR IGNORE INTO chunk_sources VALUES (?, ?)", [r for doc_id, m in metadatas.items() for r in self._extra_sources(doc_id, m)])
+
+    def search(self, search: str) -> Document | str:
+        row = self._conn.execute("SELECT page_content, metadata FROM chunks WHERE id = ?", (search,)).fetchone()
+        if row is None: return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def delete(self, ids: list) -> None:
+        with self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE id = ?", [(i,) for i in ids])
+            self._conn.executemany("DELETE FROM chunk_sources WHERE id = ?", [(i,) for i in ids])
+
+    def ids_for_source(self, source: str) -> list[str]:
+        return [r[0] for r in self._conn.execute("SELECT id FROM chunks WHERE source = ? UNION SELECT id FROM chunk_sources WHERE source = ?", (source, source))]
+
+    def ids_by_source(self) -> dict[str, list[str]]:
+        result = {}
+        for doc_id, source in self._conn.execute("SELECT id, source FROM chunks UNION ALL SELECT c.id, c.source FROM chunk_sources c JOIN chunks USING (id)"):
+            result.setdefault(source, []).append(doc_id)
+        return result
+
+    def delete_source(self, source: str) -> list[str]:
+        ids = self.ids_for_source(source)
+        self.delete(ids)
+        return ids
+
+    def count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def retain_only(self, ids: Iterable[str]) -> int:
+        # Borra las filas cuyo ID no está en `ids` (recolección del docstore compartido por varias versiones)
+        with self._conn:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS retain_ids (id TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM retain_ids")
+            self._conn.executemany("INSERT OR IGNORE INTO retain_ids VALUES (?)", ((i,) for i in ids))
+            n = self._conn.execute("DELETE FROM chunks WHERE id NOT IN (SELECT id FROM retain_ids)").rowcount
+            self._conn.execute("DELETE FROM chunk_sources WHERE id NOT IN (SELECT id FROM retain_ids)")
+            self._conn.execute("DELETE FROM retain_ids")
+        return n
+
+    def close(self) -> None:
+        self._conn.close()
+
+def save_faiss_vectorstore(vectorstore: FAISS, persist_path: str) -> None:
+    # El docstore SQLite ya persiste en persist_path; aquí se guardan el índice y el mapeo id FAISS -> id de chunk
+    faiss.write_index(vectorstore.index, os.path.join(persist_path, "index.faiss"))
+    mapping_path = os.path.join(persist_path, "index_to_docstore_id.json")
+    with open(mapping_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({str(k): v for k, v in vectorstore.index_to_docstore_id.items()}, f, ensure_ascii=False)
+    os.replace(mapping_path + ".tmp", mapping_path)
+
+# --- VERSIONES DEL ÍNDICE: construcción en staging, validación y publicación atómica ---
+# Estructura: persist_path/CURRENT (nombre de la versión activa) y persist_path/versions/<versión>/
+def resolve_faiss_index_dir(persist_path: str) -> str:
+    # Directorio de la versión activa; índices sin versionado (anteriores) se leen directamente de persist_path
+    current_file = os.path.join(persist_path, "CURRENT")
+    if os.path.exists(current_file):
+        with open(current_file, "r", encoding="utf-8") as f: version = f.read().strip()
+        version_dir = os.path.join(persist_path, "versions", version)
+        if version and os.path.isdir(version_dir): return version_dir
+        logging.warning(f"CURRENT de {persist_path} apunta a una versión inexistente ('{version}').")
+    return persist_path
+
+def list_faiss_index_versions(persist_path: str) -> list[str]:
+    versions_dir = os.path.join(persist_path, "versions")
+    if not os.path.isdir(versions_dir): return []
+    # Solo versiones completas: un directorio que ya solo guarda un docstore compartido no es restaurable
+    return sorted(v for v in os.listdir(versions_dir) if not v.endswith(".staging") and os.path.exists(os.path.join(versions_dir, v, "index.faiss")))
+
+def create_faiss_staging_dir(persist_path: str) -> str:
+    staging_dir = os.path.join(persist_path, "versions", f"v{time.strftime('%Y%m%d_%H%M%S')}_{time.time_ns() // 1000 % 1000000:06d}.staging")
+    os.makedirs(staging_dir)
+    return staging_dir
+
+def faiss_docstore_path(version_dir: str) -> str:
+    # Docstore propio de la versión o, en versiones incrementales, el de la versión anterior que comparten
+    ref_path = os.path.join(version_dir, FAISS_DOCSTORE_REF_FILENAME)
+    if not os.path.exists(ref_path): return os.path.join(version_dir, FAISS_DOCSTORE_FILENAME)
+    with open(ref_path, "r", encoding="utf-8") as f: return os.path.normpath(os.path.join(version_dir, f.read().strip()))
+
+def load_faiss_index_file(version_dir: str, mmap: bool = FAISS_MMAP_LOAD):
+    # Con mmap el índice se mapea en memoria en vez de leerse completo (arranque inmediato); queda de solo lectura.
+    # IO_FLAG_MMAP mapea las listas invertidas (IVF); IO_FLAG_MMAP_IFC los códigos de índices planos/HNSW. No se pueden combinar.
+    index_file = os.path.join(version_dir, "index.faiss")
+    if mmap:
+        flag_sets = [faiss.IO_FLAG_MMAP, getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)]
+        if "IVF" not in FAISS_INDEX_FACTORY.upper(): flag_sets.reverse()
+        for flags in flag_sets:
+            try: return faiss.read_index(index_file, flags | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e: logging.info(f"Carga mmap con flags={flags} no soportada para este índice ({str(e).splitlines()[0][-120:]}).")
+    return faiss.read_index(index_file)
+
+def validate_faiss_vectorstore(vectorstore: FAISS) -> None:
+    ntotal = vectorstore.index.ntotal
+    if ntotal <= 0: raise ValueError("El índice no contiene vectores.")
+    if len(vectorstore.index_to_docstore_id) != ntotal:
+        raise ValueError(f"Mapeo inconsistente: {len(vectorstore.index_to_docstore_id)} IDs para {ntotal} vectores.")
+    n_docs = vectorstore.docstore.count() if isinstance(vectorstore.docstore, SQLiteDocstore) else len(vectorstore.docstore._dict)
+    if n_docs < ntotal: raise ValueError(f"Docstore inconsistente: {n_docs} documentos para {ntotal} vectores.") # Compartido: puede conservar filas de versiones anteriores
+    sample_ids = [vectorstore.index_to_docstore_id[i] for i in np.linspace(0, ntotal - 1, num=min(20, ntotal), dtype=int)]
+    sample_docs = [vectorstore.docstore.search(doc_id) for doc_id in sample_ids]
+    missing = [doc_id for doc_id, doc in zip(sample_ids, sample_docs) if not isinstance(doc, Document)]
+    if missing: raise ValueError(f"IDs del índice sin documento en el docstore: {missing[:3]}")
+    # Auto-recuperación: cada chunk re-embebido debe volver a su propio ID (o a un chunk de texto idéntico). Detecta un mapeo
+    # posición -> ID desalineado, que las comprobaciones de conteo no ven. Un índice exacto debe acertar en el top-1; uno
+    # aproximado solo en el top-k y con un umbral menor (un mapeo desalineado da ~0 aciertos en cualquier caso).
+    exact = isinstance(faiss.downcast_index(vectorstore.index), faiss.IndexFlat)
+    min_hits, top_k = (FAISS_VALIDATION_MIN_SELF_HITS, 1) if exact else (FAISS_VALIDATION_MIN_SELF_HITS_APPROX, min(FAISS_VALIDATION_APPROX_TOP_K, ntotal))
+    if min_hits > 0 and hasattr(vectorstore.embedding_function, "embed_documents"):
+        vectors = embed_texts(vectorstore.embedding_function, [d.page_content for d in sample_docs])
+        if getattr(vectorstore, "_normalize_L2", False): faiss.normalize_L2(vectors)
+        _, labels = vectorstore.index.search(vectors, top_k)
+        hits = 0
+        for doc_id, doc, row in zip(sample_ids, sample_docs, labels):
+            hit_ids = [vectorstore.index_to_docstore_id.get(int(label)) for label in row if label >= 0]
+            if doc_id in hit_ids: hits += 1
+            elif any(getattr(vectorstore.docstore.search(h), "page_content", None) == doc.page_content for h in hit_ids if h is not None): hits += 1
+        if hits < min_hits * len(sample_ids):
+            raise ValueError(f"Auto-recuperación fallida: solo {hits}/{len(sample_ids)} chunks de muestra se recuperan a sí mismos en el top-{top_k}.")
+
+def publish_faiss_version(persist_path: str, staging_dir: str) -> str:
+    # Renombrar el staging y reescribir CURRENT con os.replace: los lectores ven la versión anterior o la nueva, nunca una a medias
+    version = os.path.basename(staging_dir)[:-len(".staging")]
+    os.replace(staging_dir, os.path.join(persist_path, "versions", version))
+    current_tmp = os.path.join(persist_path, f"CURRENT.{os.getpid()}.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f: f.write(version)
+    os.replace(current_tmp, os.path.join(persist_path, "CURRENT"))
+    logging.info(f"Versión '{version}' del índice FAISS publicada en {persist_path}.")
+    prune_faiss_versions(persist_path)
+    return version
+
+def prune_faiss_versions(persist_path: str, keep: int = FAISS_INDEX_KEEP_VERSIONS) -> None:
+    versions = list_faiss_index_versions(persist_path)
+    current = os.path.basename(resolve_faiss_index_dir(persist_path))
+    versions_dir = os.path.join(persist_path, "versions")
+    old = [v for v in (versions[:-(keep + 1)] if len(versions) > keep + 1 else []) if v != current]
+    holders = [v for v in os.listdir(versions_dir) if v not in versions and not v.endswith(".staging") and os.path.isdir(os.path.join(versions_dir, v))]
+    in_use = {os.path.abspath(faiss_docstore_path(os.path.join(versions_dir, v))) for v in versions if v not in old}
+    for version in old + holders:
+        version_dir = os.path.join(versions_dir, version)
+        try:
+            if os.path.abspath(os.path.join(version_dir, FAISS_DOCSTORE_FILENAME)) in in_use:
+                # Versiones más recientes comparten su docstore: se conserva solo ese archivo
+                for name in os.listdir(version_dir):
+                    if name != FAISS_DOCSTORE_FILENAME: os.remove(os.path.join(version_dir, name))
+            else: shutil.rmtree(version_dir)
+        except Exception as e_del: logging.error(f'Failed to delete {version}. Reason: {e_del}')
+    collect_faiss_docstore_garbage(persist_path)
+
+def collect_faiss_docstore_garbage(persist_path: str) -> None:
+    # Filas de PDFs retirados en actualizaciones incrementales: se borran cuando ninguna versión restante las referencia
+    users = {}
+    for v in list_faiss_index_versions(persist_path):
+        d = os.path.join(persist_path, "versions", v)
+        users.setdefault(os.path.abspath(faiss_docstore_path(d)), []).append(d)
+    for docstore_path, dirs in users.items():
+        if not os.path.exists(docstore_path) or not any(os.path.exists(os.path.join(d, FAISS_DOCSTORE_REF_FILENAME)) for d in dirs): continue
+        referenced = set()
+        try:
+            for d in dirs:
+                with open(os.path.join(d, "index_to_docstore_id.json"), "r", encoding="utf-8") as f: referenced.update(json.load(f).values())
+            docstore = SQLiteDocstore(docstore_path)
+            try: n = docstore.retain_only(referenced)
+            finally: docstore.close()
+            if n: logging.info(f"Docstore compartido {docstore_path}: {n} filas sin referencias eliminadas.")
+        except (OSError, ValueError, sqlite3.Error) as e: logging.warning(f"No se pudo recolectar el docstore {docstore_path}: {e}")
+
+def discard_faiss_staging(staging_dir: str) -> None:
+    try: shutil.rmtree(staging_dir)
+    except Exception as e_del: logging.error(f'Failed to delete {staging_dir}. Reason: {e_del}')
+
+def rollback_faiss_index(persist_path: str, steps: int = 1) -> str:
+    # Uso: python -c "import main; main.rollback_faiss_index(main.FAISS_INDEX_PATH)"
+    versions = list_faiss_index_versions(persist_path)
+    current = os.path.basename(resolve_faiss_index_dir(persist_path))
+    if current not in versions or versions.index(current) - steps < 0:
+        raise ValueError(f"No hay {steps} versión(es) anterior(es) a '{current}' en {persist_path}.")
+    target = versions[versions.index(current) - steps]
+    current_tmp = os.path.join(persist_path, f"CURRENT.{os.getpid()}.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f: f.write(target)
+    os.replace(current_tmp, os.path.join(persist_path, "CURRENT"))
+    logging.info(f"Índice FAISS revertido de '{current}' a '{target}'.")
+    return target
+
+# --- ÍNDICES ANN CONFIGURABLES Y CARGA POR MEMORY-MAP ---
+def configure_faiss_index(index) -> None:
+    try: faiss.extract_index_ivf(index).nprobe = FAISS_IVF_NPROBE
+    except Exception: pass
+    base = faiss.downcast_index(index)
+    if hasattr(base, "hnsw"): base.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+
+def faiss_training_rows(n_vectors: int, sample_size: int = FAISS_TRAIN_SAMPLE_SIZE) -> np.ndarray:
+    # Filas usadas para entrenar: muestra aleatoria (reproducible) si la base supera el tamaño de muestra
+    if n_vectors <= sample_size: return np.arange(n_vectors)
+    return np.sort(np.random.default_rng(0).choice(n_vectors, sample_size, replace=False))
+
+def create_faiss_index(vectors: np.ndarray, factory: str = FAISS_INDEX_FACTORY):
+    dim = vectors.shape[1]
+    index = faiss.index_factory(dim, factory, faiss.METRIC_L2)
+    if not index.is_trained:
+        sample = vectors[faiss_training_rows(len(vectors))]
+        try:
+            logging.info(f"Entrenando índice FAISS '{factory}' con {len(sample)} vectores...")
+            index.train(sample)
+        except RuntimeError as e:
+            # Típicamente: menos vectores que centroides IVF/PQ. Con corpus tan pequeños el índice exacto es lo adecuado.
+            logging.warning(f"No se pudo entrenar '{factory}' ({str(e).splitlines()[0][:200]}). Se usará 'Flat'.")
+            index = faiss.index_factory(dim, "Flat", faiss.METRIC_L2)
+    configure_faiss_index(index)
+    return index
+
+def evaluate_index_recall(index, vectors: np.ndarray, k: int = 10, n_queries: int = FAISS_RECALL_EVAL_QUERIES, held_out: np.ndarray = None, block_size: int = 65536) -> float:
+    # Recall@k del índice aproximado frente a la búsqueda exacta. `vectors` es la base indexada completa (array o memmap:
+    # la búsqueda exacta la recorre por bloques). Las queries salen de `held_out` (filas no usadas al entrenar) si se indica.
+    candidates = np.arange(len(vectors)) if held_out is None else np.asarray(held_out)
+    n_queries = min(n_queries, len(candidates))
+    if n_queries <= 0: return float("nan")
+    queries = np.ascontiguousarray(vectors[np.sort(np.random.default_rng(1).choice(candidates, n_queries, replace=False))], dtype=np.float32)
+    k = min(k, len(vectors))
+    best_d, best_i = np.empty((n_queries, 0), dtype=np.float32), np.empty((n_queries, 0), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.ascontiguousarray(vectors[start:start + block_size], dtype=np.float32)
+        d, i = faiss.knn(queries, block, min(k, len(block)))
+        best_d, best_i = np.hstack([best_d, d]), np.hstack([best_i, i + start])
+        order = np.argsort(best_d, axis=1, kind="stable")[:, :k]
+        best_d, best_i = np.take_along_axis(best_d, order, 1), np.take_along_axis(best_i, order, 1)
+    _, approx = index.search(queries, k)
+    return float(np.mean([len(set(t) & set(a)) / k for t, a in zip(best_i, approx)]))
+
+def log_index_recall(index, vectors: np.ndarray, train_rows: np.ndarray) -> None:
+    if FAISS_RECALL_EVAL_QUERIES <= 0 or isinstance(faiss.downcast_index(index), faiss.IndexFlat): return
+    held_out = np.setdiff1d(np.arange(len(vectors)), train_rows)
+    # Con corpus menores que la muestra de entrenamiento no quedan vectores excluidos: se mide sobre la base entera
+    scope = "vectores no usados al entrenar" if len(held_out) else "todos los vectores (todos se usaron al entrenar)"
+    recall = evaluate_index_recall(index, vectors, held_out=held_out if len(held_out) else None)
+    logging.info(f"Recall@10 del índice '{FAISS_INDEX_FACTORY}' frente a búsqueda exacta ({scope}): {recall:.3f}")
+    current_span().set(recall_at_10=round(recall, 4))
+
+def build_faiss_vectorstore(documents: list[Document], embeddings: Embeddings, ids: list[str], docstore: Docstore = None) -> FAISS:
+    vectors = embed_texts(embeddings, [d.page_content for d in documents], cache=True)
+    index = create_faiss_index(vectors, FAISS_INDEX_FACTORY)
+    index.add(vectors)
+    log_index_recall(index, vectors, faiss_training_rows(len(vectors)))
+    docstore = docstore if docstore is not None else InMemoryDocstore()
+    docstore.add({doc_id: doc for doc_id, doc in zip(ids, documents)})
+    return FAISS(embedding_function=embeddings, index=index, docstore=docstore, index_to_docstore_id=dict(enumerate(ids)))
+
+@traced("faiss_build")
+def build_faiss_index_streaming(chunks: Iterable[Document], embeddings: Embeddings, persist_path: str, pdf_hashes: dict = None, batch_size: int = INGESTION_BATCH_SIZE,
+                                deduplicator: ChunkDeduplicator = None) -> FAISS:
+    # Chunks -> embeddings por lotes -> índice incremental. Los documentos van directo al docstore SQLite; en memoria
+    # solo queda el lote actual. Los índices que requieren entrenamiento (IVF/PQ) se construyen en dos pasadas: los vectores
+    # se vuelcan a un archivo temporal mientras se toma una muestra de reservorio uniforme sobre TODO el flujo (no los
+    # primeros lotes, que suelen ser de los mismos PDFs), se entrena con ella y después se añaden leyendo el volcado.
+    pdf_hashes = pdf_hashes or {}
+    os.makedirs(persist_path, exist_ok=True)
+    staging_dir = create_faiss_staging_dir(persist_path)
+    docstore = SQLiteDocstore(os.path.join(staging_dir, FAISS_DOCSTORE_FILENAME))
+    index, index_to_docstore_id, counters, manifest = None, {}, {}, {}
+    spill_path = os.path.join(staging_dir, "vectors.spill")
+    reservoir, reservoir_rows, spilled_ids, dim = None, None, [], None
+    rng = np.random.default_rng(0)
+
+    def _add_to_index(vectors: np.ndarray, ids: list[str]):
+        start = index.ntotal
+        index.add(vectors)
+        for j, doc_id in enumerate(ids): index_to_docstore_id[start + j] = doc_id
+
+    def _spill_and_sample(vectors: np.ndarray, ids: list[str]):
+        # Algoritmo R vectorizado: la fila global t sustituye a una posición aleatoria j<=t del reservorio si j < tamaño
+        nonlocal reservoir, reservoir_rows
+        first = len(spilled_ids)
+        with open(spill_path, "ab") as f: f.write(vectors.tobytes())
+        spilled_ids.extend(ids)
+        if reservoir is None: reservoir, reservoir_rows = np.empty((0, vectors.shape[1]), dtype=np.float32), np.empty(0, dtype=np.int64)
+        free = max(0, min(FAISS_TRAIN_SAMPLE_SIZE - len(reservoir), len(vectors)))
+        if free:
+            reservoir = np.vstack([reservoir, vectors[:free]])
+            reservoir_rows = np.concatenate([reservoir_rows, np.arange(first, first + free)])
+        rows = np.arange(first + free, first + len(vectors))
+        if len(rows):
+            slots = rng.integers(0, rows + 1)
+            take = slots < FAISS_TRAIN_SAMPLE_SIZE
+            reservoir[slots[take]] = vectors[rows[take] - first]; reservoir_rows[slots[take]] = rows[take]
+
+    def _train_and_add_spilled():
+        nonlocal index
+        index = create_faiss_index(reservoir, FAISS_INDEX_FACTORY)
+        spilled = np.memmap(spill_path, dtype=np.float32, mode="r", shape=(len(spilled_ids), dim))
+        for start in range(0, len(spilled_ids), batch_size):
+            _add_to_index(np.ascontiguousarray(spilled[start:start + batch_size]), spilled_ids[start:start + batch_size])
+        log_index_recall(index, spilled, reservoir_rows)
+        del spilled
 
-def build_or_load_faiss_index(documents: list[Document] = None, embeddings: Embeddings = None, persist_path: str = "faiss_index_local") -> FAISS:
+    try:
+        n_chunks, n_batches = 0, 0
+        for batch in iter_batches(chunks, batch_size):
+            ids = assign_chunk_ids(batch, pdf_hashes, counters)
+            texts = [d.page_content for d in batch]
+            if n_batches == 0 and getattr(embeddings, "backend", "torch") != "torch" and EMBEDDING_PARITY_SAMPLE > 0:
+                try: check_embedding_parity(texts[:EMBEDDING_PARITY_SAMPLE], embeddings)
+                except Exception as e: logging.warning(f"No se pudo medir la paridad de embeddings: {e}")
+            vectors = embed_texts(embeddings, texts, cache=True)
+            docstore.add(dict(zip(ids, batch)))
+            build_manifest_entries(batch, ids, pdf_hashes, manifest)
+            if dim is None:
+                dim = vectors.shape[1]
+                if faiss.index_factory(dim, FAISS_INDEX_FACTORY).is_trained: index = create_faiss_index(vectors, FAISS_INDEX_FACTORY)
+            if index is not None: _add_to_index(vectors, ids)
+            else: _spill_and_sample(vectors, ids)
+            n_chunks += len(batch); n_batches += 1
+            logging.info(f"Lote {n_batches} indexado ({n_chunks} chunks acumulados).")
+        if spilled_ids: _train_and_add_spilled()
+        if deduplicator is not None: apply_chunk_merges(docstore, deduplicator.pop_updated(), manifest, pdf_hashes)
+        if index is None: raise ValueError("No se generaron chunks para construir el índice.")
+        if os.path.exists(spill_path): os.remove(spill_path)
+
+        vectorstore = FAISS(embedding_function=embeddings, index=index, docstore=docstore, index_to_docstore_id=index_to_docstore_id)
+        validate_faiss_vectorstore(vectorstore)
+        save_faiss_vectorstore(vectorstore, staging_dir)
+        save_faiss_manifest(staging_dir, manifest)
+        docstore.close()
+        publish_faiss_version(persist_path, staging_dir)
+    except Exception:
+        docstore.close(); discard_faiss_staging(staging_dir)
+        raise
+    logging.info(f"Índice FAISS construido en streaming en {persist_path} ({n_chunks} chunks, {n_batches} lotes).")
+    current_span().set(chunks=n_chunks, vectors=index.ntotal, batches=n_batches, factory=FAISS_INDEX_FACTORY)
+    return load_faiss_vectorstore(persist_path, embeddings)
+
+def load_faiss_vectorstore(persist_path: str, embeddings: Embeddings, mmap: bool = FAISS_MMAP_LOAD) -> FAISS:
+    persist_path = resolve_faiss_index_dir(persist_path)
+    index = load_faiss_index_file(persist_path, mmap)
+    configure_faiss_index(index)
+    docstore_path = faiss_docstore_path(persist_path)
+    if not os.path.exists(docstore_path):
+        raise FileNotFoundError(f"No existe {docstore_path} (índice con docstore pickle antiguo). Reconstruye el índice.")
+    with open(os.path.join(persist_path, "index_to_docstore_id.json"), "r", encoding="utf-8") as f:
+        index_to_docstore_id = {int(k): v for k, v in json.load(f).items()}
+    docstore = SQLiteDocstore(docstore_path)
+    return FAISS(embedding_function=embeddings, index=index, docstore=docstore, index_to_docstore_id=index_to_docstore_id)
+
+def build_or_load_faiss_index(documents: list[Document] = None, embeddings: Embeddings = None, persist_path: str = "faiss_index_local", pdf_hashes: dict = None) -> FAISS:
     if os.path.exists(persist_path) and os.listdir(persist_path) and not REBUILD_FAISS_INDEX:
         logging.info(f"Cargando índice FAISS desde {persist_path}")
         if not embeddings: raise ValueError("Embeddings requeridos para cargar índice.")
-        try: return FAISS.load_local(persist_path, embeddings, allow_dangerous_deserialization=True)
+        try: return load_faiss_vectorstore(persist_path, embeddings)
         except Exception as e:
             logging.error(f"Error cargando índice FAISS ({e}). Se reconstruirá si se proporcionan documentos y REBUILD_FAISS_INDEX es True.")
             # No forzar REBUILD_FAISS_INDEX = True aquí, la lógica principal lo decidirá.
@@ -358,20 +1683,21 @@ def build_or_load_faiss_index(documents: list[Document] = None, embeddings: Embe
     if REBUILD_FAISS_INDEX and documents and embeddings:
         logging.info(f"Construyendo nuevo índice FAISS en {persist_path}")
         os.makedirs(persist_path, exist_ok=True)
-        if os.path.exists(persist_path) and os.listdir(persist_path):
-            logging.info(f"Limpiando directorio de índice existente: {persist_path}")
-            for f_item in os.listdir(persist_path):
-                item_path = os.path.join(persist_path, f_item)
-                try:
-                    if os.path.isfile(item_path) or os.path.islink(item_path):
-                        os.unlink(item_path)
-                    elif os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
-                except Exception as e_del:
-                    logging.error(f'Failed to delete {item_path}. Reason: {e_del}')
-        
-        vectorstore = FAISS.from_documents(documents, embeddings)
-        vectorstore.save_local(persist_path)
+        # La nueva versión se construye en un staging aparte: la versión activa sigue disponible para otros lectores
+        staging_dir = create_faiss_staging_dir(persist_path)
+        docstore = SQLiteDocstore(os.path.join(staging_dir, FAISS_DOCSTORE_FILENAME))
+        try:
+            ids = assign_chunk_ids(documents, pdf_hashes or {})
+            vectorstore = build_faiss_vectorstore(documents, embeddings, ids, docstore=docstore)
+            validate_faiss_vectorstore(vectorstore)
+            save_faiss_vectorstore(vectorstore, staging_dir)
+            save_faiss_manifest(staging_dir, build_manifest_entries(documents, ids, pdf_hashes or {}))
+            docstore.close()
+            publish_faiss_version(persist_path, staging_dir)
+        except Exception:
+            docstore.close(); discard_faiss_staging(staging_dir)
+            raise
+        vectorstore = load_faiss_vectorstore(persist_path, embeddings)
         logging.info(f"Nuevo índice FAISS construido y guardado en {persist_path}.")
         return vectorstore
     
@@ -388,59 +1714,393 @@ def build_or_load_faiss_index(documents: list[Document] = None, embeddings: Embe
 
     return None # Caso por defecto si no se entra en ninguna lógica de construcción/carga exitosa
 
+# --- BÚSQUEDA FILTRADA POR PDF DENTRO DEL ÍNDICE (IDSelector de FAISS) ---
+def get_source_faiss_ids(vectorstore: FAISS) -> dict[str, np.ndarray]:
+    # {source: IDs internos de FAISS}. Se memoriza en el vectorstore (las versiones publicadas no se modifican).
+    cached = getattr(vectorstore, "_ids_por_fuente", None)
+    if cached is not None and cached[0] == vectorstore.index.ntotal: return cached[1]
+    ids_por_fuente = {}
+    if isinstance(vectorstore.docstore, SQLiteDocstore):
+        # Una sola consulta agregada en vez de leer cada documento
+        faiss_id_of = {doc_id: faiss_id for faiss_id, doc_id in vectorstore.index_to_docstore_id.items()}
+        for source, doc_ids in vectorstore.docstore.ids_by_source().items():
+            ids_por_fuente[source] = [faiss_id_of[d] for d in doc_ids if d in faiss_id_of]
+    else:
+        for faiss_id, doc_id in vectorstore.index_to_docstore_id.items():
+            doc = vectorstore.docstore.search(doc_id)
+            if not isinstance(doc, Document): continue
+            for source in doc.metadata.get("sources") or [doc.metadata.get("source")]: ids_por_fuente.setdefault(source, []).append(faiss_id)
+    result = {source: np.asarray(sorted(ids), dtype=np.int64) for source, ids in ids_por_fuente.items() if ids} # El docstore compartido puede tener filas fuera de esta versión
+    vectorstore._ids_por_fuente = (vectorstore.index.ntotal, result)
+    return result
+
+def _faiss_search_params(index, selector):
+    # Cada familia de índice exige su propio tipo de SearchParameters para aceptar el selector
+    try: ivf = faiss.extract_index_ivf(index)
+    except Exception: ivf = None
+    if ivf is not None: return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    base = faiss.downcast_index(index)
+    if hasattr(base, "hnsw"): return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+def search_faiss_filtered(vectorstore: FAISS, vectors: np.ndarray, k: int, source_filename: str = None) -> list[list[tuple[Document, float]]]:
+    # Una búsqueda matricial por llamada; con `source_filename` la restricción se aplica dentro del índice,
+    # así que se obtienen exactamente min(k, nº de chunks del PDF) resultados de ese PDF.
+    x = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+    if getattr(vectorstore, "_normalize_L2", False): faiss.normalize_L2(x)
+    params, k_eff = None, min(k, vectorstore.index.ntotal)
+    if source_filename:
+        ids = get_source_faiss_ids(vectorstore).get(source_filename)
+        if ids is None or len(ids) == 0:
+            logging.warning(f"No hay vectores indexados para '{source_filename}'."); return [[] for _ in range(len(x))]
+        k_eff = min(k, len(ids))
+        params = _faiss_search_params(vectorstore.index, faiss.IDSelectorBatch(ids))
+    if k_eff <= 0: return [[] for _ in range(len(x))]
+    distances, indices = vectorstore.index.search(x, k_eff, params=params)
+    if params is not None and (indices == -1).any() and not type(params) is faiss.SearchParameters:
+        # IVF/HNSW filtrados pueden no alcanzar k vectores del PDF con la exploración por defecto: se repite ampliándola
+        if isinstance(params, faiss.SearchParametersIVF): params.nprobe = faiss.extract_index_ivf(vectorstore.index).nlist
+        else: params.efSearch = max(params.efSearch * 8, k_eff * 8)
+        distances, indices = vectorstore.index.search(x, k_eff, params=params)
+    relevance_fn = vectorstore._select_relevance_score_fn()
+    results = []
+    for row_distances, row_indices in zip(distances, indices):
+        row = []
+        for dist, faiss_id in zip(row_distances, row_indices):
+            if faiss_id == -1: continue
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(faiss_id)])
+            if isinstance(doc, Document): row.append((doc, float(relevance_fn(dist))))
+        results.append(row)
+    return results
+
 def semantic_search_filtered(query: str, vectorstore: FAISS, k: int = 10, source_filename: str = None) -> list[Document]:
     logging.info(f"Búsqueda semántica: '{query}' (k={k}, filtro='{source_filename or 'Ninguno'}')")
     if not (vectorstore and hasattr(vectorstore, 'index') and vectorstore.index and vectorstore.index.ntotal > 0):
         logging.error(f"Índice FAISS no disponible o vacío para la query: '{query}'."); return []
     try:
-        k_fetch = min(k * 2, vectorstore.index.ntotal) 
-        if k_fetch == 0 and k > 0 : k_fetch = min(k, vectorstore.index.ntotal)
-        if k_fetch == 0: logging.warning(f"k_fetch es 0 para la query '{query}'. No se buscará."); return []
-        
-        results_with_scores = vectorstore.similarity_search_with_relevance_scores(query, k=k_fetch)
-
-        if not results_with_scores: logging.warning(f"similarity_search_with_relevance_scores no devolvió resultados para '{query}'."); return []
-        
-        final_results = []
-        for doc, score in results_with_scores:
-            if source_filename:
-                if doc.metadata.get("source") == source_filename:
-                    final_results.append(doc)
-            else:
-                final_results.append(doc)
-            if len(final_results) >= k:
-                break
+        query_vector = vectorstore.embedding_function.embed_query(query)
+        results_with_scores = search_faiss_filtered(vectorstore, np.asarray(query_vector, dtype=np.float32), k, source_filename)[0]
+        final_results = [doc for doc, _ in results_with_scores]
         logging.info(f"Se obtuvieron {len(final_results)} resultados (de k={k} solicitados) para '{query}' con filtro '{source_filename or 'todos'}'.")
         return final_results
     except Exception as e: logging.error(f"Excepción en búsqueda semántica para '{query}': {e}", exc_info=True); return []
 
-def initialize_llm(provider: str = "google", model_name: str = None, temperature: float = 0.15):
-    if provider.lower() == "google":
-        model_to_use = model_name if model_name else "gemini-1.5-flash-latest"
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            logging.critical("CRÍTICO: GOOGLE_API_KEY no encontrada en .env o en el entorno.")
-            raise ValueError("GOOGLE_API_KEY no encontrada en .env.")
-        try:
-            safety_settings_corrected = {
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            }
-            llm = ChatGoogleGenerativeAI(
-                model=model_to_use,
-                google_api_key=api_key,
-                temperature=temperature,
-                safety_settings=safety_settings_corrected,
-                request_timeout=300 # Timeout aumentado a 5 minutos
-            )
-            logging.info(f"LLM Google Gemini ('{model_to_use}', temp={temperature}) inicializado.")
-            return llm
+# --- PLAN DE RECUPERACIÓN POR LOTES (todas las queries de todos los competidores) ---
+def competitor_display_name(pdf_filename: str) -> str:
+    return os.path.splitext(pdf_filename)[0].replace("_", " ").replace("-", " ").title()
+
+def retrieval_query(pdf: str, param_info: dict) -> str:
+    return param_info["query_rag_banco_externo_template"].format(nombre_banco_externo=competitor_display_name(pdf))
+
+def plan_retrieval(pdfs_competidores: list[str], parametros: list[dict]) -> list[dict]:
+    plan = []
+    for pdf in pdfs_competidores:
+        for param_info in parametros:
+            plan.append({"source": pdf, "nombre_parametro": param_info["nombre_parametro"], "query": retrieval_query(pdf, param_info)})
+    return plan
+
+@traced("retrieval_search")
+def execute_retrieval_plan(plan: list[dict], vectorstore: FAISS, k: int) -> dict[tuple[str, str], list[tuple[Document, float]]]:
+    # Un único encode por lotes para todas las queries y una búsqueda matricial por PDF (el filtro por fuente es por llamada)
+    if not plan: return {}
+    if not (vectorstore and vectorstore.index and vectorstore.index.ntotal > 0):
+        logging.error("Índice FAISS no disponible o vacío para ejecutar el plan de recuperación."); return {}
+    query_vectors = embed_texts(vectorstore.embedding_function, [item["query"] for item in plan])
+    filas_por_fuente = {}
+    for row, item in enumerate(plan): filas_por_fuente.setdefault(item["source"], []).append(row)
+    results = {}
+    for source, rows in filas_por_fuente.items():
+        try: hits_por_query = search_faiss_filtered(vectorstore, query_vectors[rows], k, source)
         except Exception as e:
-            logging.error(f"Error inicializando Google Gemini: {e}", exc_info=True); raise
-    else:
-        raise ValueError(f"Proveedor de LLM no soportado: {provider}.")
+            logging.error(f"Excepción en la búsqueda por lotes para '{source}': {e}", exc_info=True); hits_por_query = [[] for _ in rows]
+        for row, hits in zip(rows, hits_por_query):
+            results[(source, plan[row]["nombre_parametro"])] = hits
+    logging.info(f"Plan de recuperación ejecutado: {len(plan)} queries, {len(filas_por_fuente)} PDF(s), k={k}.")
+    current_span().set(queries=len(plan), sources=len(filas_por_fuente), hits=sum(len(h) for h in results.values()))
+    return results
+
+# --- ALMACÉN ESTRUCTURADO DE TABLAS (consultas numéricas directas, sin pasar por el LLM) ---
+def parse_numeric_cell(text: str) -> float | None:
+    # "1,234.5", "1.234,5", "(1,234)" -> negativo, "12.5%", "S/ 1,000", "US$ 3.2"; None si la celda no es numérica
+    t = str(text).strip().replace(" ", "").replace("US$", "$")
+    if not t or not _RE_NUMERIC_TOKEN.match(t): return None
+    negative = (t.startswith("(") and t.endswith(")")) or "-" in t
+    digits = re.sub(r"[^\d.,]", "", t).rstrip(".,")
+    if "," in digits and "." in digits: decimal = "," if digits.rfind(",") > digits.rfind(".") else "." # El último separador es el decimal
+    elif digits.count(",") + digits.count(".") == 1:
+        sep = "," if "," in digits else "."
+        int_part, frac_part = digits.split(sep)
+        decimal = sep if len(frac_part) != 3 or int_part in ("", "0") else None # "1,234" / "1.234": separador de miles
+    else: decimal = None
+    if decimal is None: digits = digits.replace(",", "").replace(".", "")
+    else: digits = digits.replace("." if decimal == "," else ",", "").replace(decimal, ".")
+    try: value = float(digits)
+    except ValueError: return None
+    return -value if negative else value
+
+def table_terms(text: str) -> set[str]:
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return set(re.findall(r"[a-z0-9]+", "".join(c for c in text if not unicodedata.combining(c))))
+
+class TableStore:
+    # Formato largo: una fila por celda (tabla, fila, columna, etiqueta de fila, cabecera, texto, número) + índice
+    # invertido de términos de cabeceras/etiquetas por tabla. Fuente y página quedan indexadas en `tables`. Sustituye al
+    # almacén columnar (Parquet/DuckDB, no disponibles como dependencia): las tablas de los PDFs tienen columnas
+    # heterogéneas y las consultas son por término + fuente, que el formato largo con índices resuelve igual de bien.
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tables (table_id TEXT PRIMARY KEY, source TEXT NOT NULL, pdf_hash TEXT, page INTEGER, method TEXT, headers TEXT, n_rows INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tables_source_page ON tables(source, page)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cells (table_id TEXT NOT NULL, row_idx INTEGER, col_idx INTEGER, row_label TEXT, header TEXT, value_text TEXT, value_num REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cells_table ON cells(table_id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT NOT NULL, table_id TEXT NOT NULL, PRIMARY KEY (term, table_id)) WITHOUT ROWID")
+            # PDFs sincronizados (también los que no tienen tablas, para no re-extraerlos en cada ejecución)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, pdf_hash TEXT)")
+
+    @staticmethod
+    def _split_header(columns: list[str], data: list[list[str]]) -> tuple[list[str], list[list[str]]]:
+        # Camelot numera las columnas (0, 1, 2...): la cabecera real suele ser la primera fila de datos
+        if data and all(str(c).isdigit() for c in columns):
+            return [str(h) or f"col_{j}" for j, h in enumerate(data[0])], data[1:]
+        return [str(c) for c in columns], data
+
+    def add_table(self, metadata: dict, columns: list[str], data: list[list[str]], pdf_hash: str = None) -> None:
+        headers, rows = self._split_header(columns, data)
+        table_id = metadata.get("table_id") or f"{metadata.get('source')}_p{metadata.get('page')}_{len(headers)}x{len(rows)}"
+        cells, terms = [], set(table_terms(" ".join(headers)))
+        for i, row in enumerate(rows):
+            label = next((str(v) for v in row if str(v).strip() and parse_numeric_cell(v) is None), "")
+            terms |= table_terms(label)
+            for j, value in enumerate(row):
+                if not str(value).strip() or str(value) == label: continue
+                cells.append((table_id, i, j, label, headers[j] if j < len(headers) else f"col_{j}", str(value), parse_numeric_cell(value)))
+        with self._conn:
+            self._conn.execute("DELETE FROM cells WHERE table_id = ?", (table_id,))
+            self._conn.execute("DELETE FROM terms WHERE table_id = ?", (table_id,))
+            self._conn.execute("INSERT OR REPLACE INTO tables VALUES (?, ?, ?, ?, ?, ?, ?)", (table_id, metadata.get("source"), pdf_hash, metadata.get("page"),
+                               metadata.get("extraction_method"), json.dumps(headers, ensure_ascii=False), len(rows)))
+            self._conn.executemany("INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)", cells)
+            self._conn.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?)", [(t, table_id) for t in terms])
+
+    def pdf_hashes(self) -> dict[str, str]:
+        return dict(self._conn.execute("SELECT source, pdf_hash FROM sources"))
+
+    def mark_source(self, source: str, pdf_hash: str) -> None:
+        with self._conn: self._conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (source, pdf_hash))
+
+    def count_tables(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM tables").fetchone()[0]
+
+    def delete_source(self, source: str) -> None:
+        with self._conn:
+            for sql in ("DELETE FROM cells WHERE table_id IN (SELECT table_id FROM tables WHERE source = ?)",
+                        "DELETE FROM terms WHERE table_id IN (SELECT table_id FROM tables WHERE source = ?)",
+                        "DELETE FROM tables WHERE source = ?", "DELETE FROM sources WHERE source = ?"): self._conn.execute(sql, (source,))
+
+    def lookup(self, terms: list[str], source: str = None, page: int = None, max_tables: int = TABLE_LOOKUP_MAX_TABLES, numeric_only: bool = True) -> pd.DataFrame:
+        # Tablas ordenadas por nº de términos presentes en sus cabeceras/etiquetas; se devuelven las celdas cuya fila o
+        # columna contiene alguno de los términos (todas las palabras de un término deben aparecer)
+        term_sets = [ts for ts in (table_terms(t) for t in terms) if ts]
+        empty = pd.DataFrame(columns=["source", "page", "table_id", "row_label", "header", "value_text", "value_num"])
+        if not term_sets: return empty
+        score = {}
+        for ts in term_sets:
+            placeholders = ",".join("?" * len(ts))
+            for (table_id,) in self._conn.execute(f"SELECT table_id FROM terms WHERE term IN ({placeholders}) GROUP BY table_id HAVING COUNT(*) = ?", (*ts, len(ts))):
+                score[table_id] = score.get(table_id, 0) + 1
+        if not score: return empty
+        filters, params = "", []
+        if source is not None: filters += " AND t.source = ?"; params.append(source)
+        if page is not None: filters += " AND t.page = ?"; params.append(page)
+        placeholders = ",".join("?" * len(score))
+        rows = self._conn.execute(f"SELECT t.source, t.page, c.table_id, c.row_label, c.header, c.value_text, c.value_num, c.row_idx, c.col_idx FROM cells c JOIN tables t ON t.table_id = c.table_id "
+                                  f"WHERE c.table_id IN ({placeholders}){filters}" + (" AND c.value_num IS NOT NULL" if numeric_only else ""), (*score, *params)).fetchall()
+        df = pd.DataFrame(rows, columns=[*empty.columns, "row_idx", "col_idx"])
+        if df.empty: return empty
+        matches = lambda text: any(ts <= table_terms(text) for ts in term_sets)
+        df = df[df["row_label"].map(matches) | df["header"].map(matches)]
+        top_tables = sorted(df["table_id"].unique(), key=lambda t: (-score[t], t))[:max_tables]
+        df = df[df["table_id"].isin(top_tables)]
+        df = df.assign(_rank=df["table_id"].map({t: i for i, t in enumerate(top_tables)})).sort_values(["_rank", "row_idx", "col_idx"])
+        return df[empty.columns].reset_index(drop=True)
+
+    def close(self) -> None:
+        self._conn.close()
+
+def load_table_records(fname: str, pdf_hash: str = None, folder: str = None) -> list[tuple[dict, list[str], list[list[str]]]]:
+    # (metadatos, columnas, filas) de las tablas de un PDF: de la caché de extracción si existe o, si no (caché desactivada,
+    # incompleta o de otro nombre de archivo), directamente de extract_tables_from_pdf
+    if EXTRACTION_CACHE_DIR and pdf_hash and os.path.exists(extraction_cache_path(pdf_hash)):
+        try:
+            records = list(iter_extraction_cache(pdf_hash))
+            if all(r["metadata"].get("source") == fname for r in records):
+                return [(r["metadata"], r["columns"], r["data"]) for r in records if r.get("type") == "table"]
+        except Exception as e: logging.warning(f"Caché de extracción ilegible para {fname} ({e}). Se extraerán sus tablas.")
+    table_items, _ = extract_tables_from_pdf(os.path.join(folder or FOLDER_INPUT_PDFS, fname))
+    return [(doc.metadata, [str(c) for c in df.columns], df.astype(str).values.tolist()) for doc, df in table_items]
+
+def sync_table_store(store: TableStore, pdf_hashes: dict, folder: str = None) -> None:
+    # Los PDFs ya cargados con el mismo hash se omiten; los demás se (re)cargan de la caché de extracción o extrayendo sus tablas
+    stored = store.pdf_hashes()
+    for source in set(stored) - set(pdf_hashes): store.delete_source(source)
+    for fname, pdf_hash in pdf_hashes.items():
+        if pdf_hash and stored.get(fname) == pdf_hash: continue
+        try:
+            records = load_table_records(fname, pdf_hash, folder)
+            store.delete_source(fname)
+            for metadata, columns, data in records: store.add_table(metadata, columns, data, pdf_hash)
+            store.mark_source(fname, pdf_hash)
+            logging.info(f"Almacén de tablas: {len(records)} tabla(s) de {fname} cargadas.")
+        except Exception as e: logging.warning(f"No se pudieron cargar las tablas de {fname} en el almacén estructurado: {e}")
+    if pdf_hashes and not store.count_tables():
+        logging.warning(f"El almacén estructurado de tablas está vacío ({len(pdf_hashes)} PDF(s)): las consultas de tablas no devolverán valores.")
+
+def lookup_table_values(store: TableStore, terms: list[str], source: str = None, page: int = None) -> pd.DataFrame:
+    # Ej.: lookup_table_values(store, ["ecl", "stage"], source="BBVA 2024.pdf") -> celdas numéricas de las tablas de ECL por etapa
+    try: return store.lookup(terms, source=source, page=page)
+    except Exception as e:
+        logging.warning(f"Error consultando el almacén de tablas ({terms}, {source}): {e}")
+        return pd.DataFrame(columns=["source", "page", "table_id", "row_label", "header", "value_text", "value_num"])
+
+def format_table_lookup_context(df: pd.DataFrame, max_rows: int = TABLE_LOOKUP_MAX_ROWS) -> str:
+    # Contexto compacto: una línea por fila de tabla ("etiqueta: cabecera=valor; ..."), en lugar del Markdown completo
+    if df is None or df.empty: return ""
+    lines, n_rows = [], 0
+    for (source, page, table_id), tabla in df.groupby(["source", "page", "table_id"], sort=False):
+        lines.append(f"Tabla '{table_id}' (Fuente: {source}, Página: {page}):")
+        for label, fila in tabla.groupby("row_label", sort=False):
+            if n_rows >= max_rows: break
+            lines.append(f"- {label or '(sin etiqueta)'}: " + "; ".join(f"{h}={v}" for h, v in zip(fila["header"], fila["value_text"]))); n_rows += 1
+    return "\n".join(lines)
+
+# --- PROVEEDORES LLM (registro por nombre; clientes HTTP con pool de conexiones compartido) ---
+class LLMProviderError(Exception):
+    # Error HTTP de un proveedor; status_code y el texto (429, "retry after", "context length", "candidate blocked")
+    # los clasifican _is_retryable_llm_error y _llm_error_message igual que los errores de Gemini
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message); self.status_code = status_code
+
+_HTTP_CLIENTS: dict[tuple, httpx.Client] = {}
+_HTTP_CLIENTS_LOCK = threading.Lock()
+
+def get_http_client(base_url: str, timeout: float = LLM_HTTP_TIMEOUT_SECONDS) -> httpx.Client:
+    # Un cliente por (base_url, timeout) para todo el proceso: las llamadas concurrentes reutilizan conexiones keep-alive
+    with _HTTP_CLIENTS_LOCK:
+        client = _HTTP_CLIENTS.get((base_url, timeout))
+        if client is None:
+            limits = httpx.Limits(max_connections=LLM_HTTP_MAX_CONNECTIONS, max_keepalive_connections=LLM_HTTP_MAX_CONNECTIONS)
+            client = _HTTP_CLIENTS[(base_url, timeout)] = httpx.Client(base_url=base_url, timeout=timeout, limits=limits)
+            if len(_HTTP_CLIENTS) == 1: atexit.register(close_http_clients)
+        return client
+
+def close_http_clients() -> None:
+    with _HTTP_CLIENTS_LOCK:
+        for client in _HTTP_CLIENTS.values(): client.close()
+        _HTTP_CLIENTS.clear()
+
+def _raise_for_llm_response(response: httpx.Response) -> None:
+    if response.status_code < 400: return
+    try: detalle = response.json().get("error", {}).get("message", "")
+    except Exception: detalle = response.text[:500]
+    retry_after = response.headers.get("retry-after")
+    raise LLMProviderError(f"HTTP {response.status_code}: {detalle}" + (f" (retry after {retry_after}s)" if retry_after else ""), response.status_code)
+
+class OpenAICompatibleChatModel(BaseChatModel):
+    # Cliente mínimo de /chat/completions (OpenAI, vLLM, Ollama, LM Studio, stub_llm_server.py), con y sin streaming (SSE)
+    model: str
+    base_url: str
+    api_key: str | None = None
+    temperature: float = 0.15
+    max_tokens: int | None = None
+    timeout: float = LLM_HTTP_TIMEOUT_SECONDS
+
+    @property
+    def _llm_type(self) -> str:
+        return "openai_compatible"
+
+    def _payload(self, messages: list[BaseMessage], stop: list[str] | None, stream: bool) -> dict:
+        roles = {"human": "user", "ai": "assistant", "system": "system"}
+        payload = {"model": self.model, "temperature": self.temperature, "stream": stream,
+                   "messages": [{"role": roles.get(m.type, "user"), "content": m.content} for m in messages]}
+        if stop: payload["stop"] = stop
+        if self.max_tokens: payload["max_tokens"] = self.max_tokens
+        return payload
+
+    def get_num_tokens(self, text: str) -> int:
+        # El tokenizador depende del modelo servido: se usa la estimación caracteres/token del pipeline (LangChain descargaría el de GPT-2)
+        return count_llm_tokens(text)
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    @staticmethod
+    def _check_finish_reason(finish_reason: str | None) -> None:
+        if finish_reason == "content_filter": raise LLMProviderError("Respuesta bloqueada: candidate blocked by content filter (finish_reason=content_filter)")
+
+    def _generate(self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager=None, **kwargs) -> ChatResult:
+        response = get_http_client(self.base_url, self.timeout).post("/chat/completions", json=self._payload(messages, stop, False), headers=self._headers())
+        _raise_for_llm_response(response)
+        data = response.json(); choice = data["choices"][0]
+        self._check_finish_reason(choice.get("finish_reason"))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=choice["message"].get("content") or ""))], llm_output={"usage": data.get("usage", {}), "model": self.model})
+
+    def _stream(self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        with get_http_client(self.base_url, self.timeout).stream("POST", "/chat/completions", json=self._payload(messages, stop, True), headers=self._headers()) as response:
+            if response.status_code >= 400: response.read(); _raise_for_llm_response(response)
+            for line in response.iter_lines():
+                if not line.startswith("data:"): continue
+                data = line[5:].strip()
+                if data == "[DONE]": break
+                choice = json.loads(data)["choices"][0]
+                self._check_finish_reason(choice.get("finish_reason"))
+                texto = choice.get("delta", {}).get("content") or ""
+                if not texto: continue
+                if run_manager: run_manager.on_llm_new_token(texto)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=texto))
+
+def _initialize_google_llm(model_name: str = None, temperature: float = 0.15):
+    model_to_use = model_name if model_name else "gemini-1.5-flash-latest"
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        logging.critical("CRÍTICO: GOOGLE_API_KEY no encontrada en .env o en el entorno.")
+        raise ValueError("GOOGLE_API_KEY no encontrada en .env.")
+    try:
+        safety_settings_corrected = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        }
+        llm = ChatGoogleGenerativeAI(
+            model=model_to_use,
+            google_api_key=api_key,
+            temperature=temperature,
+            safety_settings=safety_settings_corrected,
+            request_timeout=300 # Timeout aumentado a 5 minutos
+        )
+        logging.info(f"LLM Google Gemini ('{model_to_use}', temp={temperature}) inicializado.")
+        return llm
+    except Exception as e:
+        logging.error(f"Error inicializando Google Gemini: {e}", exc_info=True); raise
+
+def _initialize_openai_compatible_llm(model_name: str = None, temperature: float = 0.15):
+    model_to_use = model_name if model_name else os.getenv("OPENAI_MODEL", "stub-llm")
+    llm = OpenAICompatibleChatModel(model=model_to_use, base_url=LLM_BASE_URL.rstrip("/"), api_key=os.getenv("OPENAI_API_KEY"), temperature=temperature)
+    logging.info(f"LLM compatible con OpenAI ('{model_to_use}' en {llm.base_url}, temp={temperature}) inicializado.")
+    return llm
+
+LLM_PROVIDERS: dict[str, Callable] = {
+    "google": _initialize_google_llm,
+    "openai_compatible": _initialize_openai_compatible_llm,
+}
+
+def initialize_llm(provider: str = "google", model_name: str = None, temperature: float = 0.15):
+    factory = LLM_PROVIDERS.get(provider.lower())
+    if factory is None:
+        raise ValueError(f"Proveedor de LLM no soportado: {provider}. Disponibles: {', '.join(LLM_PROVIDERS)}.")
+    return factory(model_name=model_name, temperature=temperature)
 
 # Usando PromptTemplate de langchain.prompts para compatibilidad con la v11 que funcionó
 PROMPT_DESCRIBIR_METODOLOGIA_NB = PromptTemplate(
@@ -456,12 +2116,107 @@ PROMPT_INFORME_COMPETIDOR = PromptTemplate(
     template=TEMPLATE_INFORME_BENCHMARK_COMPETIDOR_V2
 )
 PROMPT_CONCLUSION_GLOBAL = PromptTemplate(
-    input_variables=["textos_informes_individuales_concatenados_placeholder", "nombre_nuestro_banco_prompt", "lista_nombres_competidores"],
+    input_variables=["resumenes_hallazgos_competidores", "nombre_nuestro_banco_prompt", "lista_nombres_competidores"],
     template=TEMPLATE_CONCLUSION_GLOBAL_BENCHMARK
 )
+PROMPT_RESUMEN_HALLAZGOS = PromptTemplate(
+    input_variables=["informe_competidor", "nombre_banco_externo_prompt", "nombre_nuestro_banco_prompt", "max_palabras"],
+    template=TEMPLATE_RESUMEN_HALLAZGOS_COMPETIDOR
+)
+PROMPT_FUSION_RESUMENES = PromptTemplate(
+    input_variables=["resumenes_grupo", "nombre_nuestro_banco_prompt", "max_palabras"],
+    template=TEMPLATE_FUSION_RESUMENES_HALLAZGOS
+)
 
-def run_llm_chain(llm, prompt_template: PromptTemplate, inputs: dict, task_description: str) -> str:
-    context_keys = ["context", "contexto_completo_analisis", "textos_informes_individuales_concatenados_placeholder"]
+# --- PLANIFICADOR LLM: límite de peticiones/tokens por minuto (token bucket), concurrencia y reintentos con backoff ---
+class LLMRateLimiter:
+    # Dos token buckets (peticiones y tokens por minuto) compartidos por todos los hilos. Diseño basado en hilos: cada llamada
+    # LLM (también las lanzadas por el planificador asíncrono) corre en un hilo de trabajo, que espera aquí con time.sleep
+    def __init__(self, requests_per_minute: float = LLM_REQUESTS_PER_MINUTE, tokens_per_minute: float = LLM_TOKENS_PER_MINUTE):
+        self.capacity = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+        self.available = dict(self.capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        # Reserva si hay saldo (devuelve 0) o devuelve los segundos a esperar antes de reintentar
+        needed = {"requests": 1.0, "tokens": float(min(tokens, self.capacity["tokens"]))}
+        with self._lock:
+            now = time.monotonic()
+            for key, cap in self.capacity.items(): self.available[key] = min(cap, self.available[key] + (now - self._last_refill) * cap / 60.0)
+            self._last_refill = now
+            waits = [(needed[k] - self.available[k]) * 60.0 / self.capacity[k] for k in needed if self.available[k] < needed[k]]
+            if waits: return max(waits)
+            for k in needed: self.available[k] -= needed[k]
+            return 0.0
+
+    def acquire(self, tokens: int) -> float:
+        waited = 0.0
+        while (wait := self._reserve(tokens)) > 0: time.sleep(wait); waited += wait
+        return waited
+
+LLM_RATE_LIMITER = LLMRateLimiter()
+_RE_RETRY_DELAY = re.compile(r'retry[_ -]?(?:delay|in|after)\D{0,20}?(\d+(?:\.\d+)?)', re.IGNORECASE) # "retry_delay { seconds: 36 }", "Retry-After: 20", "retry in 12s"
+
+def _is_quota_error(e: Exception) -> bool:
+    if getattr(e, "code", None) == 429 or getattr(e, "status_code", None) == 429 or type(e).__name__ in ("ResourceExhausted", "RateLimitError"): return True
+    error_str = str(e).lower()
+    return "rate limit" in error_str or "quota" in error_str or "429" in error_str or "resource_exhausted" in error_str
+
+def _is_retryable_llm_error(e: Exception) -> bool:
+    if _is_quota_error(e): return True
+    if type(e).__name__ in ("ServiceUnavailable", "DeadlineExceeded", "InternalServerError", "TimeoutError", "APITimeoutError", "APIConnectionError"): return True
+    if isinstance(e, (httpx.TimeoutException, httpx.NetworkError)) or getattr(e, "status_code", None) in (500, 502, 503, 504): return True
+    error_str = str(e).lower()
+    return "503" in error_str or "unavailable" in error_str or "deadline exceeded" in error_str
+
+def llm_backoff_delay(attempt: int, error: Exception = None) -> float:
+    # Si el proveedor indica cuánto esperar (retry_delay de Gemini, Retry-After) se respeta; si no, full jitter
+    m = _RE_RETRY_DELAY.search(str(error)) if error is not None else None
+    if m: return min(float(m.group(1)) + random.uniform(0, 1), LLM_BACKOFF_MAX_SECONDS)
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+_LLM_CHARS_PER_TOKEN_CALIBRATED = None
+
+def calibrate_llm_token_counter(llm, sample_text: str, provider: str = LLM_PROVIDER, calibration_path: str = LLM_TOKEN_CALIBRATION_PATH) -> float:
+    # Una sola llamada al contador real del modelo (get_num_tokens) fija la relación caracteres/token del corpus;
+    # después el conteo es local. Si el proveedor no lo soporta se mantiene LLM_CHARS_PER_TOKEN.
+    # La relación (cuantizada) se guarda por proveedor y modelo: las ejecuciones siguientes empaquetan el mismo contexto
+    # y conservan las claves de artefactos y de la caché LLM aunque la muestra o el contador cambien ligeramente.
+    global _LLM_CHARS_PER_TOKEN_CALIBRATED
+    key = f"{provider}:{llm_fingerprint(llm)['model']}"
+    calibraciones = {}
+    if calibration_path and os.path.exists(calibration_path):
+        try:
+            with open(calibration_path, "r", encoding="utf-8") as f: calibraciones = json.load(f)
+        except (OSError, ValueError) as e: logging.warning(f"No se pudo leer {calibration_path} ({e}). Se recalibrará.")
+    if calibraciones.get(key):
+        _LLM_CHARS_PER_TOKEN_CALIBRATED = float(calibraciones[key])
+        logging.info(f"Contador de tokens LLM: {_LLM_CHARS_PER_TOKEN_CALIBRATED:.2f} caracteres/token (calibración guardada para '{key}').")
+    elif sample_text.strip():
+        try:
+            n_tokens = llm.get_num_tokens(sample_text)
+            if n_tokens > 0:
+                paso = LLM_TOKEN_CALIBRATION_STEP
+                _LLM_CHARS_PER_TOKEN_CALIBRATED = max(paso, math.floor(len(sample_text) / n_tokens / paso) * paso) if paso > 0 else len(sample_text) / n_tokens
+                logging.info(f"Contador de tokens LLM calibrado: {_LLM_CHARS_PER_TOKEN_CALIBRATED:.2f} caracteres/token ({n_tokens} tokens de muestra).")
+                if calibration_path:
+                    calibraciones[key] = _LLM_CHARS_PER_TOKEN_CALIBRATED
+                    tmp_path = f"{calibration_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f: json.dump(calibraciones, f, indent=2)
+                    os.replace(tmp_path, calibration_path)
+        except Exception as e: logging.warning(f"No se pudo calibrar el contador de tokens del LLM ({e}). Se usa {LLM_CHARS_PER_TOKEN} caracteres/token.")
+    return _LLM_CHARS_PER_TOKEN_CALIBRATED or LLM_CHARS_PER_TOKEN
+
+def count_llm_tokens(text: str) -> int:
+    return int(len(text) / (_LLM_CHARS_PER_TOKEN_CALIBRATED or LLM_CHARS_PER_TOKEN)) + 1
+
+def estimate_llm_tokens(prompt_template: PromptTemplate, inputs: dict) -> int:
+    return count_llm_tokens(prompt_template.template) + sum(count_llm_tokens(v) for v in inputs.values() if isinstance(v, str)) + LLM_OUTPUT_TOKENS_RESERVE
+
+def _prepare_llm_inputs(prompt_template: PromptTemplate, inputs: dict, task_description: str) -> str | None:
+    # Devuelve un mensaje si la llamada no debe hacerse (contexto vacío, variables faltantes); None si puede seguir
+    context_keys = ["context", "contexto_completo_analisis", "resumenes_hallazgos_competidores", "informe_competidor", "resumenes_grupo"]
     relevant_context_present = False
     for key in context_keys:
         if key in inputs and isinstance(inputs[key], str) and inputs[key].strip(): # Asegurarse que es string
@@ -480,335 +2235,891 @@ def run_llm_chain(llm, prompt_template: PromptTemplate, inputs: dict, task_descr
     if missing_vars:
         logging.error(f"Error para {task_description}: Faltan variables en input para PromptTemplate: {missing_vars}. Esperadas: {prompt_template.input_variables}. Recibidas: {list(inputs.keys())}")
         return f"Error de configuración de Prompt: Faltan variables {missing_vars} para la tarea '{task_description}'."
+    return None
 
-    chain = prompt_template | llm | StrOutputParser()
-    approx_chars = 0
-    for v_key, v_val in inputs.items():
-        if isinstance(v_val, str):
-            approx_chars += len(v_val)
-
-    logging.info(f"Enviando al LLM para: {task_description} (aprox. {approx_chars} chars)...")
-    try:
-        response_content = chain.invoke(inputs)
-        return response_content
-    except KeyError as ke:
-        logging.error(f"KeyError específico durante chain.invoke para {task_description}: {ke}", exc_info=True)
+def _llm_error_message(e: Exception, task_description: str, approx_chars: int) -> str:
+    if isinstance(e, KeyError):
+        logging.error(f"KeyError específico durante chain.invoke para {task_description}: {e}", exc_info=True)
         key_arg = "No disponible"
-        if ke.args: key_arg = ke.args[0]
+        if e.args: key_arg = e.args[0]
         logging.error(f"Argumento del KeyError (clave problemática si está disponible): {key_arg}")
         # El mensaje de error de Langchain ya es bastante descriptivo
-        return f"Error LLM (KeyError en invoke) para {task_description}. Detalle: {str(ke)}. Verifique las variables del prompt y las claves en `inputs`. Clave problemática podría ser: '{key_arg}'. Ver logs."
-    except Exception as e:
-        logging.error(f"Error en LLM para {task_description}. Tipo: {type(e).__name__}, Mensaje: {str(e)[:500]}", exc_info=True)
-        error_str = str(e).lower()
-        if "rate limit" in error_str or "quota" in error_str or "429" in error_str or "resource_exhausted" in error_str:
-             return f"Error de API (Rate limit/Cuota) para {task_description}. Considera aumentar pausas o revisar cuotas de Gemini."
-        if "context length" in error_str or "request payload" in error_str or "token" in error_str:
-             return f"Error: Contexto demasiado largo para {task_description} (aprox. {approx_chars} chars). El modelo no puede procesar esta cantidad de información."
-        if "candidate" in error_str and "blocked" in error_str:
-             block_reason = "razón desconocida"
-             if "safety" in error_str: block_reason = "SAFETY"
-             if "recitation" in error_str: block_reason = "RECITATION"
-             logging.warning(f"Respuesta bloqueada por Gemini ({block_reason}) para {task_description}. Contenido del error: {str(e)}")
-             return f"Respuesta de Gemini bloqueada (Razón: {block_reason}) para {task_description}. Esto puede ocurrir si el contenido se parece a datos de entrenamiento o es percibido como no seguro. Revisa los logs."
-        if "unknown field for part: thought" in error_str:
-            return f"Error específico de Gemini (Unknown field for Part: thought) para {task_description}. Revisa versiones de librerías o la estructura del prompt/respuesta."
-        return f"Error LLM para {task_description} (Tipo: {type(e).__name__}. Ver logs para detalle)."
+        return f"Error LLM (KeyError en invoke) para {task_description}. Detalle: {str(e)}. Verifique las variables del prompt y las claves en `inputs`. Clave problemática podría ser: '{key_arg}'. Ver logs."
+    logging.error(f"Error en LLM para {task_description}. Tipo: {type(e).__name__}, Mensaje: {str(e)[:500]}", exc_info=True)
+    error_str = str(e).lower()
+    if _is_quota_error(e):
+         return f"Error de API (Rate limit/Cuota) para {task_description} tras {LLM_MAX_RETRIES} reintentos. Considera reducir LLM_REQUESTS_PER_MINUTE/LLM_TOKENS_PER_MINUTE o revisar cuotas de Gemini."
+    if "context length" in error_str or "request payload" in error_str or "token" in error_str:
+         return f"Error: Contexto demasiado largo para {task_description} (aprox. {approx_chars} chars). El modelo no puede procesar esta cantidad de información."
+    if "candidate" in error_str and "blocked" in error_str:
+         block_reason = "razón desconocida"
+         if "safety" in error_str: block_reason = "SAFETY"
+         if "recitation" in error_str: block_reason = "RECITATION"
+         logging.warning(f"Respuesta bloqueada por Gemini ({block_reason}) para {task_description}. Contenido del error: {str(e)}")
+         return f"Respuesta de Gemini bloqueada (Razón: {block_reason}) para {task_description}. Esto puede ocurrir si el contenido se parece a datos de entrenamiento o es percibido como no seguro. Revisa los logs."
+    if "unknown field for part: thought" in error_str:
+        return f"Error específico de Gemini (Unknown field for Part: thought) para {task_description}. Revisa versiones de librerías o la estructura del prompt/respuesta."
+    return f"Error LLM para {task_description} (Tipo: {type(e).__name__}. Ver logs para detalle)."
+
+# --- CACHÉ PERSISTENTE DE RESPUESTAS DEL LLM ---
+class LLMResponseCache:
+    # Solo se guardan respuestas correctas (los errores nunca se cachean); expulsión LRU por tamaño total
+    def __init__(self, db_path: str, max_bytes: int = LLM_CACHE_MAX_MB * 1024 * 1024):
+        self.db_path, self.max_bytes = db_path, max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, task TEXT, response TEXT NOT NULL, size INTEGER NOT NULL, created REAL, last_access REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+
+    @staticmethod
+    def make_key(llm, prompt_template: PromptTemplate, inputs: dict) -> str:
+        model = getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__
+        template_hash = hashlib.sha256(prompt_template.template.encode("utf-8")).hexdigest()
+        inputs_hash = hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model}\x00{getattr(llm, 'temperature', None)}\x00{template_hash}\x00{inputs_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None: self.misses += 1; return None
+            with self._conn: self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str, model: str = None, task: str = None) -> None:
+        size = len(response.encode("utf-8"))
+        with self._lock, self._conn:
+            now = time.time()
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", (key, model, task, response, size, now, now))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Se expulsan las entradas menos usadas recientemente hasta volver bajo el límite
+                for old_key, old_size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+                    if total <= self.max_bytes or old_key == key: break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (old_key,)); total -= old_size
+
+    def stats(self) -> dict:
+        with self._lock:
+            n, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": n, "bytes": total}
+
+    def log_stats(self) -> None:
+        st = self.stats()
+        if st["hits"] + st["misses"]:
+            logging.info(f"Caché LLM: {st['hits']} aciertos, {st['misses']} fallos ({st['hit_rate']:.0%}), {st['entries']} entradas, {st['bytes'] / 1e6:.1f} MB.")
+
+_LLM_CACHE = None
+
+def get_llm_cache() -> LLMResponseCache | None:
+    global _LLM_CACHE
+    if _LLM_CACHE is None and LLM_CACHE_PATH:
+        try:
+            _LLM_CACHE = LLMResponseCache(LLM_CACHE_PATH)
+            atexit.register(_LLM_CACHE.log_stats)
+        except Exception as e: logging.warning(f"Caché de respuestas LLM no disponible ({e}).")
+    return _LLM_CACHE
+
+def echo_llm_chunk(text: str) -> None:
+    print(text, end="", flush=True)
+
+def _stream_llm_response(chain, inputs: dict, task_description: str, on_chunk: Callable[[str], None], partes: list[str]) -> str:
+    # Acumula en `partes` los fragmentos de chain.stream; on_chunk recibe cada fragmento en cuanto llega
+    t0 = time.monotonic()
+    for parte in chain.stream(inputs):
+        if not partes:
+            logging.info(f"Primer fragmento de respuesta para {task_description} en {time.monotonic() - t0:.1f}s.")
+            current_span().set(first_chunk_seconds=round(time.monotonic() - t0, 3))
+        partes.append(parte); on_chunk(parte)
+    return "".join(partes)
+
+@traced("llm_call")
+def run_llm_chain(llm, prompt_template: PromptTemplate, inputs: dict, task_description: str, limiter: LLMRateLimiter = None, on_chunk: Callable[[str], None] = None) -> str:
+    # on_chunk: con LLM_STREAMING recibe la respuesta por fragmentos (si llega de caché, de una vez)
+    span = current_span()
+    span.set(task=task_description)
+    early_result = _prepare_llm_inputs(prompt_template, inputs, task_description)
+    if early_result is not None: span.set(outcome="skipped"); return early_result
+
+    cache = get_llm_cache()
+    cache_key = LLMResponseCache.make_key(llm, prompt_template, inputs) if cache else None
+    if cache and not LLM_CACHE_BYPASS:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Respuesta LLM recuperada de caché para: {task_description}.")
+            span.set(outcome="ok", cache_hit=True, response_tokens=count_llm_tokens(cached))
+            if on_chunk: on_chunk(cached)
+            return cached
 
-# =========================================
-# EJECUCIÓN PRINCIPAL
-# =========================================
-if __name__ == "__main__":
+    chain = prompt_template | llm | StrOutputParser()
+    approx_chars = sum(len(v) for v in inputs.values() if isinstance(v, str))
+    limiter = limiter or LLM_RATE_LIMITER
+    estimated_tokens = estimate_llm_tokens(prompt_template, inputs)
+    span.set(cache_hit=False, prompt_chars=approx_chars, prompt_tokens=estimated_tokens - LLM_OUTPUT_TOKENS_RESERVE) # Tokens según count_llm_tokens (calibrado)
+
+    logging.info(f"Enviando al LLM para: {task_description} (aprox. {approx_chars} chars)...")
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        span.set(retries=attempt)
+        waited = limiter.acquire(estimated_tokens)
+        if waited > 0:
+            logging.info(f"Límite de tasa LLM: {waited:.1f}s de espera antes de '{task_description}'.")
+            span.add("rate_limit_wait_seconds", round(waited, 3))
+        partes = []
+        try:
+            if LLM_STREAMING and on_chunk: response = _stream_llm_response(chain, inputs, task_description, on_chunk, partes)
+            else: response = chain.invoke(inputs)
+        except Exception as e:
+            if attempt < LLM_MAX_RETRIES and _is_retryable_llm_error(e):
+                delay = llm_backoff_delay(attempt, e)
+                if partes: on_chunk(f"\n[... respuesta interrumpida ({type(e).__name__}); se reintenta ...]\n")
+                logging.warning(f"Error transitorio/cuota en LLM para {task_description} ({type(e).__name__}). Reintento {attempt + 1}/{LLM_MAX_RETRIES} en {delay:.1f}s.")
+                span.add("backoff_seconds", round(delay, 3))
+                time.sleep(delay); continue
+            span.set(outcome="error", error=type(e).__name__)
+            return _llm_error_message(e, task_description, approx_chars)
+        if cache and isinstance(response, str) and response.strip():
+            try: cache.put(cache_key, response, getattr(llm, "model", None), task_description)
+            except Exception as e_cache: logging.warning(f"No se pudo guardar la respuesta en la caché LLM: {e_cache}")
+        span.set(outcome="ok", response_tokens=count_llm_tokens(response) if isinstance(response, str) else None)
+        return response
+
+async def arun_llm_chain(llm, prompt_template: PromptTemplate, inputs: dict, task_description: str, semaphore: asyncio.Semaphore = None) -> str:
+    # La llamada bloqueante (reintentos y esperas del limitador incluidos) se ejecuta en un hilo; el semáforo acota la concurrencia
+    if semaphore is None: return await asyncio.to_thread(run_llm_chain, llm, prompt_template, inputs, task_description)
+    async with semaphore: return await asyncio.to_thread(run_llm_chain, llm, prompt_template, inputs, task_description)
+
+async def _arun_llm_chains(llm, jobs: list[tuple[PromptTemplate, dict, str]], max_concurrency: int, on_result: Callable[[int, str], None] = None) -> list[str]:
+    # Un hilo por llamada en vuelo: el executor por defecto (min(32, CPUs + 4) hilos) limitaría la concurrencia en máquinas pequeñas
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="llm"))
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    async def _run(i: int, prompt: PromptTemplate, inputs: dict, desc: str) -> str:
+        response = await arun_llm_chain(llm, prompt, inputs, desc, semaphore)
+        if on_result is not None: on_result(i, response) # En el hilo del bucle, en orden de finalización: debe ser rápido
+        return response
+    return await asyncio.gather(*(_run(i, prompt, inputs, desc) for i, (prompt, inputs, desc) in enumerate(jobs)))
+
+@traced("llm_batch")
+def run_llm_chains_concurrently(llm, jobs: list[tuple[PromptTemplate, dict, str]], max_concurrency: int = LLM_MAX_CONCURRENCY, on_result: Callable[[int, str], None] = None) -> list[str]:
+    # jobs: [(prompt, inputs, descripción)] -> respuestas en el mismo orden; on_result(índice, respuesta) se avisa según terminan
+    if not jobs: return []
+    current_span().set(jobs=len(jobs))
+    t0 = time.monotonic()
+    results = asyncio.run(_arun_llm_chains(llm, jobs, max_concurrency, on_result))
+    logging.info(f"{len(jobs)} llamadas LLM completadas en {time.monotonic() - t0:.1f}s (concurrencia={max_concurrency}, RPM={LLM_REQUESTS_PER_MINUTE}).")
+    return results
+
+# --- EMPAQUETADO DE CONTEXTO POR PRESUPUESTO DE TOKENS (solapamientos, MMR, relevancia) ---
+def _chunk_position(doc: Document) -> tuple[str, int] | None:
+    # chunk_id = "{source}:{hash}:{n}" -> (source:hash, n): permite saber si dos chunks son contiguos
+    prefix, _, n = str(doc.metadata.get("chunk_id", "")).rpartition(":")
+    return (prefix, int(n)) if prefix and n.isdigit() else None
+
+def _overlap_length(previous: str, current: str, min_chars: int = CONTEXT_MIN_OVERLAP_CHARS) -> int:
+    # Longitud del mayor sufijo de `previous` que es prefijo de `current` (el chunk_overlap del splitter)
+    if len(current) < min_chars: return 0
+    probe, start = current[:min_chars], max(0, len(previous) - len(current))
+    while (idx := previous.find(probe, start)) != -1:
+        if current.startswith(previous[idx:]): return len(previous) - idx
+        start = idx + 1
+    return 0
+
+def trim_chunk_overlaps(docs: list[Document]) -> list[Document]:
+    # Recorta el texto repetido entre chunks contiguos del mismo PDF y descarta los chunks contenidos en otro
+    por_posicion = {pos: d for d in docs if (pos := _chunk_position(d))}
+    result = []
+    for doc in docs:
+        content, pos = doc.page_content, _chunk_position(doc)
+        anterior = por_posicion.get((pos[0], pos[1] - 1)) if pos else None
+        if anterior is not None:
+            n = _overlap_length(anterior.page_content, content)
+            if n: content = content[n:].lstrip()
+        if len(content) < CONTEXT_MIN_OVERLAP_CHARS or any(content in other.page_content for other in result if other.metadata.get("source") == doc.metadata.get("source")): continue
+        result.append(doc if content == doc.page_content else Document(page_content=content, metadata={**doc.metadata, "overlap_trimmed": True}))
+    return result
+
+def mmr_order(query_vector: np.ndarray, doc_vectors: np.ndarray, lambda_mult: float = CONTEXT_MMR_LAMBDA) -> list[int]:
+    # Orden completo por Maximal Marginal Relevance (vectores normalizados -> producto escalar = coseno)
+    q = query_vector / (np.linalg.norm(query_vector) or 1.0)
+    d = doc_vectors / np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12)
+    relevance, similarity = d @ q, d @ d.T
+    selected, remaining, max_sim = [], list(range(len(d))), np.zeros(len(d), dtype=np.float32)
+    while remaining:
+        scores = lambda_mult * relevance[remaining] - (1 - lambda_mult) * max_sim[remaining]
+        best = remaining.pop(int(np.argmax(scores)))
+        selected.append(best)
+        max_sim = np.maximum(max_sim, similarity[best])
+    return selected
+
+_RE_SENTENCE_END = re.compile(r'(?<=[.;!?])\s+(?=\S)')
+
+def _split_compression_units(doc: Document) -> tuple[str, list[str], str]:
+    # (cabecera fija, unidades puntuables, pie fijo). En tablas la cabecera incluye contexto y encabezado Markdown y las
+    # unidades son filas; en texto, frases (o ventanas de palabras si no hay puntuación)
+    content = doc.page_content
+    if doc.metadata.get("is_table") and _TABLE_START in content and _TABLE_END in content:
+        prefix, rest = content.split(_TABLE_START, 1)
+        body, suffix = rest.split(_TABLE_END, 1)
+        lines = [l for l in body.strip("\n").split("\n") if l.strip()]
+        return f"{prefix.rstrip()}\n\n{_TABLE_START}\n" + "\n".join(lines[:2]), lines[2:], f"{_TABLE_END}{suffix.rstrip()}"
+    units = []
+    for sentence in _RE_SENTENCE_END.split(content):
+        words = sentence.split()
+        units.extend(" ".join(words[i:i + CONTEXT_COMPRESSION_MAX_UNIT_WORDS]) for i in range(0, len(words), CONTEXT_COMPRESSION_MAX_UNIT_WORDS))
+    return "", units, ""
+
+def compress_chunks(docs: list[Document], query: str, aspectos: str, embeddings: Embeddings, keep_ratio: float = CONTEXT_COMPRESSION_KEEP_RATIO,
+                    min_similarity: float = CONTEXT_COMPRESSION_MIN_SIMILARITY) -> list[Document]:
+    # Puntúa cada frase/fila contra la query y los aspectos con el modelo de embeddings local (un solo encode por lotes)
+    # y conserva las mejores hasta `keep_ratio` del texto. Metadatos (fuente/página) intactos; el orden original se mantiene.
+    partes = [_split_compression_units(d) for d in docs]
+    unidades = [(i, j, u) for i, (_, units, _) in enumerate(partes) for j, u in enumerate(units)]
+    if len(unidades) < 2: return docs
+    vectors = embed_texts(embeddings, [query, aspectos] + [u for _, _, u in unidades])
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scores = (vectors[2:] @ vectors[:2].T).max(axis=1)
+    total_chars, kept_chars, keep = sum(len(u) for _, _, u in unidades), 0, set()
+    for k in np.argsort(-scores):
+        if kept_chars >= keep_ratio * total_chars and scores[k] < min_similarity: break
+        keep.add(int(k)); kept_chars += len(unidades[k][2])
+    result, k = [], 0
+    for doc, (header, units, footer) in zip(docs, partes):
+        if not units: result.append(doc); continue
+        seleccion, anterior = [], -2
+        for j, unit in enumerate(units):
+            if k + j in keep:
+                if not header and seleccion and j != anterior + 1: seleccion.append("[...]")
+                seleccion.append(unit); anterior = j
+        k += len(units)
+        if not seleccion: continue
+        content = "\n".join([header, *seleccion, footer]) if header else " ".join(seleccion)
+        result.append(Document(page_content=content, metadata={**doc.metadata, "compressed": True}))
+    logging.info(f"Compresión extractiva: {len(keep)}/{len(unidades)} unidades, {kept_chars}/{total_chars} caracteres, {len(result)}/{len(docs)} chunks.")
+    return result
+
+def format_context_chunk(doc: Document) -> str:
+    return f"{format_source_reference(doc.metadata)}\n{doc.page_content}"
+
+def pack_context(docs: list[Document], query: str, embeddings: Embeddings, token_budget: int, count_tokens: Callable[[str], int] = None,
+                 separator: str = "\n\n---\n\n") -> str:
+    # Sin solapamientos, ordenados por MMR y añadidos mientras quepan en el presupuesto (se saltan los que no caben)
+    count_tokens = count_tokens or count_llm_tokens
+    docs = trim_chunk_overlaps(docs)
+    if not docs or token_budget <= 0: return ""
+    orden = list(range(len(docs)))
+    if len(docs) > 1 and embeddings is not None:
+        try:
+            vectors = embed_texts(embeddings, [query] + [d.page_content for d in docs])
+            orden = mmr_order(vectors[0], vectors[1:])
+        except Exception as e: logging.warning(f"MMR no disponible ({e}); se usa el orden de relevancia de la búsqueda.")
+    partes, usados, sep_tokens = [], 0, count_tokens(separator)
+    for i in orden:
+        texto = format_context_chunk(docs[i])
+        coste = count_tokens(texto) + (sep_tokens if partes else 0)
+        if usados + coste > token_budget: continue
+        partes.append(texto); usados += coste
+    if len(partes) < len(docs): logging.info(f"Contexto empaquetado: {len(partes)}/{len(docs)} chunks, ~{usados}/{token_budget} tokens.")
+    return separator.join(partes)
+
+def fit_sections_to_budget(sections: list[str], token_budget: int, count_tokens: Callable[[str], int] = None) -> list[str]:
+    # Reparto equitativo del presupuesto (water-filling): las secciones cortas se conservan enteras y las largas se
+    # recortan en un límite de párrafo/línea hasta su cuota
+    count_tokens = count_tokens or count_llm_tokens
+    sizes = [count_tokens(s) for s in sections]
+    if sum(sizes) <= token_budget: return sections
+    cuotas, restante, pendientes = [0] * len(sections), token_budget, sorted(range(len(sections)), key=lambda i: sizes[i])
+    while pendientes:
+        cuota = restante // len(pendientes)
+        i = pendientes.pop(0)
+        cuotas[i] = min(sizes[i], cuota); restante -= cuotas[i]
+    result = []
+    for section, size, cuota in zip(sections, sizes, cuotas):
+        if size <= cuota: result.append(section); continue
+        corte = int(len(section) * cuota / max(size, 1))
+        limite = max(section.rfind("\n", 0, corte), section.rfind(". ", 0, corte))
+        result.append(section[:limite if limite > corte // 2 else corte].rstrip() + "\n\n... (SECCIÓN RECORTADA POR PRESUPUESTO DE TOKENS)")
+    logging.warning(f"Contexto de {sum(sizes)} tokens recortado a ~{token_budget} tokens ({sum(1 for s, c in zip(sizes, cuotas) if s > c)} sección(es) recortada(s)).")
+    return result
+
+# --- PIPELINE COMO GRAFO DE ETAPAS CON ARTEFACTOS PERSISTENTES Y REANUDACIÓN ---
+# extract -> chunk -> index -> retrieve (competidor, parámetro) -> analyze (competidor, parámetro) -> individual_report (competidor) -> digest (competidor) -> global_conclusion (reduce por grupos)
+# Extracción (caché por hash de PDF) y chunking/indexado (manifiesto + versiones del índice) ya persisten su salida; el resto de
+# etapas guarda un artefacto JSON cuya clave es el hash de sus entradas, incluidas las claves de las etapas de las que depende.
+# Al reanudar solo se re-ejecuta lo que está aguas abajo de una entrada modificada.
+_LLM_FAILURE_MARKERS = ("Error LLM", "Error de API", "Error de configuración de Prompt", "Respuesta de Gemini bloqueada", "Error: Contexto demasiado largo", "No se proporcionó contexto válido")
+
+def artifact_key(stage: str, inputs: dict) -> str:
+    payload = json.dumps({"stage": stage, "version": PIPELINE_ARTIFACTS_VERSION, "inputs": inputs}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+
+def is_llm_failure(text: str) -> bool:
+    return any(marker in text for marker in _LLM_FAILURE_MARKERS)
+
+def llm_fingerprint(llm) -> dict:
+    return {"model": getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__, "temperature": getattr(llm, "temperature", None)}
+
+class ArtifactStore:
+    # Un archivo JSON por (etapa, clave); escritura atómica para que una ejecución interrumpida no deje artefactos a medias
+    def __init__(self, root: str, resume: bool = PIPELINE_RESUME):
+        self.root, self.resume = root, resume
+        self.reused, self.computed, self.used = {}, {}, {}
+        self._lock = threading.Lock() # Contadores compartidos entre el bucle de análisis y los hilos de informes
+
+    def _path(self, stage: str, key: str) -> str:
+        return os.path.join(self.root, stage, f"{key}.json")
+
+    def get(self, stage: str, key: str):
+        if not self.root or not self.resume or not os.path.exists(self._path(stage, key)): return None
+        try:
+            with open(self._path(stage, key), "r", encoding="utf-8") as f: value = json.load(f)["value"]
+        except Exception as e:
+            logging.warning(f"Artefacto ilegible ({stage}/{key[:12]}): {e}. Se recalculará."); return None
+        with self._lock: self.reused[stage] = self.reused.get(stage, 0) + 1; self.used.setdefault(stage, set()).add(key)
+        current_span().add("artifacts_reused")
+        return value
+
+    def put(self, stage: str, key: str, value, meta: dict = None) -> None:
+        with self._lock: self.computed[stage] = self.computed.get(stage, 0) + 1; self.used.setdefault(stage, set()).add(key)
+        current_span().add("artifacts_computed")
+        if not self.root: return
+        path = self._path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stage": stage, "key": key, "created": time.strftime('%Y-%m-%d %H:%M:%S'), "meta": meta or {}, "value": value}, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+
+    def prune(self, keep: int = PIPELINE_ARTIFACTS_KEEP_VERSIONS) -> int:
+        # Artefactos superados (entradas, plantillas o modelo cambiaron y la clave es otra): por etapa y elemento (sus
+        # metadatos: fuente, parámetro...) se conservan los usados en esta ejecución y las `keep` versiones más recientes,
+        # como prune_faiss_versions con las versiones del índice
+        if not self.root or keep is None or not os.path.isdir(self.root): return 0
+        removed = 0
+        for stage in os.listdir(self.root):
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir): continue
+            slots = {}
+            for name in os.listdir(stage_dir):
+                if not name.endswith(".json"): continue
+                path = os.path.join(stage_dir, name)
+                try:
+                    with open(path, "r", encoding="utf-8") as f: meta = json.load(f).get("meta") or {}
+                except Exception: continue # Ilegible: get() ya lo trata como ausente
+                slots.setdefault(json.dumps(meta, sort_keys=True, default=str), []).append((os.path.getmtime(path), name[:-len(".json")], path))
+            for entries in slots.values():
+                superseded = [e for e in sorted(entries, reverse=True) if e[1] not in self.used.get(stage, ())][keep:]
+                for _, key, path in superseded:
+                    try: os.remove(path); removed += 1
+                    except OSError as e: logging.warning(f"No se pudo borrar el artefacto superado {stage}/{key[:12]}: {e}")
+        if removed: logging.info(f"Artefactos: {removed} versión(es) superada(s) eliminada(s).")
+        return removed
+
+    def log_summary(self) -> None:
+        for stage in sorted(set(self.reused) | set(self.computed)):
+            logging.info(f"Etapa '{stage}': {self.reused.get(stage, 0)} artefacto(s) reutilizado(s), {self.computed.get(stage, 0)} calculado(s).")
+
+def discover_input_pdfs() -> list[str] | None:
+    # Devuelve los PDFs de competidores (lista posiblemente vacía) o None si falta la carpeta o el PDF propio
     if not os.path.isdir(FOLDER_INPUT_PDFS):
         logging.critical(f"La carpeta de PDFs de entrada '{FOLDER_INPUT_PDFS}' no existe. Saliendo.")
-        exit(1)
+        return None
 
     todos_los_pdfs_en_carpeta = [f for f in os.listdir(FOLDER_INPUT_PDFS) if f.lower().endswith('.pdf')]
 
     if PDF_NUESTRO_BANCO_FILENAME not in todos_los_pdfs_en_carpeta:
         logging.critical(f"El PDF de nuestro banco '{PDF_NUESTRO_BANCO_FILENAME}' no se encontró en '{FOLDER_INPUT_PDFS}'. Saliendo.")
-        exit(1)
+        return None
 
-    LISTA_PDFS_COMPETIDORES = [pdf for pdf in todos_los_pdfs_en_carpeta if pdf != PDF_NUESTRO_BANCO_FILENAME]
+    lista_pdfs_competidores = [pdf for pdf in todos_los_pdfs_en_carpeta if pdf != PDF_NUESTRO_BANCO_FILENAME]
 
-    if not LISTA_PDFS_COMPETIDORES:
+    if not lista_pdfs_competidores:
         logging.warning("No se encontraron PDFs de competidores en la carpeta. El análisis comparativo no se realizará.")
     else:
-        logging.info(f"PDFs de competidores encontrados: {', '.join(LISTA_PDFS_COMPETIDORES)}")
-
-    pdfs_a_indexar_y_validar = list(set([PDF_NUESTRO_BANCO_FILENAME] + LISTA_PDFS_COMPETIDORES))
-
-    try: embedder = LocalEmbeddings(model_name="all-MiniLM-L6-v2")
-    except Exception: logging.critical(f"Fallo inicializando embeddings. Saliendo."); exit(1)
-
+        logging.info(f"PDFs de competidores encontrados: {', '.join(lista_pdfs_competidores)}")
+    return lista_pdfs_competidores
+
+def compute_pdf_hashes(fnames: list[str]) -> dict[str, str]:
+    # Hash de contenido por PDF: determina qué PDFs deben re-embeberse en la actualización incremental
+    pdf_hashes = {}
+    for fname in fnames:
+        try: pdf_hashes[fname] = compute_file_hash(os.path.join(FOLDER_INPUT_PDFS, fname))
+        except OSError as e: logging.error(f"No se pudo calcular el hash de {fname}: {e}")
+    return pdf_hashes
+
+@traced("stage:index")
+def stage_index(embedder: LocalEmbeddings, pdfs_a_indexar_y_validar: list[str], pdf_hashes: dict, rebuild: bool = REBUILD_FAISS_INDEX) -> FAISS | None:
+    # Etapas extract -> chunk -> index: carga, actualización incremental o reconstrucción del índice FAISS
     vector_store = None
-    # Lógica de carga/reconstrucción del índice FAISS
-    if not REBUILD_FAISS_INDEX and os.path.exists(FAISS_INDEX_PATH) and os.listdir(FAISS_INDEX_PATH):
+    if not rebuild and os.path.exists(FAISS_INDEX_PATH) and os.listdir(FAISS_INDEX_PATH):
         try:
             logging.info(f"Intentando cargar índice FAISS desde {FAISS_INDEX_PATH}...")
-            vector_store = FAISS.load_local(FAISS_INDEX_PATH, embedder, allow_dangerous_deserialization=True)
+            vector_store = load_faiss_vectorstore(FAISS_INDEX_PATH, embedder)
             if not (vector_store and hasattr(vector_store, 'index') and vector_store.index and vector_store.index.ntotal > 0):
                  logging.warning(f"Índice cargado desde {FAISS_INDEX_PATH} está vacío o inválido. Se marcará para reconstrucción.")
-                 REBUILD_FAISS_INDEX = True 
+                 rebuild = True 
                  vector_store = None 
             else:
                  logging.info(f"Índice FAISS cargado exitosamente desde {FAISS_INDEX_PATH} con {vector_store.index.ntotal} vectores.")
         except Exception as e:
             logging.warning(f"Error cargando índice FAISS existente desde {FAISS_INDEX_PATH} ({e}). Se marcará para reconstrucción.")
-            REBUILD_FAISS_INDEX = True 
+            rebuild = True 
             vector_store = None 
     
-    if REBUILD_FAISS_INDEX: # Si se necesita reconstruir (ya sea por la variable o porque la carga falló)
+    # Actualización incremental: solo se re-embeben los PDFs nuevos/modificados según el manifiesto de hashes
+    if rebuild and INCREMENTAL_FAISS_UPDATE and os.path.exists(os.path.join(resolve_faiss_index_dir(FAISS_INDEX_PATH), FAISS_MANIFEST_FILENAME)):
+        try:
+            pdfs_sin_hash = [f for f in pdfs_a_indexar_y_validar if f not in pdf_hashes]
+            if pdfs_sin_hash: logging.warning(f"Se conservan en el índice los vectores de {len(pdfs_sin_hash)} PDF(s) sin hash: {', '.join(pdfs_sin_hash)}")
+            pdfs_a_reindexar, pdfs_a_eliminar = diff_pdf_manifest(load_faiss_manifest(FAISS_INDEX_PATH), pdf_hashes, pdfs_sin_hash)
+            if not pdfs_a_reindexar and not pdfs_a_eliminar:
+                vector_store = load_faiss_vectorstore(FAISS_INDEX_PATH, embedder)
+                logging.info(f"Índice FAISS en {FAISS_INDEX_PATH} ya está al día con los PDFs de entrada ({vector_store.index.ntotal} vectores).")
+            elif pdfs_a_eliminar and not faiss_index_supports_removal(load_faiss_index_file(resolve_faiss_index_dir(FAISS_INDEX_PATH))):
+                logging.warning(f"El índice FAISS ('{FAISS_INDEX_FACTORY}') no es Flat y no admite eliminar los vectores de {len(pdfs_a_eliminar)} PDF(s) retirados/modificados. Se reconstruirá completo.")
+            else:
+                logging.info(f"Actualización incremental del índice: {len(pdfs_a_reindexar)} PDF(s) a indexar, {len(pdfs_a_eliminar)} a eliminar.")
+                # Los PDFs nuevos se deduplican entre sí (no contra los chunks ya indexados de los PDFs sin cambios)
+                dedup = ChunkDeduplicator() if DEDUP_CHUNKS else None
+                chunks_nuevos = iter_index_chunks(pdfs_a_reindexar, embedder, pdf_hashes, deduplicator=dedup) # Generador: se embeben por lotes
+                vector_store = update_faiss_index_incremental(embedder, chunks_nuevos, FAISS_INDEX_PATH, pdf_hashes, pdfs_a_eliminar, deduplicator=dedup)
+            if vector_store is not None and vector_store.index.ntotal > 0:
+                rebuild = False # Índice sincronizado; no hace falta la reconstrucción completa
+            elif vector_store is not None:
+                logging.warning("El índice quedó vacío tras la actualización incremental. Se reconstruirá completo.")
+                vector_store = None
+        except Exception as e:
+            logging.warning(f"Falló la actualización incremental del índice ({e}). Se reconstruirá completo.", exc_info=True)
+            vector_store = None
+
+    if rebuild and not pdfs_a_indexar_y_validar:
+        logging.critical(f"No hay PDFs para indexar. No se puede construir el índice.")
+        return None
+    if rebuild and INGESTION_STREAMING: # Reconstrucción completa en streaming (memoria acotada por INGESTION_BATCH_SIZE)
+        logging.info(f"Iniciando (re)construcción en streaming del índice FAISS en {FAISS_INDEX_PATH}...")
+        try:
+            dedup = ChunkDeduplicator() if DEDUP_CHUNKS else None
+            vector_store = build_faiss_index_streaming(iter_index_chunks(pdfs_a_indexar_y_validar, embedder, pdf_hashes, deduplicator=dedup), embedder, FAISS_INDEX_PATH, pdf_hashes, deduplicator=dedup)
+            logging.info(f"Índice FAISS (re)construido y disponible con {vector_store.index.ntotal} vectores.")
+        except Exception as e: logging.critical(f"Error crítico construyendo/guardando índice FAISS: {e}.", exc_info=True); return None
+    elif rebuild: # Si se necesita reconstruir (ya sea por la variable o porque la carga falló)
         logging.info(f"Iniciando (re)construcción del índice FAISS en {FAISS_INDEX_PATH}...")
         all_docs_for_processing = []
-        if not pdfs_a_indexar_y_validar:
-            logging.critical(f"No hay PDFs para indexar. No se puede construir el índice. Saliendo.")
-            exit(1)
+        for docs_pdf in load_pdfs_documents(pdfs_a_indexar_y_validar, pdf_hashes=pdf_hashes).values():
+            all_docs_for_processing.extend(docs_pdf)
 
-        for fname in pdfs_a_indexar_y_validar:
-            full_path = os.path.join(FOLDER_INPUT_PDFS, fname)
-            logging.info(f"\n--- Procesando para índice: {fname} ---")
-            try:
-                loader = PyPDFLoader(full_path)
-                pages = loader.load()
-                current_page_docs = [Document(page_content=p.page_content, metadata={"source": fname, "page": p.metadata.get("page", i) + 1, "is_table": False}) for i, p in enumerate(pages)]
-                all_docs_for_processing.extend(current_page_docs)
-                logging.info(f"Texto cargado de {fname} ({len(current_page_docs)} págs).")
-                
-                table_documents = extract_and_format_tables_from_pdf(full_path, pages="all")
-                all_docs_for_processing.extend(table_documents)
-                logging.info(f"{len(table_documents)} tablas procesadas de {fname}.")
-            except Exception as e: logging.error(f"Error procesando PDF {full_path}: {e}", exc_info=True)
-
-        if not all_docs_for_processing: logging.critical("No se cargaron documentos para el índice. Saliendo."); exit(1)
+        if not all_docs_for_processing: logging.critical("No se cargaron documentos para el índice."); return None
         
         clean_docs = preprocess_documents(all_docs_for_processing)
-        if not clean_docs: logging.critical("No hay documentos después de la limpieza. Saliendo."); exit(1)
+        if not clean_docs: logging.critical("No hay documentos después de la limpieza."); return None
         
-        chunked_docs = chunk_documents(clean_docs, chunk_size=1800, chunk_overlap=200) 
-        if not chunked_docs: logging.critical("No se generaron chunks. Saliendo."); exit(1)
+        chunked_docs = chunk_documents(clean_docs, count_tokens=embedder.count_tokens)
+        if not chunked_docs: logging.critical("No se generaron chunks."); return None
+        if DEDUP_CHUNKS: chunked_docs = deduplicate_chunks(chunked_docs)
+
+        if embedder.backend != "torch" and EMBEDDING_PARITY_SAMPLE > 0:
+            paso = max(1, len(chunked_docs) // EMBEDDING_PARITY_SAMPLE)
+            try: check_embedding_parity([d.page_content for d in chunked_docs[::paso][:EMBEDDING_PARITY_SAMPLE]], embedder)
+            except Exception as e: logging.warning(f"No se pudo medir la paridad de embeddings: {e}")
         
         try:
-            # La función build_or_load_faiss_index ahora maneja la reconstrucción si REBUILD_FAISS_INDEX es True
-            vector_store = build_or_load_faiss_index(documents=chunked_docs, embeddings=embedder, persist_path=FAISS_INDEX_PATH)
+            vector_store = build_or_load_faiss_index(documents=chunked_docs, embeddings=embedder, persist_path=FAISS_INDEX_PATH, pdf_hashes=pdf_hashes)
             if vector_store and hasattr(vector_store, 'index') and vector_store.index and vector_store.index.ntotal > 0:
                  logging.info(f"Índice FAISS (re)construido y disponible con {vector_store.index.ntotal} vectores.")
-                 # No es necesario cambiar REBUILD_FAISS_INDEX aquí, se hará al inicio de la próxima ejecución si es False
             else:
-                 logging.critical("Falló la construcción del índice FAISS o el índice está vacío post-construcción. Saliendo.")
-                 exit(1)
-        except Exception as e: logging.critical(f"Error crítico construyendo/guardando índice FAISS: {e}. Saliendo.", exc_info=True); exit(1)
+                 logging.critical("Falló la construcción del índice FAISS o el índice está vacío post-construcción.")
+                 return None
+        except Exception as e: logging.critical(f"Error crítico construyendo/guardando índice FAISS: {e}.", exc_info=True); return None
+    return vector_store
+
+def index_artifact_key(embedder: LocalEmbeddings) -> str:
+    # El contenido del índice queda determinado por el manifiesto (hash y chunks de cada PDF) y la configuración de chunking/embeddings
+    settings = {"chunk_size": CHUNK_SIZE_TOKENS, "chunk_overlap": CHUNK_OVERLAP_TOKENS, "dedup": [DEDUP_CHUNKS, DEDUP_SIMILARITY_THRESHOLD, DEDUP_NUM_PERM, DEDUP_SHINGLE_SIZE],
+                "embeddings": embedder.cache_namespace, "extraction": extraction_settings_fingerprint(), "factory": FAISS_INDEX_FACTORY}
+    return artifact_key("index", {"manifest": load_faiss_manifest(FAISS_INDEX_PATH), "settings": settings})
+
+@traced("stage:retrieve")
+def stage_retrieve(store: ArtifactStore, vector_store: FAISS, index_key: str, pdfs_competidores: list[str], k: int) -> dict[tuple[str, str], tuple[list[Document], str]]:
+    # (competidor, parámetro) -> (chunks recuperados, clave del artefacto); solo se buscan los que no están persistidos
+    search_settings = {"k": k, "nprobe": FAISS_IVF_NPROBE, "ef_search": FAISS_HNSW_EF_SEARCH}
+    plan = plan_retrieval(pdfs_competidores, PARAMETROS_CLAVE)
+    results, pendientes = {}, []
+    for item in plan:
+        key = artifact_key("retrieve", {"index": index_key, "item": item, "search": search_settings})
+        hits = store.get("retrieve", key)
+        if hits is None: pendientes.append((item, key)); continue
+        results[(item["source"], item["nombre_parametro"])] = ([Document(page_content=h["page_content"], metadata=h["metadata"]) for h in hits], key)
+    if pendientes:
+        recuperados = execute_retrieval_plan([item for item, _ in pendientes], vector_store, k)
+        for item, key in pendientes:
+            hits = recuperados.get((item["source"], item["nombre_parametro"]), [])
+            store.put("retrieve", key, [{"page_content": d.page_content, "metadata": d.metadata, "score": float(score)} for d, score in hits],
+                      {"source": item["source"], "parametro": item["nombre_parametro"]})
+            results[(item["source"], item["nombre_parametro"])] = ([d for d, _ in hits], key)
+    return results
+
+def build_analysis_inputs(pdf_banco_externo_actual: str, param_info: dict, chunks_be: list[Document], table_store: TableStore = None,
+                          embeddings: Embeddings = None, token_budget: int = LLM_CONTEXT_BUDGET_ANALISIS) -> dict:
+    nombre_p = param_info["nombre_parametro"]
+    ctx_tablas = ""
+    if table_store and param_info.get("terminos_tabla"):
+        ctx_tablas = format_table_lookup_context(lookup_table_values(table_store, param_info["terminos_tabla"], source=pdf_banco_externo_actual))
+        if ctx_tablas: ctx_tablas = f"[DATOS TABULARES ESTRUCTURADOS (extraídos directamente de las tablas del informe)]\n{ctx_tablas}"
+    ctx_be_llm = ""
+    if chunks_be:
+        query = retrieval_query(pdf_banco_externo_actual, param_info)
+        if CONTEXT_COMPRESSION_ENABLED and embeddings is not None:
+            try: chunks_be = compress_chunks(trim_chunk_overlaps(chunks_be), query, param_info["aspectos_parametro"], embeddings)
+            except Exception as e: logging.warning(f"Compresión extractiva no aplicada para '{nombre_p}' ({e}).")
+        ctx_be_llm = pack_context(chunks_be, query, embeddings, token_budget - count_llm_tokens(ctx_tablas))
+    else:
+         logging.warning(f"No se recuperaron chunks para '{nombre_p}' de '{pdf_banco_externo_actual}'. El LLM lo indicará.")
+    if ctx_tablas: ctx_be_llm = f"{ctx_tablas}\n\n---\n\n{ctx_be_llm}"
+
+    # Inputs para PROMPT_EXTRACCION_CAMBIOS_BE
+    return {
+        "context": ctx_be_llm, 
+        "nombre_parametro": nombre_p,
+        "aspectos_a_buscar_en_cambios": param_info["aspectos_parametro"],
+        "nombre_banco_externo_prompt": competitor_display_name(pdf_banco_externo_actual)
+    }
+
+@traced("stage:analyze")
+def stage_analyze(store: ArtifactStore, llm, pdfs_competidores: list[str], recuperacion: dict, table_store: TableStore = None, embeddings: Embeddings = None,
+                  on_competitor_done: Callable[[str, dict], None] = None) -> dict[tuple[str, str], tuple[str, str]]:
+    # (competidor, parámetro) -> (análisis, clave). Las llamadas pendientes se lanzan concurrentemente; los errores no se persisten.
+    # on_competitor_done(competidor, resultados) se avisa en cuanto están todos los análisis de ese competidor (no al final del lote)
+    results, trabajos, pendientes = {}, [], []
+    restantes = {pdf: 0 for pdf in pdfs_competidores}
+    for pdf_banco_externo_actual in pdfs_competidores:
+        for param_info in PARAMETROS_CLAVE:
+            nombre_p = param_info["nombre_parametro"]
+            chunks_be, retrieve_key = recuperacion.get((pdf_banco_externo_actual, nombre_p), ([], None))
+            inputs_extraccion_be = build_analysis_inputs(pdf_banco_externo_actual, param_info, chunks_be, table_store, embeddings)
+            key = artifact_key("analyze", {"retrieve": retrieve_key, "inputs": inputs_extraccion_be, "template": text_hash(PROMPT_EXTRACCION_CAMBIOS_BE.template), "llm": llm_fingerprint(llm)})
+            analisis = store.get("analyze", key)
+            if analisis is not None: results[(pdf_banco_externo_actual, nombre_p)] = (analisis, key); continue
+            print(f"--- B.1. Analizando metodología y cambios en '{pdf_banco_externo_actual}' para '{nombre_p}' ---")
+            trabajos.append((PROMPT_EXTRACCION_CAMBIOS_BE, inputs_extraccion_be, f"analizar {pdf_banco_externo_actual} para {nombre_p}"))
+            pendientes.append(((pdf_banco_externo_actual, nombre_p), key)); restantes[pdf_banco_externo_actual] += 1
+
+    def _analysis_done(i: int, analisis: str) -> None:
+        clave, key = pendientes[i]
+        if not is_llm_failure(analisis): store.put("analyze", key, analisis, {"source": clave[0], "parametro": clave[1]})
+        results[clave] = (analisis, key); restantes[clave[0]] -= 1
+        if restantes[clave[0]] == 0 and on_competitor_done is not None: on_competitor_done(clave[0], results)
+
+    if on_competitor_done is not None:
+        for pdf in pdfs_competidores:
+            if restantes[pdf] == 0: on_competitor_done(pdf, results) # Todo reanudado desde artefactos
+    run_llm_chains_concurrently(llm, trabajos, on_result=_analysis_done)
+    return results
+
+def generate_individual_report(llm, pdf_banco_externo_actual: str, resultados_por_parametro_lista_actual: list[dict]) -> str:
+    nombre_banco_externo_actual_prompt = competitor_display_name(pdf_banco_externo_actual)
+    contexto_completo_analisis_para_informe = f"**Contexto de Referencia - Metodologías de {NOMBRE_NUESTRO_BANCO_PROMPT} (Archivo: {PDF_NUESTRO_BANCO_FILENAME}):**\n"
+    contexto_completo_analisis_para_informe += "*Nota: La descripción detallada de la metodología de Credicorp por parámetro se ha omitido en esta pasada para enfocar el análisis en el competidor. El LLM debe centrarse en el análisis del banco externo.*\n"
+    
+    contexto_completo_analisis_para_informe += "\n\n**===============================================**\n"
+    contexto_completo_analisis_para_informe += f"**ANÁLISIS PRINCIPAL - Metodologías y Cambios en {nombre_banco_externo_actual_prompt} (Archivo: {pdf_banco_externo_actual}) (Generado con explicaciones de conceptos):**\n"
+    # Presupuesto de tokens repartido entre los análisis por parámetro (ninguno se pierde por un corte al final)
+    presupuesto_analisis = LLM_CONTEXT_BUDGET_INFORME - count_llm_tokens(contexto_completo_analisis_para_informe) - count_llm_tokens(PROMPT_INFORME_COMPETIDOR.template)
+    for analisis_txt in fit_sections_to_budget([res['analisis_banco_externo_detallado'] for res in resultados_por_parametro_lista_actual], presupuesto_analisis):
+        contexto_completo_analisis_para_informe += f"\n{analisis_txt}\n" 
+    contexto_completo_analisis_para_informe += "---\n"
+    
+    debug_informe_context_filename = f"contexto_informe_v11_FINAL_COMPETIDOR_{nombre_banco_externo_actual_prompt.replace(' ', '_')}_debug.txt"
+    with open(debug_informe_context_filename, "w", encoding="utf-8") as f_debug:
+        f_debug.write(contexto_completo_analisis_para_informe)
+    logging.info(f"Contexto para informe individual ({nombre_banco_externo_actual_prompt}) guardado en: {debug_informe_context_filename}")
+
+    print(f"\n--- D. GENERANDO INFORME DE BENCHMARKING INDIVIDUAL PARA {nombre_banco_externo_actual_prompt} ---")
+
+    contexto_final_para_informe_llm = contexto_completo_analisis_para_informe
+    informe_benchmark_individual_texto_error_base = (
+        f"## Análisis Comparativo: {NOMBRE_NUESTRO_BANCO_PROMPT} vs. {nombre_banco_externo_actual_prompt}\n"
+        f"*(Basado en el archivo del competidor: {pdf_banco_externo_actual})*\n\n"
+    )
+
+    context_has_errors = any("Error LLM" in res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual) or \
+                         any("Error de configuración de Prompt" in res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual) or \
+                         any("Respuesta de Gemini bloqueada" in res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual) or \
+                         len(contexto_final_para_informe_llm.strip()) < 200
     
+    if context_has_errors:
+        error_details_from_params = [res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual if "Error LLM" in res["analisis_banco_externo_detallado"] or "Respuesta de Gemini bloqueada" in res["analisis_banco_externo_detallado"] or "Error de configuración de Prompt" in res["analisis_banco_externo_detallado"]]
+        informe_benchmark_individual_texto = informe_benchmark_individual_texto_error_base + \
+                                          (f"**Error Crítico:** No se pudo generar el informe detallado para {nombre_banco_externo_actual_prompt} porque el análisis por parámetros previo para este competidor resultó en uno o más errores, o no produjo contenido útil.\n"
+                                           f"Detalles del error en parámetros (primeros errores): {' | '.join(error_details_from_params[:2])}'\n" # Mostrar hasta 2 errores para brevedad
+                                           f"Por favor, revise los logs anteriores correspondientes a las llamadas 'PROMPT_EXTRACCION_CAMBIOS_BE' para cada parámetro de {nombre_banco_externo_actual_prompt} y el archivo de debug '{debug_informe_context_filename}'.\n")
+    elif llm:
+        inputs_informe_competidor = {
+            "contexto_completo_analisis": contexto_final_para_informe_llm,
+            "pdf_nuestro_banco": PDF_NUESTRO_BANCO_FILENAME,
+            "pdf_banco_externo": pdf_banco_externo_actual,
+            "nombre_nuestro_banco_prompt": NOMBRE_NUESTRO_BANCO_PROMPT,
+            "nombre_banco_externo_prompt": nombre_banco_externo_actual_prompt
+        }
+        informe_benchmark_individual_texto = run_llm_chain(
+            llm,
+            PROMPT_INFORME_COMPETIDOR,
+            inputs_informe_competidor,
+            f"generar informe benchmark individual para {nombre_banco_externo_actual_prompt}",
+            on_chunk=echo_llm_chunk
+        )
+        print()
+        if "Error LLM" in informe_benchmark_individual_texto or "Respuesta de Gemini bloqueada" in informe_benchmark_individual_texto or "Error:" in informe_benchmark_individual_texto or "Error de configuración de Prompt" in informe_benchmark_individual_texto:
+            informe_benchmark_individual_texto = informe_benchmark_individual_texto_error_base + \
+                                          (f"**Error al generar el resumen del informe para {nombre_banco_externo_actual_prompt}:** {informe_benchmark_individual_texto}\n"
+                                           f"Esto ocurrió al intentar resumir y estructurar el análisis por parámetros del competidor.\n"
+                                           f"El contexto enviado al LLM para este resumen tenía aproximadamente {len(contexto_final_para_informe_llm)} caracteres. "
+                                           f"Se recomienda revisar el archivo de debug: '{debug_informe_context_filename}' y los logs del script para más detalles.\n")
+    else:
+         informe_benchmark_individual_texto = informe_benchmark_individual_texto_error_base + \
+                                           f"**Error Crítico:** LLM no disponible para generar el informe de {nombre_banco_externo_actual_prompt}.\n"
+    return informe_benchmark_individual_texto
+
+def is_failed_report(informe: str) -> bool:
+    return "Error Crítico:" in informe or "Error al generar" in informe or "Error LLM" in informe or "Error de configuración de Prompt" in informe
+
+@traced("stage:individual_report")
+def stage_individual_report(store: ArtifactStore, llm, pdf_banco_externo_actual: str, analisis: dict) -> tuple[str, str]:
+    resultados_por_parametro_lista_actual, analyze_keys = [], []
+    for param_info in PARAMETROS_CLAVE:
+        nombre_p = param_info["nombre_parametro"]
+        texto, analyze_key = analisis[(pdf_banco_externo_actual, nombre_p)]
+        met_nb_txt = f"### Descripción Contextual de la Metodología de '{NOMBRE_NUESTRO_BANCO_PROMPT}' para {nombre_p}\n*Nota: El análisis detallado de {NOMBRE_NUESTRO_BANCO_PROMPT} no se genera en este paso para enfocar en el competidor. Se asume conocimiento interno o se puede generar por separado.*\n"
+        resultados_por_parametro_lista_actual.append({
+            "parametro": nombre_p,
+            "metodologia_nuestro_banco_contexto": met_nb_txt,
+            "analisis_banco_externo_detallado": texto
+        })
+        analyze_keys.append(analyze_key if not is_llm_failure(texto) else text_hash(texto))
+    key = artifact_key("individual_report", {"source": pdf_banco_externo_actual, "analyze": analyze_keys, "template": text_hash(PROMPT_INFORME_COMPETIDOR.template), "llm": llm_fingerprint(llm)})
+    informe = store.get("individual_report", key)
+    if informe is not None:
+        logging.info(f"Informe individual de {pdf_banco_externo_actual} reutilizado de artefacto.")
+        return informe, key
+    informe = generate_individual_report(llm, pdf_banco_externo_actual, resultados_por_parametro_lista_actual)
+    if not is_failed_report(informe): store.put("individual_report", key, informe, {"source": pdf_banco_externo_actual})
+    return informe, key
+
+def group_by_token_budget(texts: list[str], token_budget: int, count_tokens: Callable[[str], int] = None) -> list[list[str]]:
+    # Grupos consecutivos cuyo tamaño total no supera el presupuesto (un texto que no cabe solo forma su propio grupo)
+    count_tokens = count_tokens or count_llm_tokens
+    grupos, actual, usados = [], [], 0
+    for text in texts:
+        n = count_tokens(text)
+        if actual and usados + n > token_budget: grupos.append(actual); actual, usados = [], 0
+        actual.append(text); usados += n
+    if actual: grupos.append(actual)
+    return grupos
+
+def reduce_digests(llm, digests: list[str], token_budget: int = CONCLUSION_REDUCE_GROUP_TOKENS) -> list[str]:
+    # Fusiona por niveles hasta que todos los resúmenes quepan juntos en el presupuesto; cada nivel se lanza en paralelo
+    nivel = 0
+    while len(digests) > 1 and sum(count_llm_tokens(d) for d in digests) > token_budget:
+        grupos = group_by_token_budget(digests, token_budget)
+        if all(len(g) == 1 for g in grupos): break # Ningún par cabe junto: se recorta al final
+        nivel += 1
+        trabajos = [(PROMPT_FUSION_RESUMENES, {"resumenes_grupo": "\n\n".join(g), "nombre_nuestro_banco_prompt": NOMBRE_NUESTRO_BANCO_PROMPT, "max_palabras": CONCLUSION_DIGEST_MAX_WORDS},
+                     f"fusionar {len(g)} resúmenes de hallazgos (nivel {nivel})") for g in grupos if len(g) > 1]
+        fusionados = iter(run_llm_chains_concurrently(llm, trabajos))
+        siguiente = []
+        for g in grupos:
+            if len(g) == 1: siguiente.append(g[0]); continue
+            fusion = next(fusionados)
+            siguiente.extend(g if is_llm_failure(fusion) else [fusion]) # Si la fusión falla se conservan los resúmenes originales
+        if len(siguiente) >= len(digests): break
+        logging.info(f"Reduce nivel {nivel}: {len(digests)} -> {len(siguiente)} resúmenes.")
+        digests = siguiente
+    return fit_sections_to_budget(digests, token_budget)
+
+def generate_global_conclusion(llm, digests: list[str], nombres_competidores_analizados_lista: list[str]) -> str:
+    conclusion_global_texto = f"## CONCLUSIONES GLOBALES Y RECOMENDACIONES ESTRATÉGICAS AGREGADAS\n*Error: No se pudo generar la conclusión global y recomendaciones agregadas. Verificar logs.*"
+
+    if digests and llm:
+        inputs_conclusion_global = {
+            "resumenes_hallazgos_competidores": "\n\n".join(reduce_digests(llm, digests)),
+            "nombre_nuestro_banco_prompt": NOMBRE_NUESTRO_BANCO_PROMPT,
+            "lista_nombres_competidores": ", ".join(nombres_competidores_analizados_lista)
+        }
+        conclusion_global_texto = run_llm_chain(
+            llm,
+            PROMPT_CONCLUSION_GLOBAL, 
+            inputs_conclusion_global,
+            "generar conclusión global y recomendaciones agregadas",
+            on_chunk=echo_llm_chunk
+        )
+        print()
+        if is_llm_failure(conclusion_global_texto):
+             conclusion_global_texto = (f"## CONCLUSIONES GLOBALES Y RECOMENDACIONES ESTRATÉGICAS AGREGADAS\n"
+                                        f"*Error al generar la conclusión global y recomendaciones agregadas. Mensaje del LLM: {conclusion_global_texto}*\n"
+                                        f"*Esto ocurrió a pesar de tener algunos informes individuales aparentemente válidos. Revise los logs.*\n")
+    elif not digests:
+        conclusion_global_texto = (f"## CONCLUSIONES GLOBALES Y RECOMENDACIONES ESTRATÉGICAS AGREGADAS\n"
+                                   f"*No se pudo generar una conclusión global significativa ya que todos los análisis individuales de los competidores resultaron en errores críticos o no se pudieron procesar correctamente.*\n"
+                                   f"*Por favor, revise los errores detallados en cada sección de análisis de competidor anterior y los logs del script.*\n")
+    return conclusion_global_texto
+
+@traced("stage:digest")
+def stage_digest(store: ArtifactStore, llm, lista_informes_individuales_md: list[str], report_keys: list[str], nombres_competidores_analizados_lista: list[str]) -> tuple[list[str], list[str]]:
+    # Map: un resumen de hallazgos por informe individual válido, en paralelo. Devuelve (resúmenes, claves) en el orden de los informes
+    digests, keys, trabajos, pendientes = {}, {}, [], []
+    for i, (informe, report_key, nombre) in enumerate(zip(lista_informes_individuales_md, report_keys, nombres_competidores_analizados_lista)):
+        if is_failed_report(informe): continue
+        keys[i] = artifact_key("digest", {"report": report_key, "template": text_hash(PROMPT_RESUMEN_HALLAZGOS.template), "max_palabras": CONCLUSION_DIGEST_MAX_WORDS, "llm": llm_fingerprint(llm)})
+        digest = store.get("digest", keys[i])
+        if digest is not None: digests[i] = digest; continue
+        trabajos.append((PROMPT_RESUMEN_HALLAZGOS, {"informe_competidor": informe, "nombre_banco_externo_prompt": nombre, "nombre_nuestro_banco_prompt": NOMBRE_NUESTRO_BANCO_PROMPT,
+                                                    "max_palabras": CONCLUSION_DIGEST_MAX_WORDS}, f"resumir hallazgos del informe de {nombre}"))
+        pendientes.append(i)
+    for i, digest in zip(pendientes, run_llm_chains_concurrently(llm, trabajos) if trabajos else []):
+        if is_llm_failure(digest):
+            # Sin resumen, el informe entra recortado a la cuota de un resumen para no perder al competidor
+            logging.warning(f"No se pudo resumir el informe de {nombres_competidores_analizados_lista[i]}; se usará el informe recortado.")
+            digests[i] = fit_sections_to_budget([lista_informes_individuales_md[i]], CONCLUSION_DIGEST_MAX_TOKENS)[0]
+            keys[i] = text_hash(digests[i])
+        else:
+            store.put("digest", keys[i], digest, {"competidor": nombres_competidores_analizados_lista[i]}); digests[i] = digest
+    orden = sorted(digests)
+    return [digests[i] for i in orden], [keys[i] for i in orden]
+
+@traced("stage:global_conclusion")
+def stage_global_conclusion(store: ArtifactStore, llm, lista_informes_individuales_md: list[str], report_keys: list[str], nombres_competidores_analizados_lista: list[str]) -> str:
+    digests, digest_keys = stage_digest(store, llm, lista_informes_individuales_md, report_keys, nombres_competidores_analizados_lista)
+    key = artifact_key("global_conclusion", {"digests": digest_keys, "competidores": nombres_competidores_analizados_lista, "reduce_tokens": CONCLUSION_REDUCE_GROUP_TOKENS,
+                                             "templates": [text_hash(p.template) for p in (PROMPT_FUSION_RESUMENES, PROMPT_CONCLUSION_GLOBAL)], "llm": llm_fingerprint(llm)})
+    conclusion = store.get("global_conclusion", key)
+    if conclusion is not None:
+        logging.info("Conclusión global reutilizada de artefacto."); return conclusion
+    conclusion = generate_global_conclusion(llm, digests, nombres_competidores_analizados_lista)
+    # Sin resúmenes o sin LLM el texto es un aviso, no una conclusión; un fallo del LLM queda citado en el texto envolvente
+    if digests and llm and not is_llm_failure(conclusion): store.put("global_conclusion", key, conclusion)
+    return conclusion
+
+def consolidated_report_path() -> str:
+    safe_nb_name = NOMBRE_NUESTRO_BANCO_PROMPT.replace(" ", "_").replace("/","_").replace("\\","_")
+    return f"Informe_Consolidado_Benchmark_{safe_nb_name}_{time.strftime('%Y%m%d_%H%M%S')}.md"
+
+def consolidated_report_header(nombres_competidores_analizados_lista: list[str]) -> str:
+    documento_final_md = f"# INFORME CONSOLIDADO DE BENCHMARKING METODOLÓGICO IFRS 9\n\n"
+    documento_final_md += f"## Para: Comité de Riesgos de {NOMBRE_NUESTRO_BANCO_PROMPT}\n"
+    documento_final_md += f"**Fecha de Generación:** {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+    documento_final_md += "## Introducción\n"
+    intro_competidores = ", ".join(nombres_competidores_analizados_lista) if nombres_competidores_analizados_lista else 'N/A (No se procesaron competidores)'
+    documento_final_md += (
+        f"Este informe presenta un análisis de benchmarking de las metodologías de riesgo crediticio bajo IFRS 9. "
+        f"El objetivo principal es identificar prácticas destacadas en bancos competidores ({intro_competidores}) "
+        f"que puedan inspirar oportunidades de mejora y refinamiento en las metodologías de **{NOMBRE_NUESTRO_BANCO_PROMPT}**. "
+        f"Se busca fortalecer la gestión de riesgos y la robustez de los modelos en nuestra entidad.\n\n"
+        "Cada competidor ha sido analizado individualmente. Los hallazgos detallados (o errores en su procesamiento) se presentan a continuación, seguidos de una conclusión global y recomendaciones estratégicas agregadas para Credicorp.\n\n"
+    )
+    documento_final_md += "---\n"
+    return documento_final_md
+
+class ReportWriter:
+    # Informe consolidado escrito de forma incremental: cada sección se añade (append + fsync) en cuanto está lista,
+    # así se puede leer mientras avanza la ejecución y una caída tardía no pierde las secciones ya terminadas.
+    # Las secciones llegan desde varios hilos (informes por competidor en paralelo): el lock evita que se entremezclen
+    def __init__(self, path: str):
+        self.path, self.sections, self.t0 = path, 0, time.monotonic()
+        self._lock = threading.Lock()
+        open(self.path, "w", encoding="utf-8").close()
+
+    def append(self, text: str, is_section: bool = True) -> None:
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(text); f.flush(); os.fsync(f.fileno())
+            if not is_section: return
+            self.sections += 1
+            if self.sections == 1: logging.info(f"Primera sección del informe consolidado escrita en {time.monotonic() - self.t0:.1f}s: {self.path}")
+
+    def close(self) -> str:
+        logging.info(f"Informe consolidado final guardado en: {self.path} ({self.sections} secciones, {time.monotonic() - self.t0:.1f}s)")
+        print(f"\n--- INFORME CONSOLIDADO FINAL GUARDADO EN: {self.path} ---")
+        return self.path
+
+def write_individual_report(writer: ReportWriter, store: ArtifactStore, llm, pdf_banco_externo_actual: str, analisis: dict) -> tuple[str, str]:
+    nombre_banco_externo_actual_prompt = competitor_display_name(pdf_banco_externo_actual)
+    print(f"\n\n=======================================================================")
+    print(f"--- INFORME: {NOMBRE_NUESTRO_BANCO_PROMPT} vs. {nombre_banco_externo_actual_prompt} (Archivo Externo: {pdf_banco_externo_actual}) ---")
+    print("=======================================================================")
+    informe, key = stage_individual_report(store, llm, pdf_banco_externo_actual, analisis)
+    writer.append(informe + "\n\n---\n\n")
+    print(f"--- INFORME INDIVIDUAL GENERADO (O ERROR REGISTRADO) PARA {nombre_banco_externo_actual_prompt} ---")
+    logging.info(f"===== ANÁLISIS COMPLETADO PARA {pdf_banco_externo_actual} =====")
+    return informe, key
+
+@traced("pipeline")
+def run_pipeline() -> None:
+    LISTA_PDFS_COMPETIDORES = discover_input_pdfs()
+    if LISTA_PDFS_COMPETIDORES is None: exit(1)
+    pdfs_a_indexar_y_validar = sorted(set([PDF_NUESTRO_BANCO_FILENAME] + LISTA_PDFS_COMPETIDORES)) # Orden fijo: índice reproducible
+    output_path = consolidated_report_path()
+    logging.info(f"El informe consolidado se irá escribiendo por secciones en: {output_path}")
+
+    try: embedder = LocalEmbeddings(model_name="all-MiniLM-L6-v2")
+    except Exception: logging.critical(f"Fallo inicializando embeddings. Saliendo."); exit(1)
+
+    pdf_hashes = compute_pdf_hashes(pdfs_a_indexar_y_validar)
+    vector_store = stage_index(embedder, pdfs_a_indexar_y_validar, pdf_hashes)
     if not vector_store: # Si después de toda la lógica, vector_store sigue siendo None
         logging.critical(f"Vector Store no pudo ser cargado ni construido. Verifique la ruta del índice '{FAISS_INDEX_PATH}' y los PDFs. Saliendo.")
         exit(1)
 
     llm = None
     try:
-        llm = initialize_llm(provider="google", model_name="gemini-1.5-flash-latest", temperature=0.15)
+        llm = initialize_llm(provider=LLM_PROVIDER, model_name=LLM_MODEL_NAME, temperature=0.15)
     except Exception as e:
         logging.error(f"Fallo CRÍTICO al inicializar LLM. Saliendo. Error: {e}")
         exit(1)
 
-    lista_informes_individuales_md = []
-    nombres_competidores_analizados_lista = [] 
-
-    if llm and vector_store and hasattr(vector_store, 'index') and vector_store.index and vector_store.index.ntotal > 0:
-      if not LISTA_PDFS_COMPETIDORES:
-          logging.info("No hay PDFs de competidores para analizar. Finalizando el script.")
-      else:
-        for pdf_banco_externo_actual in LISTA_PDFS_COMPETIDORES:
-            nombre_banco_externo_actual_prompt = os.path.splitext(pdf_banco_externo_actual)[0].replace("_", " ").replace("-", " ").title()
-            nombres_competidores_analizados_lista.append(nombre_banco_externo_actual_prompt)
-
-            print(f"\n\n=======================================================================")
-            print(f"--- INICIANDO ANÁLISIS: {NOMBRE_NUESTRO_BANCO_PROMPT} vs. {nombre_banco_externo_actual_prompt} ---")
-            print(f"--- (Archivo Externo: {pdf_banco_externo_actual}) ---")
-            print("=======================================================================")
-
-            resultados_por_parametro_lista_actual = []
-            K_VALUE_SEARCH_NB = 7 
-            K_VALUE_SEARCH_BE = 15
-
-            for param_info in PARAMETROS_CLAVE:
-                nombre_p = param_info["nombre_parametro"]
-                # q_nb = param_info["query_rag_nuestro_banco_template"] # No se usa para generar el informe de nuestro banco por parámetro
-                q_be = param_info["query_rag_banco_externo_template"].format(nombre_banco_externo=nombre_banco_externo_actual_prompt)
-                aspectos_p = param_info["aspectos_parametro"]
-                print(f"\n--- PROCESANDO PARÁMETRO: {nombre_p} (para {nombre_banco_externo_actual_prompt}) ---")
-
-                met_nb_txt = f"### Descripción Contextual de la Metodología de '{NOMBRE_NUESTRO_BANCO_PROMPT}' para {nombre_p}\n*Nota: El análisis detallado de {NOMBRE_NUESTRO_BANCO_PROMPT} no se genera en este paso para enfocar en el competidor. Se asume conocimiento interno o se puede generar por separado.*\n"
-                
-                print(f"--- B.1. Analizando metodología y cambios en '{pdf_banco_externo_actual}' para '{nombre_p}' ---")
-                chunks_be = semantic_search_filtered(q_be, vector_store, K_VALUE_SEARCH_BE, pdf_banco_externo_actual)
-                ctx_be_llm = ""
-                if chunks_be:
-                    ctx_be_llm = "\n\n---\n\n".join([f"Fuente: {d.metadata.get('source')}, Página: {d.metadata.get('page')}\n{d.page_content}" for d in chunks_be])
-                else:
-                     logging.warning(f"No se recuperaron chunks para '{nombre_p}' de '{pdf_banco_externo_actual}'. El LLM lo indicará.")
-
-                logging.info(f"Pausa LLM (Análisis BE - {nombre_p})..."); time.sleep(5) 
-                
-                # Inputs para PROMPT_EXTRACCION_CAMBIOS_BE
-                inputs_extraccion_be = {
-                    "context": ctx_be_llm, 
-                    "nombre_parametro": nombre_p,
-                    "aspectos_a_buscar_en_cambios": aspectos_p,
-                    "nombre_banco_externo_prompt": nombre_banco_externo_actual_prompt
-                }
-                analisis_be_txt = run_llm_chain(llm, PROMPT_EXTRACCION_CAMBIOS_BE, 
-                                              inputs_extraccion_be,
-                                              f"analizar {pdf_banco_externo_actual} para {nombre_p}")
-                
-                resultados_por_parametro_lista_actual.append({
-                    "parametro": nombre_p,
-                    "metodologia_nuestro_banco_contexto": met_nb_txt,
-                    "analisis_banco_externo_detallado": analisis_be_txt
-                })
-                print(f"--- FINALIZADO PARÁMETRO: {nombre_p} (para {nombre_banco_externo_actual_prompt}) ---")
-
-            contexto_completo_analisis_para_informe = f"**Contexto de Referencia - Metodologías de {NOMBRE_NUESTRO_BANCO_PROMPT} (Archivo: {PDF_NUESTRO_BANCO_FILENAME}):**\n"
-            contexto_completo_analisis_para_informe += "*Nota: La descripción detallada de la metodología de Credicorp por parámetro se ha omitido en esta pasada para enfocar el análisis en el competidor. El LLM debe centrarse en el análisis del banco externo.*\n"
-            
-            contexto_completo_analisis_para_informe += "\n\n**===============================================**\n"
-            contexto_completo_analisis_para_informe += f"**ANÁLISIS PRINCIPAL - Metodologías y Cambios en {nombre_banco_externo_actual_prompt} (Archivo: {pdf_banco_externo_actual}) (Generado con explicaciones de conceptos):**\n"
-            for res in resultados_por_parametro_lista_actual:
-                contexto_completo_analisis_para_informe += f"\n{res['analisis_banco_externo_detallado']}\n" 
-            contexto_completo_analisis_para_informe += "---\n"
-            
-            debug_informe_context_filename = f"contexto_informe_v11_FINAL_COMPETIDOR_{nombre_banco_externo_actual_prompt.replace(' ', '_')}_debug.txt"
-            with open(debug_informe_context_filename, "w", encoding="utf-8") as f_debug:
-                f_debug.write(contexto_completo_analisis_para_informe)
-            logging.info(f"Contexto para informe individual ({nombre_banco_externo_actual_prompt}) guardado en: {debug_informe_context_filename}")
-
-            print(f"\n--- D. GENERANDO INFORME DE BENCHMARKING INDIVIDUAL PARA {nombre_banco_externo_actual_prompt} ---")
-            logging.info(f"Pausa antes de LLM (Informe Individual para {nombre_banco_externo_actual_prompt})..."); time.sleep(6) 
-
-            max_chars_informe_individual_ctx = 300000 
-            contexto_final_para_informe_llm = contexto_completo_analisis_para_informe
-            
-            if len(contexto_final_para_informe_llm) > max_chars_informe_individual_ctx:
-                logging.warning(f"Contexto para informe individual ({len(contexto_final_para_informe_llm)} chars) excede {max_chars_informe_individual_ctx}. Se truncará.")
-                contexto_final_para_informe_llm = contexto_final_para_informe_llm[:max_chars_informe_individual_ctx - 500] + "\n\n... (CONTEXTO COMPLETO TRUNCADO POR LONGITUD EXCESIVA)"
-            
-            informe_benchmark_individual_texto_error_base = (
-                f"## Análisis Comparativo: {NOMBRE_NUESTRO_BANCO_PROMPT} vs. {nombre_banco_externo_actual_prompt}\n"
-                f"*(Basado en el archivo del competidor: {pdf_banco_externo_actual})*\n\n"
-            )
-
-            context_has_errors = any("Error LLM" in res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual) or \
-                                 any("Error de configuración de Prompt" in res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual) or \
-                                 any("Respuesta de Gemini bloqueada" in res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual) or \
-                                 len(contexto_final_para_informe_llm.strip()) < 200
-            
-            if context_has_errors:
-                error_details_from_params = [res["analisis_banco_externo_detallado"] for res in resultados_por_parametro_lista_actual if "Error LLM" in res["analisis_banco_externo_detallado"] or "Respuesta de Gemini bloqueada" in res["analisis_banco_externo_detallado"] or "Error de configuración de Prompt" in res["analisis_banco_externo_detallado"]]
-                informe_benchmark_individual_texto = informe_benchmark_individual_texto_error_base + \
-                                                  (f"**Error Crítico:** No se pudo generar el informe detallado para {nombre_banco_externo_actual_prompt} porque el análisis por parámetros previo para este competidor resultó en uno o más errores, o no produjo contenido útil.\n"
-                                                   f"Detalles del error en parámetros (primeros errores): {' | '.join(error_details_from_params[:2])}'\n" # Mostrar hasta 2 errores para brevedad
-                                                   f"Por favor, revise los logs anteriores correspondientes a las llamadas 'PROMPT_EXTRACCION_CAMBIOS_BE' para cada parámetro de {nombre_banco_externo_actual_prompt} y el archivo de debug '{debug_informe_context_filename}'.\n")
-            elif llm:
-                inputs_informe_competidor = {
-                    "contexto_completo_analisis": contexto_final_para_informe_llm,
-                    "pdf_nuestro_banco": PDF_NUESTRO_BANCO_FILENAME,
-                    "pdf_banco_externo": pdf_banco_externo_actual,
-                    "nombre_nuestro_banco_prompt": NOMBRE_NUESTRO_BANCO_PROMPT,
-                    "nombre_banco_externo_prompt": nombre_banco_externo_actual_prompt
-                }
-                informe_benchmark_individual_texto = run_llm_chain(
-                    llm,
-                    PROMPT_INFORME_COMPETIDOR,
-                    inputs_informe_competidor,
-                    f"generar informe benchmark individual para {nombre_banco_externo_actual_prompt}"
-                )
-                if "Error LLM" in informe_benchmark_individual_texto or "Respuesta de Gemini bloqueada" in informe_benchmark_individual_texto or "Error:" in informe_benchmark_individual_texto or "Error de configuración de Prompt" in informe_benchmark_individual_texto:
-                    informe_benchmark_individual_texto = informe_benchmark_individual_texto_error_base + \
-                                                  (f"**Error al generar el resumen del informe para {nombre_banco_externo_actual_prompt}:** {informe_benchmark_individual_texto}\n"
-                                                   f"Esto ocurrió al intentar resumir y estructurar el análisis por parámetros del competidor.\n"
-                                                   f"El contexto enviado al LLM para este resumen tenía aproximadamente {len(contexto_final_para_informe_llm)} caracteres. "
-                                                   f"Se recomienda revisar el archivo de debug: '{debug_informe_context_filename}' y los logs del script para más detalles.\n")
-            else:
-                 informe_benchmark_individual_texto = informe_benchmark_individual_texto_error_base + \
-                                                   f"**Error Crítico:** LLM no disponible para generar el informe de {nombre_banco_externo_actual_prompt}.\n"
-
-            lista_informes_individuales_md.append(informe_benchmark_individual_texto)
-            print(f"--- INFORME INDIVIDUAL GENERADO (O ERROR REGISTRADO) PARA {nombre_banco_externo_actual_prompt} ---")
-
-            logging.info(f"===== ANÁLISIS COMPLETADO PARA {pdf_banco_externo_actual} =====")
-            if len(LISTA_PDFS_COMPETIDORES) > 1 and pdf_banco_externo_actual != LISTA_PDFS_COMPETIDORES[-1]:
-                logging.info("Pausa larga antes del siguiente banco externo..."); time.sleep(90)
-
-        # --- Generación del Informe Consolidado Final ---
-        if lista_informes_individuales_md:
-            print(f"\n\n=======================================================================")
-            print(f"--- GENERANDO INFORME CONSOLIDADO FINAL PARA {NOMBRE_NUESTRO_BANCO_PROMPT} ---")
-            print("=======================================================================")
-            
-            placeholder_contexto_conclusion = "Basado en los análisis individuales previamente generados para cada competidor, donde se detallaron sus prácticas y se explicaron conceptos clave."
-
-            logging.info("Pausa antes de LLM (Conclusión Global)..."); time.sleep(7)
-            
-            conclusion_global_texto = f"## CONCLUSIONES GLOBALES Y RECOMENDACIONES ESTRATÉGICAS AGREGADAS\n*Error: No se pudo generar la conclusión global y recomendaciones agregadas. Verificar logs.*"
-            
-            informes_validos_para_conclusion = [
-                informe for informe in lista_informes_individuales_md 
-                if not ("Error Crítico:" in informe or "Error al generar" in informe or "Error LLM" in informe or "Error de configuración de Prompt" in informe)
-            ]
-
-            if informes_validos_para_conclusion and llm:
-                inputs_conclusion_global = {
-                    "textos_informes_individuales_concatenados_placeholder": placeholder_contexto_conclusion,
-                    "nombre_nuestro_banco_prompt": NOMBRE_NUESTRO_BANCO_PROMPT,
-                    "lista_nombres_competidores": ", ".join(nombres_competidores_analizados_lista)
-                }
-                conclusion_global_texto = run_llm_chain(
-                    llm,
-                    PROMPT_CONCLUSION_GLOBAL, 
-                    inputs_conclusion_global,
-                    "generar conclusión global y recomendaciones agregadas"
-                )
-                if "Error LLM" in conclusion_global_texto or "Error:" in conclusion_global_texto or "Error de configuración de Prompt" in conclusion_global_texto:
-                     conclusion_global_texto = (f"## CONCLUSIONES GLOBALES Y RECOMENDACIONES ESTRATÉGICAS AGREGADAS\n"
-                                                f"*Error al generar la conclusión global y recomendaciones agregadas. Mensaje del LLM: {conclusion_global_texto}*\n"
-                                                f"*Esto ocurrió a pesar de tener algunos informes individuales aparentemente válidos. Revise los logs.*\n")
-            elif not informes_validos_para_conclusion:
-                conclusion_global_texto = (f"## CONCLUSIONES GLOBALES Y RECOMENDACIONES ESTRATÉGICAS AGREGADAS\n"
-                                           f"*No se pudo generar una conclusión global significativa ya que todos los análisis individuales de los competidores resultaron en errores críticos o no se pudieron procesar correctamente.*\n"
-                                           f"*Por favor, revise los errores detallados en cada sección de análisis de competidor anterior y los logs del script.*\n")
-
-            documento_final_md = f"# INFORME CONSOLIDADO DE BENCHMARKING METODOLÓGICO IFRS 9\n\n"
-            documento_final_md += f"## Para: Comité de Riesgos de {NOMBRE_NUESTRO_BANCO_PROMPT}\n"
-            documento_final_md += f"**Fecha de Generación:** {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-            documento_final_md += "## Introducción\n"
-            intro_competidores = ", ".join(nombres_competidores_analizados_lista) if nombres_competidores_analizados_lista else 'N/A (No se procesaron competidores)'
-            documento_final_md += (
-                f"Este informe presenta un análisis de benchmarking de las metodologías de riesgo crediticio bajo IFRS 9. "
-                f"El objetivo principal es identificar prácticas destacadas en bancos competidores ({intro_competidores}) "
-                f"que puedan inspirar oportunidades de mejora y refinamiento en las metodologías de **{NOMBRE_NUESTRO_BANCO_PROMPT}**. "
-                f"Se busca fortalecer la gestión de riesgos y la robustez de los modelos en nuestra entidad.\n\n"
-                "Cada competidor ha sido analizado individualmente. Los hallazgos detallados (o errores en su procesamiento) se presentan a continuación, seguidos de una conclusión global y recomendaciones estratégicas agregadas para Credicorp.\n\n"
-            )
-            documento_final_md += "---\n"
-
-            for informe_ind in lista_informes_individuales_md:
-                documento_final_md += informe_ind + "\n\n---\n\n"
-            
-            documento_final_md += conclusion_global_texto
-            
-            safe_nb_name = NOMBRE_NUESTRO_BANCO_PROMPT.replace(" ", "_").replace("/","_").replace("\\","_")
-            output_filename_consolidado_md = f"Informe_Consolidado_Benchmark_{safe_nb_name}_{time.strftime('%Y%m%d_%H%M%S')}.md"
-            with open(output_filename_consolidado_md, "w", encoding="utf-8") as f_out_final:
-                f_out_final.write(documento_final_md)
-            logging.info(f"Informe consolidado final guardado en: {output_filename_consolidado_md}")
-            print(f"\n--- INFORME CONSOLIDADO FINAL GUARDADO EN: {output_filename_consolidado_md} ---")
-        else:
-            logging.info("No se generaron informes individuales de competidores (probablemente debido a que la lista de competidores estaba vacía o todos los análisis fallaron), por lo tanto no se creará un informe consolidado.")
-
-    elif not llm:
-        logging.critical("La inicialización del LLM falló. El análisis no puede continuar.")
-    elif not (vector_store and hasattr(vector_store, 'index') and vector_store.index and vector_store.index.ntotal > 0):
-        logging.critical(f"El Vector Store no está disponible o está vacío. El análisis no puede continuar.")
-    else:
-        logging.warning("LLM o Vector Store no disponibles/vacíos por alguna otra razón no cubierta. Análisis no posible.")
+    if not (vector_store.index and vector_store.index.ntotal > 0):
+        logging.critical(f"El Vector Store no está disponible o está vacío. El análisis no puede continuar."); return
+    if not LISTA_PDFS_COMPETIDORES:
+        logging.info("No hay PDFs de competidores para analizar. Finalizando el script."); return
+
+    nombres_competidores_analizados_lista = [competitor_display_name(pdf) for pdf in LISTA_PDFS_COMPETIDORES]
+    writer = ReportWriter(output_path)
+    writer.append(consolidated_report_header(nombres_competidores_analizados_lista), is_section=False)
+    store = ArtifactStore(PIPELINE_ARTIFACTS_DIR)
+    K_VALUE_SEARCH_BE = 15
+    table_store = None
+    if TABLE_STORE_PATH:
+        try: table_store = TableStore(TABLE_STORE_PATH); sync_table_store(table_store, pdf_hashes)
+        except Exception as e: logging.warning(f"Almacén estructurado de tablas no disponible ({e}). Se continúa solo con búsqueda vectorial."); table_store = None
+
+    # Todas las queries (competidor x parámetro) se embeben y buscan por lotes; las llamadas por parámetro se lanzan concurrentemente
+    recuperacion = stage_retrieve(store, vector_store, index_artifact_key(embedder), LISTA_PDFS_COMPETIDORES, K_VALUE_SEARCH_BE)
+    muestra_calibracion = "\n\n".join(d.page_content for docs, _ in list(recuperacion.values())[:3] for d in docs)[:20000]
+    calibrate_llm_token_counter(llm, muestra_calibracion)
+    # Cada informe individual se genera y se escribe en cuanto terminan los análisis de su competidor, sin esperar al resto del lote
+    informes_futuros = {}
+    with ThreadPoolExecutor(max_workers=max(1, LLM_MAX_CONCURRENCY), thread_name_prefix="informe") as report_pool:
+        def _on_competitor_done(pdf: str, analisis: dict) -> None:
+            informes_futuros[pdf] = report_pool.submit(contextvars.copy_context().run, write_individual_report, writer, store, llm, pdf, analisis)
+        stage_analyze(store, llm, LISTA_PDFS_COMPETIDORES, recuperacion, table_store, embedder, on_competitor_done=_on_competitor_done)
+        informes = [informes_futuros[pdf].result() for pdf in LISTA_PDFS_COMPETIDORES]
+    lista_informes_individuales_md, report_keys = [informe for informe, _ in informes], [key for _, key in informes]
+
+    # --- Generación del Informe Consolidado Final ---
+    print(f"\n\n=======================================================================")
+    print(f"--- GENERANDO INFORME CONSOLIDADO FINAL PARA {NOMBRE_NUESTRO_BANCO_PROMPT} ---")
+    print("=======================================================================")
+    conclusion_global_texto = stage_global_conclusion(store, llm, lista_informes_individuales_md, report_keys, nombres_competidores_analizados_lista)
+    writer.append(conclusion_global_texto)
+    writer.close()
+    store.log_summary()
+    store.prune()
 
-    logging.info("--- SCRIPT FINALIZADO ---")
\ No newline at end of file
+# =========================================
+# EJECUCIÓN PRINCIPAL
+# =========================================
+if __name__ == "__main__":
+    start_tracing()
+    run_pipeline()
+    logging.info("--- SCRIPT FINALIZADO ---")
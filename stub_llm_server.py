@@ -0,0 +1,165 @@
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Servidor local compatible con OpenAI (/v1/chat/completions) para pruebas de carga y resiliencia sin clave de API.
+# Respuestas deterministas (función del prompt) con latencia, tasa de 429, límite de contexto y bloqueos configurables.
+# Uso: python stub_llm_server.py --port 8765 --latency-ms 800 --rate-429 0.1
+#      LLM_PROVIDER=openai_compatible LLM_BASE_URL=http://127.0.0.1:8765/v1 python main.py
+
+CHARS_PER_TOKEN = 4.0 # Misma estimación que main.py para el límite de contexto
+
+class StubConfig:
+    def __init__(self, latency_ms: float = 0.0, latency_jitter_ms: float = 0.0, rate_429: float = 0.0, retry_after_seconds: float = 1.0,
+                 max_context_tokens: int = 1_000_000, blocked_rate: float = 0.0, blocked_keyword: str = None, response_words: int = 120,
+                 stream_chunk_words: int = 8, seed: int = 0):
+        self.latency_ms, self.latency_jitter_ms = latency_ms, latency_jitter_ms
+        self.rate_429, self.retry_after_seconds = rate_429, retry_after_seconds
+        self.max_context_tokens = max_context_tokens
+        self.blocked_rate, self.blocked_keyword = blocked_rate, blocked_keyword
+        self.response_words, self.stream_chunk_words = response_words, stream_chunk_words
+        self.seed = seed
+
+class StubState:
+    # Contadores compartidos entre hilos; el generador aleatorio con semilla hace reproducible la secuencia de fallos
+    def __init__(self, config: StubConfig):
+        self.config, self.lock, self.rng = config, threading.Lock(), random.Random(config.seed)
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "context_exceeded": 0, "blocked": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def draw(self) -> tuple[float, float, float]:
+        with self.lock: return self.rng.random(), self.rng.random(), self.rng.uniform(-1, 1)
+
+    def count(self, key: str, delta: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += delta
+            if key == "in_flight": self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+def deterministic_response(prompt: str, n_words: int) -> str:
+    # Mismo prompt -> misma respuesta; incluye un extracto del prompt para que la salida sea reconocible
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    extracto = " ".join(prompt.split()[:20])
+    palabras = [f"hallazgo_{digest[i % 56:i % 56 + 8]}" for i in range(max(0, n_words - 30))]
+    return f"Respuesta simulada {digest[:12]}. Contexto: {extracto}. " + " ".join(palabras)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive: permite medir el efecto del pool de conexiones del cliente
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send_json(self, status: int, body: dict, headers: dict = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers(); self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, code: str, headers: dict = None) -> None:
+        self._send_json(status, {"error": {"message": message, "type": code, "code": code}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models": self._send_json(200, {"object": "list", "data": [{"id": "stub-llm", "object": "model"}]})
+        elif self.path.rstrip("/") == "/stats":
+            with self.state.lock: self._send_json(200, dict(self.state.stats))
+        else: self._send_error(404, f"Ruta no encontrada: {self.path}", "not_found")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_error(404, f"Ruta no encontrada: {self.path}", "not_found"); return
+        length = int(self.headers.get("Content-Length", 0))
+        try: request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError: self._send_error(400, "JSON inválido", "invalid_request_error"); return
+        state, config = self.state, self.state.config
+        state.count("requests"); state.count("in_flight")
+        try: self._complete(request, state, config)
+        finally: state.count("in_flight", -1)
+
+    def _complete(self, request: dict, state: StubState, config: StubConfig) -> None:
+        r_429, r_blocked, r_jitter = state.draw()
+        time.sleep(max(0.0, config.latency_ms + r_jitter * config.latency_jitter_ms) / 1000)
+        if r_429 < config.rate_429:
+            state.count("rate_limited")
+            self._send_error(429, "Rate limit exceeded: too many requests (RESOURCE_EXHAUSTED).", "rate_limit_exceeded", {"Retry-After": f"{config.retry_after_seconds:g}"}); return
+        prompt = "\n".join(str(m.get("content", "")) for m in request.get("messages", []))
+        prompt_tokens = int(len(prompt) / CHARS_PER_TOKEN) + 1
+        if prompt_tokens > config.max_context_tokens:
+            state.count("context_exceeded")
+            self._send_error(400, f"This model's maximum context length is {config.max_context_tokens} tokens. However, your messages resulted in {prompt_tokens} tokens.", "context_length_exceeded"); return
+        model = request.get("model", "stub-llm")
+        if r_blocked < config.blocked_rate or (config.blocked_keyword and config.blocked_keyword in prompt):
+            state.count("blocked")
+            self._send_completion(request, model, "", "content_filter", prompt_tokens); return
+        texto = deterministic_response(prompt, min(config.response_words, request.get("max_tokens") or config.response_words))
+        state.count("ok")
+        self._send_completion(request, model, texto, "stop", prompt_tokens)
+
+    def _send_completion(self, request: dict, model: str, texto: str, finish_reason: str, prompt_tokens: int) -> None:
+        completion_id = f"chatcmpl-{hashlib.sha256(texto.encode('utf-8')).hexdigest()[:16]}"
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(texto.split()), "total_tokens": prompt_tokens + len(texto.split())}
+        if not request.get("stream"):
+            self._send_json(200, {"id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model, "usage": usage,
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": finish_reason}]})
+            return
+        # Streaming SSE con codificación chunked: un evento cada stream_chunk_words palabras
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        palabras, n = texto.split(" "), max(1, self.state.config.stream_chunk_words)
+        partes = [" ".join(palabras[i:i + n]) + (" " if i + n < len(palabras) else "") for i in range(0, len(palabras), n)] if texto else []
+        for parte in partes:
+            self._write_event({"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {"content": parte}, "finish_reason": None}]})
+        self._write_event({"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        self._write_chunk(b"data: [DONE]\n\n"); self._write_chunk(b"")
+
+    def _write_event(self, event: dict) -> None:
+        self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n"); self.wfile.flush()
+
+def make_server(host: str = "127.0.0.1", port: int = 8765, config: StubConfig = None) -> ThreadingHTTPServer:
+    # port=0 elige un puerto libre (server.server_address[1]); útil para lanzarlo en un hilo desde otro script
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"state": StubState(config or StubConfig())})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_in_thread(host: str = "127.0.0.1", port: int = 0, config: StubConfig = None) -> tuple[ThreadingHTTPServer, str]:
+    server = make_server(host, port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s') # Solo como script: importado no toca el logging del llamante
+    parser = argparse.ArgumentParser(description="Servidor LLM simulado compatible con OpenAI (/v1/chat/completions).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latencia base por petición")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0, help="Variación uniforme +/- sobre la latencia base")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fracción de peticiones que reciben 429 (0-1)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Segundos indicados en la cabecera Retry-After de los 429")
+    parser.add_argument("--max-context-tokens", type=int, default=1_000_000, help="Por encima: 400 context_length_exceeded")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="Fracción de respuestas bloqueadas (finish_reason=content_filter)")
+    parser.add_argument("--blocked-keyword", default=None, help="Bloquear siempre los prompts que contengan este texto")
+    parser.add_argument("--response-words", type=int, default=120, help="Palabras de cada respuesta")
+    parser.add_argument("--stream-chunk-words", type=int, default=8, help="Palabras por evento en modo streaming")
+    parser.add_argument("--seed", type=int, default=0, help="Semilla de la secuencia de 429/bloqueos/latencias")
+    args = parser.parse_args()
+    config = StubConfig(args.latency_ms, args.latency_jitter_ms, args.rate_429, args.retry_after, args.max_context_tokens,
+                        args.blocked_rate, args.blocked_keyword, args.response_words, args.stream_chunk_words, args.seed)
+    server = make_server(args.host, args.port, config)
+    logging.info(f"Servidor LLM simulado en http://{args.host}:{server.server_address[1]}/v1 (latencia={args.latency_ms}ms, 429={args.rate_429:.0%}, bloqueos={args.blocked_rate:.0%}).")
+    try: server.serve_forever()
+    except KeyboardInterrupt: logging.info("Servidor detenido.")
+    finally: server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+class FakeEmbeddings(Embeddings):
+    # Vectores pseudoaleatorios deterministas por texto: sin modelo ni red, y textos distintos -> vectores distintos
+    backend = "torch"
+
+    def __init__(self, dim: int = 32):
+        self.dim = dim
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        rng = lambda t: np.random.default_rng(int.from_bytes(hashlib.sha256(t.encode("utf-8")).digest()[:8], "little"))
+        return [rng(t).standard_normal(self.dim).astype(np.float32).tolist() for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+def make_pdf_docs(source: str, n_pages: int, seed: int = 0) -> list[Document]:
+    # Páginas con palabras aleatorias: cada chunk es único (el dedup no colapsa nada)
+    rng = np.random.default_rng(seed)
+    return [Document(page_content=" ".join(f"w{x}" for x in rng.integers(0, 10**6, 60)), metadata={"source": source, "page": p}) for p in range(n_pages)]
+
+@pytest.fixture
+def fake_embeddings() -> FakeEmbeddings:
+    return FakeEmbeddings()
+
+@pytest.fixture
+def corpus(monkeypatch, tmp_path) -> dict[str, list[Document]]:
+    # PDFs "en disco" simulados: iter_pdfs_documents devuelve las páginas del diccionario (modificable dentro del test)
+    pdfs = {"a.pdf": make_pdf_docs("a.pdf", 40, seed=1), "b.pdf": make_pdf_docs("b.pdf", 40, seed=2)}
+    monkeypatch.setattr(main, "iter_pdfs_documents", lambda fnames, **kw: ((f, pdfs[f]) for f in fnames))
+    monkeypatch.setattr(main, "FAISS_INDEX_PATH", str(tmp_path / "indice"))
+    monkeypatch.setattr(main, "FAISS_RECALL_EVAL_QUERIES", 0)
+    return pdfs
+
+def assert_self_retrieval(vectorstore, embeddings, pdfs) -> None:
+    # Cada chunk indexado debe recuperarse a sí mismo como top-1, también con el filtro por PDF
+    for source in pdfs:
+        ids = main.get_source_faiss_ids(vectorstore)[source]
+        assert len(ids) > 0
+        docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(i)]) for i in ids]
+        hits = main.search_faiss_filtered(vectorstore, main.embed_texts(embeddings, [d.page_content for d in docs]), 1, source)
+        assert [h[0][0].page_content for h in hits] == [d.page_content for d in docs]
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    # LLM determinista sin red: cada fusión devuelve un texto corto; sin caché, streaming ni esperas del limitador
+    monkeypatch.setattr(main, "LLM_CACHE_PATH", None)
+    monkeypatch.setattr(main, "_LLM_CACHE", None)
+    monkeypatch.setattr(main, "LLM_STREAMING", False)
+    monkeypatch.setattr(main, "_LLM_CHARS_PER_TOKEN_CALIBRATED", None)
+    monkeypatch.setattr(main, "LLM_RATE_LIMITER", main.LLMRateLimiter(10_000, 10**9))
+    llamadas = []
+    def _responder(prompt):
+        llamadas.append(prompt.to_string())
+        return f"fusion {len(llamadas)}"
+    llm = RunnableLambda(_responder)
+    llm.llamadas = llamadas
+    return llm
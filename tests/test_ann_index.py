@@ -0,0 +1,55 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+import main
+from conftest import assert_self_retrieval, make_pdf_docs
+
+@pytest.mark.parametrize("factory", ["IVF4,Flat", "HNSW8"])
+def test_non_flat_index_rebuilds_on_removal(corpus, fake_embeddings, monkeypatch, factory):
+    monkeypatch.setattr(main, "FAISS_INDEX_FACTORY", factory)
+    hashes = {"a.pdf": "a" * 64, "b.pdf": "b" * 64}
+    vs = main.stage_index(fake_embeddings, list(corpus), hashes, rebuild=True)
+    n_inicial = vs.index.ntotal
+    vs.docstore.close()
+
+    corpus["a.pdf"] = make_pdf_docs("a.pdf", 30, seed=3) # PDF modificado: menos páginas y otro contenido
+    hashes = {"a.pdf": "c" * 64, "b.pdf": "b" * 64}
+    vs = main.stage_index(fake_embeddings, list(corpus), hashes, rebuild=True)
+    assert vs.index.ntotal < n_inicial
+    assert len(vs.index_to_docstore_id) == vs.index.ntotal
+    assert set(main.load_faiss_manifest(main.FAISS_INDEX_PATH)) == {"a.pdf", "b.pdf"}
+    assert_self_retrieval(vs, fake_embeddings, corpus)
+    vs.docstore.close()
+
+def test_non_flat_index_does_not_support_removal():
+    assert main.faiss_index_supports_removal(faiss.index_factory(8, "Flat"))
+    assert not main.faiss_index_supports_removal(faiss.index_factory(8, "IVF4,Flat"))
+    assert not main.faiss_index_supports_removal(faiss.index_factory(8, "HNSW8"))
+
+def test_streaming_training_sample_spans_whole_stream(fake_embeddings, monkeypatch, tmp_path):
+    # Los chunks llegan ordenados por PDF: entrenar con los primeros lotes solo vería a.pdf
+    monkeypatch.setattr(main, "FAISS_INDEX_FACTORY", "IVF4,Flat")
+    monkeypatch.setattr(main, "FAISS_TRAIN_SAMPLE_SIZE", 20)
+    monkeypatch.setattr(main, "FAISS_RECALL_EVAL_QUERIES", 0)
+    trained_on = []
+    create = main.create_faiss_index
+    monkeypatch.setattr(main, "create_faiss_index", lambda vectors, factory: trained_on.append(np.array(vectors)) or create(vectors, factory))
+    chunks = make_pdf_docs("a.pdf", 40, seed=1) + make_pdf_docs("b.pdf", 40, seed=2)
+    source_of = {main.embed_texts(fake_embeddings, [d.page_content])[0].tobytes(): d.metadata["source"] for d in chunks}
+
+    vs = main.build_faiss_index_streaming(iter(chunks), fake_embeddings, str(tmp_path / "indice"), batch_size=8)
+    assert vs.index.ntotal == 80 and len(trained_on) == 1 and len(trained_on[0]) == 20
+    assert {source_of[v.tobytes()] for v in trained_on[0]} == {"a.pdf", "b.pdf"}
+    assert_self_retrieval(vs, fake_embeddings, {"a.pdf": chunks[:40], "b.pdf": chunks[40:]})
+    vs.docstore.close()
+    assert not any(f.endswith(".spill") for _, _, files in os.walk(tmp_path) for f in files)
+
+def test_recall_is_measured_on_held_out_vectors():
+    vectors = np.random.default_rng(0).standard_normal((300, 16)).astype(np.float32)
+    exact = faiss.IndexFlatL2(16); exact.add(vectors)
+    assert main.evaluate_index_recall(exact, vectors, n_queries=50, held_out=np.arange(200, 300), block_size=64) == 1.0
+    train_rows = main.faiss_training_rows(300, sample_size=200)
+    assert len(np.setdiff1d(np.arange(300), train_rows)) == 100
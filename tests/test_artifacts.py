@@ -0,0 +1,28 @@
+import os
+
+import main
+
+def test_artifact_store_prunes_superseded_versions(tmp_path):
+    store = main.ArtifactStore(str(tmp_path))
+    for version in range(3): # Tres ejecuciones anteriores: la plantilla cambió y la clave con ella
+        store.put("analyze", f"a{version}", "texto", {"source": "a.pdf", "parametro": "PD"})
+        os.utime(os.path.join(tmp_path, "analyze", f"a{version}.json"), (version, version))
+    store.put("analyze", "b0", "texto", {"source": "b.pdf", "parametro": "PD"})
+
+    store = main.ArtifactStore(str(tmp_path)) # Ejecución actual: reutiliza a0 y calcula a3
+    assert store.get("analyze", "a0") == "texto"
+    store.put("analyze", "a3", "texto", {"source": "a.pdf", "parametro": "PD"})
+    assert store.prune(keep=1) == 1
+    assert sorted(os.listdir(tmp_path / "analyze")) == ["a0.json", "a2.json", "a3.json", "b0.json"]
+    assert store.prune(keep=0) == 2 and sorted(os.listdir(tmp_path / "analyze")) == ["a0.json", "a3.json"]
+
+def test_global_conclusion_is_not_stored_on_llm_failure(monkeypatch, tmp_path):
+    store = main.ArtifactStore(str(tmp_path))
+    monkeypatch.setattr(main, "stage_digest", lambda *args: (["resumen"], ["k"]))
+    fallo = "## CONCLUSIONES\n*Error al generar la conclusión global. Mensaje del LLM: Error de API (Rate limit/Cuota) para generar conclusión*"
+    monkeypatch.setattr(main, "generate_global_conclusion", lambda *args: fallo)
+    assert main.stage_global_conclusion(store, object(), ["informe"], ["r"], ["A"]) == fallo
+    assert not store.computed
+    monkeypatch.setattr(main, "generate_global_conclusion", lambda *args: "## CONCLUSIONES\nTexto válido")
+    main.stage_global_conclusion(store, object(), ["informe"], ["r"], ["A"])
+    assert store.computed == {"global_conclusion": 1}
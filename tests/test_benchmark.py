@@ -0,0 +1,29 @@
+import logging
+
+import pytest
+
+import benchmark
+import main
+import stub_llm_server
+
+def test_run_benchmark_restores_main_globals_on_failure(monkeypatch, tmp_path):
+    previos = {name: getattr(main, name) for name in benchmark.MAIN_GLOBALS_OVERRIDDEN}
+    logging.getLogger().setLevel(logging.DEBUG)
+    def falla(*args):
+        logging.getLogger().setLevel(logging.WARNING); main.LLM_RATE_LIMITER = main.LLMRateLimiter(1, 1)
+        raise RuntimeError("corpus")
+    monkeypatch.setattr(benchmark, "generate_synthetic_corpus", falla)
+    with pytest.raises(RuntimeError): benchmark.run_benchmark(benchmark.parse_args(["--workdir", str(tmp_path)]))
+    assert {name: getattr(main, name) for name in benchmark.MAIN_GLOBALS_OVERRIDDEN} == previos
+    assert logging.getLogger().level == logging.DEBUG
+
+def test_benchmark_llm_shuts_down_stub_server_on_failure(monkeypatch):
+    servidores, limitador, url, start_in_thread = [], main.LLM_RATE_LIMITER, main.LLM_BASE_URL, stub_llm_server.start_in_thread
+    def start(*args, **kwargs):
+        server, url = start_in_thread(*args, **kwargs); servidores.append(server); return server, url
+    monkeypatch.setattr(stub_llm_server, "start_in_thread", start)
+    monkeypatch.setattr(main, "run_llm_chains_concurrently", lambda *args: (_ for _ in ()).throw(RuntimeError("llm")))
+    try:
+        with pytest.raises(RuntimeError): benchmark.benchmark_llm(benchmark.parse_args(["--llm-calls", "2"]), benchmark.StageTimer(), ["contexto"])
+    finally: main.LLM_RATE_LIMITER, main.LLM_BASE_URL = limitador, url
+    assert servidores and servidores[0].socket.fileno() == -1
@@ -0,0 +1,30 @@
+import main
+
+def test_group_by_token_budget():
+    count = lambda text: int(text)
+    assert main.group_by_token_budget(["3", "3", "3", "9", "1"], 6, count) == [["3", "3"], ["3"], ["9"], ["1"]]
+    assert main.group_by_token_budget([], 6, count) == []
+
+def test_reduce_digests_merges_until_budget(fake_llm):
+    digests = [f"resumen {i} " + "hallazgo " * 200 for i in range(8)] # ~500 tokens estimados cada uno
+    result = main.reduce_digests(fake_llm, digests, token_budget=1200)
+    assert sum(main.count_llm_tokens(d) for d in result) <= 1200
+    assert all(d.startswith("fusion") for d in result)
+    assert fake_llm.llamadas and all("resumen" in p for p in fake_llm.llamadas)
+
+def test_reduce_digests_keeps_digests_that_fit(fake_llm):
+    digests = ["corto uno", "corto dos"]
+    assert main.reduce_digests(fake_llm, digests, token_budget=1000) == digests
+    assert not fake_llm.llamadas
+
+def test_unsummarized_report_is_cut_to_the_digest_token_quota(fake_llm, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "run_llm_chains_concurrently", lambda llm, trabajos: ["Error LLM para resumir (Tipo: ValueError)."] * len(trabajos))
+    informe = "\n".join(f"Hallazgo {i}: " + "detalle metodológico " * 30 for i in range(40))
+    digests, keys = main.stage_digest(main.ArtifactStore(str(tmp_path)), fake_llm, [informe], ["r"], ["Banco A"])
+    assert len(digests) == 1 and digests[0].startswith("Hallazgo 0:")
+    assert main.count_llm_tokens(digests[0]) <= main.CONCLUSION_DIGEST_MAX_TOKENS + 20 # + marca de recorte
+
+def test_global_conclusion_prompt_receives_reduced_digests(fake_llm):
+    conclusion = main.generate_global_conclusion(fake_llm, ["resumen del banco A", "resumen del banco B"], ["A", "B"])
+    assert conclusion.startswith("fusion")
+    assert "resumen del banco A\n\nresumen del banco B" in fake_llm.llamadas[0]
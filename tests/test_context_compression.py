@@ -0,0 +1,30 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import main
+
+class KeywordEmbeddings(Embeddings):
+    # Un eje por palabra clave: la similitud coseno solo depende de qué claves comparte cada texto
+    KEYWORDS = ("pd", "lgd", "ead", "macro")
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [[float(k in t.lower().split()) for k in self.KEYWORDS] + [0.1] for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+def test_compress_chunks_keeps_table_markers_and_header():
+    filas = ["| pd 12 meses | 1,2 |", "| lgd senior | 45 |", "| ead tarjetas | 300 |", "| pd lifetime | 3,4 |"]
+    contenido = f"Tabla 2 de a.pdf (página 5)\n\n{main._TABLE_START}\n| concepto | valor |\n|---|---|\n" + "\n".join(filas) + f"\n{main._TABLE_END}\nNota al pie"
+    doc = Document(page_content=contenido, metadata={"source": "a.pdf", "page": 5, "is_table": True})
+    [result] = main.compress_chunks([doc], "pd", "pd", KeywordEmbeddings(), keep_ratio=0.4, min_similarity=0.9)
+    assert result.page_content == (f"Tabla 2 de a.pdf (página 5)\n\n{main._TABLE_START}\n| concepto | valor |\n|---|---|\n"
+                                   f"| pd 12 meses | 1,2 |\n| pd lifetime | 3,4 |\n{main._TABLE_END}\nNota al pie")
+    assert result.metadata == {**doc.metadata, "compressed": True}
+
+def test_compress_chunks_marks_gaps_in_text_and_drops_empty_chunks():
+    texto = Document(page_content="La pd se calibra anualmente. El ead usa factores de conversión. La pd incorpora escenarios.", metadata={"source": "a.pdf", "page": 2})
+    otro = Document(page_content="Sección sobre macro y escenarios.", metadata={"source": "a.pdf", "page": 3})
+    result = main.compress_chunks([texto, otro], "pd", "pd", KeywordEmbeddings(), keep_ratio=0.3, min_similarity=0.9)
+    assert [d.page_content for d in result] == ["La pd se calibra anualmente. [...] La pd incorpora escenarios."]
+    assert result[0].metadata["page"] == 2 and result[0].metadata["compressed"]
@@ -0,0 +1,39 @@
+import numpy as np
+from langchain_core.documents import Document
+
+import main
+
+count_words = lambda text: len(text.split())
+
+def chunk(n: int, text: str, source: str = "a.pdf") -> Document:
+    return Document(page_content=text, metadata={"source": source, "page": n + 1, "chunk_id": f"{source}:hash:{n}"})
+
+def test_trim_chunk_overlaps_removes_splitter_overlap_and_contained_chunks():
+    solape = "texto compartido por el solapamiento del splitter"
+    docs = [chunk(0, "inicio del primer chunk " + solape), chunk(1, solape + " y continuación del segundo chunk"),
+            chunk(5, "inicio del primer chunk"), chunk(7, solape + " en un chunk no contiguo")]
+    result = main.trim_chunk_overlaps(docs)
+    assert [d.page_content for d in result] == [docs[0].page_content, "y continuación del segundo chunk", docs[3].page_content]
+    assert result[1].metadata["overlap_trimmed"] and "overlap_trimmed" not in result[2].metadata
+
+def test_mmr_order_prefers_diverse_documents():
+    q = np.array([1.0, 0.0], dtype=np.float32)
+    docs = np.array([[1.0, 0.0], [1.0, 0.0], [0.6, 0.8]], dtype=np.float32) # El segundo duplica al primero
+    assert main.mmr_order(q, docs, lambda_mult=0.3) == [0, 2, 1]
+    assert main.mmr_order(q, docs, lambda_mult=1.0)[:2] == [0, 1]
+
+def test_pack_context_respects_budget_and_skips_chunks_that_do_not_fit():
+    docs = [chunk(0, "uno " * 10), chunk(2, "grande " * 50), chunk(4, "tres " * 10)]
+    contexto = main.pack_context(docs, "consulta", None, token_budget=40, count_tokens=count_words, separator="\n---\n")
+    partes = contexto.split("\n---\n")
+    assert len(partes) == 2 and "grande" not in contexto # El chunk grande no cabe, pero el siguiente sí
+    assert partes[0].startswith("Fuente: a.pdf, Página: 1") and partes[1].startswith("Fuente: a.pdf, Página: 5")
+    assert count_words(contexto) <= 40
+    assert main.pack_context(docs, "consulta", None, token_budget=0, count_tokens=count_words) == ""
+
+def test_pack_context_orders_by_mmr_with_embeddings(fake_embeddings):
+    docs = [chunk(0, "uno " * 10), chunk(2, "dos " * 10), chunk(4, "tres " * 10)]
+    contexto = main.pack_context(docs, "consulta", fake_embeddings, token_budget=1000, count_tokens=count_words)
+    vectors = main.embed_texts(fake_embeddings, ["consulta"] + [d.page_content for d in docs])
+    esperado = [main.format_context_chunk(docs[i]) for i in main.mmr_order(vectors[0], vectors[1:])]
+    assert contexto == "\n\n---\n\n".join(esperado)
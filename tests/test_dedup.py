@@ -0,0 +1,39 @@
+from langchain_core.documents import Document
+
+import main
+from conftest import assert_self_retrieval, make_pdf_docs
+
+HASHES = {"a.pdf": "a" * 64, "b.pdf": "b" * 64}
+
+def test_deduplicate_chunks_collapses_across_sources():
+    filas = [f"clausula {i} exencion de responsabilidad importe {i * 10}" for i in range(20)]
+    tabla = f"{main._TABLE_START}\n| clausula | importe |\n|---|---:|\n" + "\n".join(f"| {f} |" for f in filas) + f"\n{main._TABLE_END}"
+    chunks = [Document(page_content="\n".join(filas), metadata={"source": "a.pdf", "page": 1}),
+              Document(page_content=tabla, metadata={"source": "a.pdf", "page": 7, "is_table": True}),
+              Document(page_content="\n".join(filas), metadata={"source": "b.pdf", "page": 2}),
+              Document(page_content="contenido distinto " * 30, metadata={"source": "a.pdf", "page": 3})]
+    result = main.deduplicate_chunks(chunks)
+    assert len(result) == 2
+    colapsado = next(d for d in result if d.metadata.get("duplicates_collapsed"))
+    assert colapsado.metadata["is_table"] and colapsado.metadata["duplicates_collapsed"] == 2 # Se conserva la versión tabular
+    assert colapsado.metadata["sources"] == ["a.pdf", "b.pdf"] and colapsado.metadata["pages"] == [1, 7]
+    assert colapsado.metadata["source_pages"] == {"a.pdf": [1, 7], "b.pdf": [2]}
+    assert main.format_source_reference(colapsado.metadata) == "Fuentes: a.pdf (pág. 1, 7); b.pdf (pág. 2)"
+
+def test_streaming_dedup_keeps_shared_chunk_searchable_per_source(corpus, fake_embeddings):
+    corpus["b.pdf"][5] = Document(page_content=corpus["a.pdf"][3].page_content, metadata={"source": "b.pdf", "page": 5})
+    vs = main.stage_index(fake_embeddings, list(corpus), HASHES, rebuild=True)
+    assert vs.index.ntotal == 79
+    compartido = main.semantic_search_filtered(corpus["a.pdf"][3].page_content, vs, k=1, source_filename="b.pdf")[0]
+    assert compartido.metadata["source"] == "a.pdf" and compartido.metadata["source_pages"] == {"a.pdf": [3], "b.pdf": [5]}
+    manifest = main.load_faiss_manifest(main.FAISS_INDEX_PATH)
+    assert compartido.metadata["chunk_id"] in manifest["b.pdf"]["ids"] and len(manifest["b.pdf"]["ids"]) == 40
+    vs.docstore.close()
+
+    # Modificar a.pdf retira el chunk compartido: b.pdf se reindexa también para no perderlo
+    assert main.diff_pdf_manifest(manifest, {**HASHES, "a.pdf": "c" * 64}) == (["a.pdf", "b.pdf"], ["a.pdf", "b.pdf"])
+    corpus["a.pdf"] = make_pdf_docs("a.pdf", 30, seed=3)
+    vs = main.stage_index(fake_embeddings, list(corpus), {**HASHES, "a.pdf": "c" * 64}, rebuild=True)
+    assert len(main.get_source_faiss_ids(vs)["b.pdf"]) == 40 and vs.index.ntotal == 70
+    assert_self_retrieval(vs, fake_embeddings, corpus)
+    vs.docstore.close()
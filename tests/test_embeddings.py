@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import main
+
+class FakeSentenceTransformer:
+    # Codifica cada texto en un vector determinista y cuenta cuántos textos llegan al modelo
+    max_seq_length = 512
+
+    def __init__(self, model_name: str, **kwargs):
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return 8
+
+    def encode(self, texts: list[str], batch_size: int = 32, convert_to_numpy: bool = True) -> np.ndarray:
+        self.encoded.extend(texts)
+        return np.array([[len(t) + i for i in range(8)] for t in texts], dtype=np.float32)
+
+@pytest.fixture
+def local_embeddings(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "SentenceTransformer", FakeSentenceTransformer)
+    return lambda **kw: main.LocalEmbeddings("fake-model", cache_dir=str(tmp_path / "cache"), num_processes=1, **kw)
+
+def test_embed_chunks_hits_cache_across_instances(local_embeddings):
+    first = local_embeddings()
+    vectors = first.embed_chunks(["uno", "dos  tres", "uno"])
+    assert isinstance(vectors, np.ndarray) and vectors.dtype == np.float32 and vectors.shape == (3, 8)
+    assert first.model.encoded == ["uno", "dos tres"]
+
+    second = local_embeddings()
+    again = second.embed_chunks(["dos tres", "cuatro"])
+    assert second.model.encoded == ["cuatro"]
+    np.testing.assert_array_equal(again[0], vectors[1])
+
+def test_public_methods_return_lists_and_skip_cache(local_embeddings):
+    embeddings = local_embeddings()
+    docs = embeddings.embed_documents(["consulta"])
+    assert isinstance(docs, list) and isinstance(docs[0], list) and len(docs[0]) == 8
+    assert isinstance(embeddings.embed_query("consulta"), list)
+    assert embeddings.cache.n_rows == 0
+    assert isinstance(main.embed_texts(embeddings, ["consulta"]), np.ndarray) and embeddings.cache.n_rows == 0
+
+def test_embedding_cache_is_bounded(tmp_path):
+    cache = main.EmbeddingCache(str(tmp_path), "ns", dim=4, max_mb=10 * 4 * 4 / (1024 * 1024))
+    for i in range(25): cache.add([f"k{i}"], np.full((1, 4), i, dtype=np.float32))
+    assert cache.n_rows <= 10
+
+    reopened = main.EmbeddingCache(str(tmp_path), "ns", dim=4, max_mb=None)
+    vectors, missing = reopened.lookup(["k24", "k0"])
+    assert missing == [1]
+    np.testing.assert_array_equal(vectors[0], np.full(4, 24, dtype=np.float32))
@@ -0,0 +1,49 @@
+import os
+
+import main
+from conftest import assert_self_retrieval, make_pdf_docs
+
+HASHES = {"a.pdf": "a" * 64, "b.pdf": "b" * 64}
+
+def test_incremental_update_replaces_modified_pdf(corpus, fake_embeddings):
+    vs = main.stage_index(fake_embeddings, list(corpus), HASHES, rebuild=True)
+    n_inicial = vs.index.ntotal
+    vs.docstore.close()
+
+    corpus["a.pdf"] = make_pdf_docs("a.pdf", 30, seed=3) # PDF modificado: menos páginas y otro contenido
+    vs = main.stage_index(fake_embeddings, list(corpus), {**HASHES, "a.pdf": "c" * 64}, rebuild=True)
+    assert vs.index.ntotal == n_inicial - 10
+    assert len(vs.index_to_docstore_id) == vs.index.ntotal
+    assert set(main.load_faiss_manifest(main.FAISS_INDEX_PATH)) == {"a.pdf", "b.pdf"}
+    assert_self_retrieval(vs, fake_embeddings, corpus)
+    vs.docstore.close()
+
+def test_incremental_update_shares_docstore_and_collects_garbage(corpus, fake_embeddings):
+    vs = main.stage_index(fake_embeddings, list(corpus), HASHES, rebuild=True)
+    base_dir = main.resolve_faiss_index_dir(main.FAISS_INDEX_PATH)
+    vs.docstore.close()
+
+    del corpus["b.pdf"]
+    vs = main.stage_index(fake_embeddings, ["a.pdf"], {"a.pdf": HASHES["a.pdf"]}, rebuild=True)
+    new_dir = main.resolve_faiss_index_dir(main.FAISS_INDEX_PATH)
+    # La versión nueva no copia el docstore: referencia el de la versión base, que conserva las filas de b.pdf para el rollback
+    assert not os.path.exists(os.path.join(new_dir, main.FAISS_DOCSTORE_FILENAME))
+    assert main.faiss_docstore_path(new_dir) == os.path.join(base_dir, main.FAISS_DOCSTORE_FILENAME)
+    assert vs.index.ntotal == 40 and vs.docstore.count() == 80
+    assert set(main.get_source_faiss_ids(vs)) == {"a.pdf"}
+    vs.docstore.close()
+
+    main.prune_faiss_versions(main.FAISS_INDEX_PATH, keep=0) # La base se conserva (su docstore está en uso) y se recolecta
+    assert os.path.isdir(base_dir)
+    vs = main.load_faiss_vectorstore(main.FAISS_INDEX_PATH, fake_embeddings)
+    assert vs.docstore.count() == vs.index.ntotal == 40
+    main.validate_faiss_vectorstore(vs)
+    vs.docstore.close()
+
+def test_diff_pdf_manifest():
+    manifest = {"igual.pdf": {"sha256": "1"}, "cambiado.pdf": {"sha256": "2"}, "retirado.pdf": {"sha256": "3"}, "ilegible.pdf": {"sha256": "4"}}
+    hashes = {"igual.pdf": "1", "cambiado.pdf": "2b", "nuevo.pdf": "5"}
+    to_index, to_remove = main.diff_pdf_manifest(manifest, hashes, unreadable={"ilegible.pdf"})
+    assert sorted(to_index) == ["cambiado.pdf", "nuevo.pdf"]
+    assert sorted(to_remove) == ["cambiado.pdf", "retirado.pdf"] # ilegible.pdf conserva sus vectores
+    assert "ilegible.pdf" in main.diff_pdf_manifest(manifest, hashes)[1]
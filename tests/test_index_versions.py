@@ -0,0 +1,24 @@
+import faiss
+import pytest
+
+import main
+
+def test_validation_detects_misaligned_mapping(corpus, fake_embeddings):
+    vs = main.stage_index(fake_embeddings, list(corpus), {"a.pdf": "a" * 64, "b.pdf": "b" * 64}, rebuild=True)
+    main.validate_faiss_vectorstore(vs)
+    ids = list(vs.index_to_docstore_id.values())
+    vs.index_to_docstore_id = {i: ids[(i + 7) % len(ids)] for i in vs.index_to_docstore_id} # Mismos conteos, mapeo desplazado
+    with pytest.raises(ValueError, match="Auto-recuperación"): main.validate_faiss_vectorstore(vs)
+    vs.docstore.close()
+
+@pytest.mark.parametrize("factory", ["IVF4,PQ8x4", "HNSW8"])
+def test_validation_accepts_approximate_indexes(corpus, fake_embeddings, monkeypatch, factory):
+    # Índices aproximados: se valida con el umbral top-k, que sigue detectando un mapeo desplazado
+    monkeypatch.setattr(main, "FAISS_INDEX_FACTORY", factory)
+    vs = main.stage_index(fake_embeddings, list(corpus), {"a.pdf": "a" * 64, "b.pdf": "b" * 64}, rebuild=True)
+    assert not isinstance(faiss.downcast_index(vs.index), faiss.IndexFlat)
+    main.validate_faiss_vectorstore(vs)
+    ids = list(vs.index_to_docstore_id.values())
+    vs.index_to_docstore_id = {i: ids[(i + 7) % len(ids)] for i in vs.index_to_docstore_id}
+    with pytest.raises(ValueError, match="Auto-recuperación"): main.validate_faiss_vectorstore(vs)
+    vs.docstore.close()
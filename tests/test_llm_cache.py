@@ -0,0 +1,15 @@
+import time
+
+import main
+
+def test_llm_response_cache_evicts_least_recently_used(tmp_path):
+    cache = main.LLMResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=300)
+    for key in ("a", "b", "c"):
+        cache.put(key, key * 100); time.sleep(0.01)
+    assert cache.get("a") == "a" * 100 # "a" pasa a ser la más reciente
+    time.sleep(0.01)
+    cache.put("d", "d" * 100)
+    assert cache.get("b") is None
+    assert [cache.get(k) is not None for k in ("a", "c", "d")] == [True, True, True]
+    st = cache.stats()
+    assert st["entries"] == 3 and st["bytes"] == 300 and st["hits"] == 4 and st["misses"] == 1
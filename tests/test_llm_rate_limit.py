@@ -0,0 +1,63 @@
+import random
+import threading
+
+import httpx
+import pytest
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableLambda
+
+import main
+
+PROMPT = PromptTemplate.from_template("Resume: {context}")
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    # Reloj simulado: time.sleep avanza time.monotonic sin esperar de verdad
+    clock = {"now": 1000.0, "sleeps": []}
+    def _sleep(seconds):
+        clock["sleeps"].append(seconds); clock["now"] += seconds
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(main.time, "sleep", _sleep)
+    return clock
+
+def test_rate_limiter_waits_for_request_bucket(fake_clock):
+    limiter = main.LLMRateLimiter(requests_per_minute=2, tokens_per_minute=10_000)
+    assert limiter.acquire(10) == 0 and limiter.acquire(10) == 0
+    assert limiter.acquire(10) == pytest.approx(30.0) # 1 petición a 2/min
+
+def test_rate_limiter_waits_for_token_bucket_and_caps_large_requests(fake_clock):
+    limiter = main.LLMRateLimiter(requests_per_minute=1000, tokens_per_minute=1000)
+    assert limiter.acquire(800) == 0
+    assert limiter.acquire(800) == pytest.approx(36.0) # Faltan 600 tokens a 1000/min
+    fake_clock["now"] += 60
+    assert limiter.acquire(5000) == 0 # Más que la capacidad: se limita a la capacidad, no espera para siempre
+
+def test_rate_limiter_is_shared_between_threads():
+    limiter = main.LLMRateLimiter(requests_per_minute=5, tokens_per_minute=10**9)
+    waits = []
+    hilos = [threading.Thread(target=lambda: waits.append(limiter._reserve(1))) for _ in range(8)]
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    assert sum(w == 0 for w in waits) == 5 # Solo la capacidad del bucket pasa sin esperar
+
+def test_backoff_delay_uses_full_jitter_and_provider_hint():
+    random.seed(0)
+    delays = [main.llm_backoff_delay(3) for _ in range(200)]
+    assert all(0 <= d <= main.LLM_BACKOFF_BASE_SECONDS * 2 ** 3 for d in delays) and len(set(delays)) > 100
+    assert all(d <= main.LLM_BACKOFF_MAX_SECONDS for d in (main.llm_backoff_delay(20) for _ in range(50)))
+    assert 20 <= main.llm_backoff_delay(0, Exception("429 Too Many Requests. Retry-After: 20")) <= 21
+
+def test_run_llm_chain_retries_transient_errors(fake_llm, fake_clock):
+    fallos = [httpx.ConnectTimeout("timeout"), Exception("503 Service Unavailable")]
+    def _responder(prompt):
+        if fallos: raise fallos.pop(0)
+        return "ok"
+    result = main.run_llm_chain(RunnableLambda(_responder), PROMPT, {"context": "texto"}, "resumir prueba", limiter=main.LLMRateLimiter(10_000, 10**9))
+    assert result == "ok" and len(fake_clock["sleeps"]) == 2 # Solo los backoffs: el limitador tiene saldo
+
+def test_run_llm_chain_does_not_retry_permanent_errors(fake_llm, fake_clock):
+    llamadas = []
+    def _responder(prompt):
+        llamadas.append(prompt); raise ValueError("invalid argument")
+    result = main.run_llm_chain(RunnableLambda(_responder), PROMPT, {"context": "texto"}, "resumir prueba", limiter=main.LLMRateLimiter(10_000, 10**9))
+    assert main.is_llm_failure(result) and len(llamadas) == 1 and not fake_clock["sleeps"]
@@ -0,0 +1,38 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+def test_report_writer_appends_each_section_immediately(tmp_path):
+    writer = main.ReportWriter(str(tmp_path / "informe.md"))
+    writer.append("# Cabecera\n", is_section=False)
+    assert (tmp_path / "informe.md").read_text(encoding="utf-8") == "# Cabecera\n" and writer.sections == 0
+    writer.append("## A\n")
+    assert (tmp_path / "informe.md").read_text(encoding="utf-8") == "# Cabecera\n## A\n" and writer.sections == 1
+    writer.append("## B\n")
+    assert (tmp_path / "informe.md").read_text(encoding="utf-8").endswith("## A\n## B\n") and writer.sections == 2
+
+def test_competitor_section_is_written_while_others_are_still_analyzed(monkeypatch, tmp_path):
+    writer, store = main.ReportWriter(str(tmp_path / "informe.md")), main.ArtifactStore(None)
+    monkeypatch.setattr(main, "PARAMETROS_CLAVE", [{"nombre_parametro": "PD"}, {"nombre_parametro": "LGD"}])
+    monkeypatch.setattr(main, "build_analysis_inputs", lambda pdf, param_info, *args: {"pdf": pdf, "parametro": param_info["nombre_parametro"]})
+    monkeypatch.setattr(main, "stage_individual_report", lambda store, llm, pdf, analisis: (f"informe {pdf}: {analisis[(pdf, 'PD')][0]}", f"k-{pdf}"))
+    visto_durante_b = []
+
+    async def fake_arun_llm_chain(llm, prompt, inputs, desc, semaphore):
+        if inputs["pdf"] == "b.pdf": # b sigue en vuelo hasta ver escrita la sección de a
+            for _ in range(500):
+                if "informe a.pdf" in (tmp_path / "informe.md").read_text(encoding="utf-8"): break
+                await asyncio.sleep(0.01)
+            visto_durante_b.append("informe a.pdf" in (tmp_path / "informe.md").read_text(encoding="utf-8"))
+        return f"análisis {inputs['pdf']} {inputs['parametro']}"
+    monkeypatch.setattr(main, "arun_llm_chain", fake_arun_llm_chain)
+
+    futuros = {}
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        on_done = lambda pdf, analisis: futuros.setdefault(pdf, pool.submit(main.write_individual_report, writer, store, object(), pdf, analisis))
+        analisis = main.stage_analyze(store, object(), ["a.pdf", "b.pdf"], {}, on_competitor_done=on_done)
+        informes = [futuros[pdf].result() for pdf in ["a.pdf", "b.pdf"]]
+    assert visto_durante_b == [True, True]
+    assert informes == [("informe a.pdf: análisis a.pdf PD", "k-a.pdf"), ("informe b.pdf: análisis b.pdf PD", "k-b.pdf")]
+    assert len(analisis) == 4 and writer.sections == 2
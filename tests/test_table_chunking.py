@@ -0,0 +1,21 @@
+from langchain_core.documents import Document
+
+import main
+
+count_words = lambda text: len(text.split())
+
+def test_split_table_document_repeats_header_in_each_part():
+    filas = [f"| fila {i} | {i * 10} |" for i in range(40)]
+    contenido = f"Tabla 3 de a.pdf\n\n{main._TABLE_START}\n| concepto | valor |\n|---|---|\n" + "\n".join(filas) + f"\n{main._TABLE_END}"
+    doc = Document(page_content=contenido, metadata={"source": "a.pdf", "is_table": True})
+    partes = main.split_table_document(doc, count_words, chunk_size=60)
+    assert len(partes) > 1
+    for k, parte in enumerate(partes, 1):
+        assert count_words(parte.page_content) <= 60
+        assert parte.page_content.startswith("Tabla 3 de a.pdf") and "| concepto | valor |\n|---|---|" in parte.page_content
+        assert parte.metadata["table_part"] == k and parte.metadata["table_parts"] == len(partes)
+    assert [l for p in partes for l in p.page_content.split("\n") if l.startswith("| fila")] == filas
+
+def test_split_table_document_keeps_small_tables():
+    doc = Document(page_content=f"{main._TABLE_START}\n| a |\n|---|\n| 1 |\n{main._TABLE_END}", metadata={"is_table": True})
+    assert main.split_table_document(doc, count_words, chunk_size=60) == [doc]
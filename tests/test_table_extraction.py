@@ -0,0 +1,43 @@
+import random
+
+import pandas as pd
+
+import benchmark
+import main
+
+def write_sample_pdf(path) -> str:
+    # Pág. 1: texto; pág. 2: tabla reglada; pág. 3: tabla solo alineada en columnas
+    rng = random.Random(0)
+    benchmark.write_pdf(str(path), [benchmark.text_page_content(rng, 1), benchmark.table_page_content(rng, 2, 8, 4, ruled=True),
+                                    benchmark.table_page_content(rng, 3, 8, 4, ruled=False)])
+    return str(path)
+
+class FakeTableReport:
+    def __init__(self, page: int):
+        self.page, self.parsing_report = str(page), {"accuracy": 99.0}
+        self.df = pd.DataFrame([["Stage 1", "1,234.5"], ["Stage 2", "(56.0)"]])
+
+class FakeTables(list):
+    @property
+    def n(self) -> int:
+        return len(self)
+
+def test_prescreen_selects_table_pages_and_detects_rulings(tmp_path):
+    assert main.screen_pdf_pages_for_tables(write_sample_pdf(tmp_path / "muestra.pdf")) == {2: True, 3: False}
+
+def test_stream_fallback_only_for_pages_without_lattice_tables(tmp_path, monkeypatch):
+    pdf_path = write_sample_pdf(tmp_path / "muestra.pdf")
+    monkeypatch.setattr(main, "screen_pdf_pages_for_tables", lambda path: {2: True, 3: True, 5: False})
+    llamadas = []
+    def fake_read_pdf(path, pages, flavor, **kwargs):
+        llamadas.append((flavor, pages))
+        return FakeTables([FakeTableReport(2)] if flavor == "lattice" else [FakeTableReport(int(p)) for p in pages.split(",")])
+    monkeypatch.setattr(main.camelot, "read_pdf", fake_read_pdf)
+    items, complete = main.extract_tables_from_pdf(pdf_path, prescreen=True)
+    assert llamadas == [("lattice", "2,3"), ("stream", "3,5")] # La pág. 2 ya tiene tabla 'lattice': no se repite con 'stream'
+    assert complete and [doc.metadata["extraction_method"] for doc, _ in items] == ["camelot_lattice", "camelot_stream", "camelot_stream"]
+
+def test_no_candidate_pages_skips_camelot(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "screen_pdf_pages_for_tables", lambda path: {})
+    monkeypatch.setattr(main.camelot, "read_pdf", lambda *a, **kw: (_ for _ in ()).throw(AssertionError("Camelot no debe ejecutarse")))
+    assert main.extract_tables_from_pdf(write_sample_pdf(tmp_path / "muestra.pdf")) == ([], True)
@@ -0,0 +1,37 @@
+import os
+
+import pandas as pd
+import pytest
+from langchain_core.documents import Document
+
+import main
+
+@pytest.mark.parametrize("text, expected", [
+    ("1,234.5", 1234.5), ("1.234,5", 1234.5), ("(1,234)", -1234.0), ("12.5%", 12.5), ("S/ 1,000", 1000.0),
+    ("US$ 3.2", 3.2), ("-7", -7.0), ("0,5", 0.5), ("1.234", 1234.0), ("2023", 2023.0),
+    ("abc", None), ("", None), ("n.d.", None),
+])
+def test_parse_numeric_cell(text, expected):
+    assert main.parse_numeric_cell(text) == expected
+
+def test_sync_table_store_extracts_without_extraction_cache(monkeypatch, tmp_path):
+    # Sin caché de extracción las tablas se leen de extract_tables_from_pdf; un PDF ya sincronizado no se vuelve a extraer
+    monkeypatch.setattr(main, "EXTRACTION_CACHE_DIR", None)
+    extraidos = []
+    def fake_extract(pdf_path):
+        extraidos.append(os.path.basename(pdf_path))
+        if pdf_path.endswith("b.pdf"): return [], True # PDF sin tablas
+        df = pd.DataFrame([["Concepto", "2023", "2024"], ["Pérdida esperada stage 2", "1.234,5", "(200)"]])
+        return [(Document(page_content="tabla", metadata={"source": "a.pdf", "page": 4, "is_table": True}), df)], True
+    monkeypatch.setattr(main, "extract_tables_from_pdf", lambda pdf_path, **kw: fake_extract(pdf_path))
+    store = main.TableStore(str(tmp_path / "tablas.sqlite"))
+    main.sync_table_store(store, {"a.pdf": "h1", "b.pdf": "h2"}, folder=str(tmp_path))
+    df = main.lookup_table_values(store, ["perdida esperada"], source="a.pdf")
+    assert df[["header", "value_num"]].values.tolist() == [["2023", 1234.5], ["2024", -200.0]]
+    assert set(df["page"]) == {4}
+
+    main.sync_table_store(store, {"a.pdf": "h1", "b.pdf": "h2"}, folder=str(tmp_path))
+    assert sorted(extraidos) == ["a.pdf", "b.pdf"]
+    main.sync_table_store(store, {"b.pdf": "h2"}, folder=str(tmp_path)) # a.pdf retirado
+    assert store.count_tables() == 0 and store.pdf_hashes() == {"b.pdf": "h2"}
+    store.close()
@@ -0,0 +1,21 @@
+import json
+
+import numpy as np
+
+import main
+
+def test_span_reports_rss_delta_not_process_peak(tmp_path):
+    tracer = main.Tracer(export_path=None, enabled=True, summary_at_exit=False)
+    with tracer.span("alloc"):
+        retenido = np.ones(64 * 1024 * 1024 // 8) # 64 MB residentes al cerrar el span
+    del retenido
+    with tracer.span("idle"): pass
+    alloc, idle = tracer.spans
+    assert alloc["rss_delta_mb"] >= 48 and idle["rss_delta_mb"] < 16 # El pico del proceso no se atribuye al span siguiente
+    assert idle["process_peak_rss_mb"] >= alloc["rss_end_mb"] - 1 # Fuentes distintas (ru_maxrss / statm), redondeo a 0.1 MB
+
+    rows = {row["name"]: row for row in tracer.summary_rows()}
+    assert rows["alloc"]["max_rss_delta_mb"] == alloc["rss_delta_mb"] and rows["idle"]["process_peak_rss_mb"] == idle["process_peak_rss_mb"]
+    tracer.export_otlp_json(str(tmp_path / "trazas.json"))
+    spans = json.loads((tmp_path / "trazas.json").read_text(encoding="utf-8"))["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert {"rss_delta_mb", "rss_end_mb", "process_peak_rss_mb"} <= {a["key"] for a in spans[0]["attributes"]}